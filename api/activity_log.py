@@ -0,0 +1,169 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, transaction
+
+from api.models import Activity
+
+
+# Put on the queue to stop the writer thread
+STOP = object()
+
+
+class ActivitySink:
+    """
+    Write-behind store for Activity records. add() only puts the record on a queue;
+    a background thread writes everything queued so far with one bulk_create, so a request
+    no longer waits for the SQLite write lock, and concurrent requests share one transaction.
+    While a batch is being written the next one builds up, so batches grow with the load.
+    Compressing the input and output into their PayloadBlobs happens in that thread too.
+    A record's 'created' is the time it is written, normally within milliseconds of add().
+    Until then its tokens are counted in unwritten_tokens(), for the token budgets.
+    """
+
+    def __init__(self, batch_size: int = 100, retries: int = 3):
+        self.batch_size = batch_size
+        self.retries = retries
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.pending_tokens = {}  # user id => tokens of the records added but not written yet
+
+    def add(self, activity: Activity) -> None:
+        self.start()
+        with self.lock:
+            self.pending_tokens[activity.user_id] = self.pending_tokens.get(activity.user_id, 0) + activity.total_tokens
+        self.queue.put(activity)
+
+    def unwritten_tokens(self, user_id: int) -> int:
+        return self.pending_tokens.get(user_id, 0)
+
+    def start(self) -> None:
+        """
+        Start the writer thread, again in a process forked from this one.
+        """
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name="activity-writer", daemon=True)
+                self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = STOP in batch
+            activities = [activity for activity in batch if activity is not STOP]
+            try:
+                if activities:
+                    self.write(activities)
+            finally:
+                with self.lock:
+                    for activity in activities:
+                        tokens = self.pending_tokens.get(activity.user_id, 0) - activity.total_tokens
+                        if tokens:
+                            self.pending_tokens[activity.user_id] = tokens
+                        else:
+                            self.pending_tokens.pop(activity.user_id, None)
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def write(self, activities: list[Activity]) -> None:
+        """
+        Insert the batch in one statement, trying again a little later while the database is locked;
+        if that keeps failing, save the records one by one, so one that can't be stored
+        doesn't take the others with it.
+        """
+        close_old_connections()
+        for attempt in range(self.retries + 1):
+            try:
+                with transaction.atomic():
+                    Activity.store_payloads(activities)
+                    Activity.objects.bulk_create(activities)
+                self.batches += 1
+                self.written += len(activities)
+                return
+            except OperationalError as e:
+                error = e
+                time.sleep(0.1 * 2**attempt)
+            except Exception as e:
+                error = e
+                break
+        print(f"[activity log] Writing {len(activities)} records at once failed, saving them one by one: {error}")
+        for activity in activities:
+            try:
+                activity.save()
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"[activity log] Lost the '{activity.endpoint}' activity of user {activity.user_id}: {e}")
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait until everything added so far has been written; False if 'timeout' seconds weren't enough.
+        """
+        if self.thread is None or self.pid != os.getpid():
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 10.0) -> None:
+        """
+        Write what is left and stop the writer thread, on shutdown.
+        """
+        if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        self.queue.put(STOP)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f"[activity log] {self.queue.qsize()} records not written after {timeout}s at shutdown")
+
+
+# One sink per process; a gunicorn worker that is stopped gracefully writes its queue before it exits
+sink = ActivitySink(batch_size=settings.ACTIVITY_BATCH_SIZE)
+atexit.register(sink.close)
+
+
+def log_activity(**fields) -> None:
+    """
+    Record a request: Activity.objects.create(**fields), written behind by the sink,
+    or right away when settings.ACTIVITY_WRITE_BEHIND is off, as in tests that look the record up.
+    """
+    if settings.ACTIVITY_WRITE_BEHIND:
+        sink.add(Activity(**fields))
+    else:
+        Activity.objects.create(**fields)
+
+
+def flush_activities(timeout: float = None) -> bool:
+    """
+    Wait until the activities logged so far are in the database.
+    """
+    return sink.flush(timeout)
+
+
+def unwritten_tokens(user) -> int:
+    """
+    Tokens of the user's activities logged by this process that aren't in the database yet.
+    """
+    return sink.unwritten_tokens(user.pk)
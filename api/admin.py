@@ -1,28 +1,147 @@
 import json
+import zlib
 from pygments import highlight
 from pygments.lexers import JsonLexer
 from pygments.formatters import HtmlFormatter
 
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
-from api.models import Activity
+from api.budgets import tokens_used_today
+from api.models import Activity, Job, PayloadBlob, UserTokenBudget
+from api.paths.caches import get_cache
 
 
-def pretty_json(instance, field_name):
-    """Function to display pretty version of our data"""
-    json_data = getattr(instance, field_name)
+# Longest string and list shown in full in a payload preview; the whole payload is a link away
+PREVIEW_STRING_CHARS = 2000
+PREVIEW_LIST_ITEMS = 20
+# Bytes of JSON decompressed for a preview; of a larger payload only its start is shown, as it is
+PREVIEW_BYTES = 2**16
+
+
+def highlighted_json(json_data) -> str:
     json_string = json.dumps(json_data, ensure_ascii=False, indent=2) if json_data else ''
+    return highlighted_json_string(json_string)
+
+
+def highlighted_json_string(json_string: str) -> str:
     formatter = HtmlFormatter(style='colorful')
     response = highlight(json_string, JsonLexer(), formatter)
     scroll_style = ".highlight { height: 20em; overflow: scroll; border: 1px solid lightgray; resize: both; min-width: 30em; } "
     style = "<style>" + scroll_style + formatter.get_style_defs() + "</style><br>"
-    return mark_safe(style + response)
+    return style + response
+
+
+def pretty_json(instance, field_name):
+    """Function to display pretty version of our data"""
+    return mark_safe(highlighted_json(getattr(instance, field_name)))
+
+
+def truncate_payload(value):
+    """
+    The payload with long strings and lists cut short, saying how much was left out.
+    """
+    if isinstance(value, str) and len(value) > PREVIEW_STRING_CHARS:
+        return value[:PREVIEW_STRING_CHARS] + f" … ({len(value) - PREVIEW_STRING_CHARS} more characters)"
+    if isinstance(value, list):
+        items = [truncate_payload(item) for item in value[:PREVIEW_LIST_ITEMS]]
+        if len(value) > PREVIEW_LIST_ITEMS:
+            items.append(f"… ({len(value) - PREVIEW_LIST_ITEMS} more items)")
+        return items
+    if isinstance(value, dict):
+        return {key: truncate_payload(item) for key, item in value.items()}
+    return value
+
+
+def payload_preview(digest: str) -> str:
+    """
+    Highlighted HTML of the truncated payload in a blob, or of the first PREVIEW_BYTES of its JSON
+    when it is larger, so a preview never decompresses or parses more than that. Blobs never change,
+    so the HTML is cached under their digest and the blob is only read the first time.
+    """
+    cache = get_cache('admin_previews')
+    key = f"{digest}|{PREVIEW_STRING_CHARS}|{PREVIEW_LIST_ITEMS}|{PREVIEW_BYTES}"
+    html = cache.get(key)
+    if html is None:
+        blob = PayloadBlob.objects.get(pk=digest)
+        if blob.size <= PREVIEW_BYTES:
+            html = highlighted_json(truncate_payload(blob.value))
+        else:
+            start = zlib.decompressobj().decompress(blob.data, PREVIEW_BYTES)
+            # The last character may be cut in half
+            html = highlighted_json_string(
+                start.decode(errors='ignore') + f" … ({blob.size - len(start)} more bytes)"
+            )
+        cache.set(key, html)
+    return html
 
 
 @admin.register(Activity)
 class ActivityAdmin(admin.ModelAdmin):
-    readonly_fields = ['created', 'input_prettified', 'output_prettified']
+    list_display = ['__str__', 'prompt_tokens', 'completion_tokens', 'llm_calls', 'llm_seconds', 'llm_cost',
+                    'input_summary']
+    list_filter = ['endpoint', 'user', 'created']
+    list_select_related = ['user']
+    list_per_page = 50
+    ordering = ['-created']
+    # Counting all activities for "(... total)" scans the whole table
+    show_full_result_count = False
+    readonly_fields = ['created', 'prompt_tokens', 'completion_tokens', 'llm_calls', 'llm_seconds', 'llm_cost',
+                       'input_prettified', 'output_prettified']
+    exclude = ['input_blob', 'output_blob', 'input_summary', 'output_summary']
+
+    def get_urls(self):
+        return [
+            path('<path:object_id>/payload/<str:name>/', self.admin_site.admin_view(self.payload_view),
+                 name='api_activity_payload'),
+            *super().get_urls(),
+        ]
+
+    def payload_view(self, request, object_id, name):
+        """
+        The whole input or output of an activity as JSON.
+        """
+        if name not in ('input', 'output'):
+            raise Http404
+        activity = get_object_or_404(Activity.objects.select_related(f'{name}_blob'), pk=object_id)
+        if not self.has_view_permission(request, activity):
+            raise PermissionDenied
+        blob = getattr(activity, f'{name}_blob')
+        if blob is None:
+            raise Http404
+        response = StreamingHttpResponse(blob.iter_json(), content_type='application/json; charset=utf-8')
+        response['Content-Length'] = blob.size
+        return response
+
+    def payload_field(self, instance, name):
+        digest = getattr(instance, f'{name}_blob_id')
+        if digest is None:
+            return '-'
+        link = format_html(
+            '<a href="{}">Whole {}</a>: {}',
+            reverse('admin:api_activity_payload', args=[instance.pk, name]), name, getattr(instance, f'{name}_summary')
+        )
+        return mark_safe(link + payload_preview(digest))
+
+    def input_prettified(self, instance):
+        return self.payload_field(instance, 'input')
+    input_prettified.short_description = 'Input'
+
+    def output_prettified(self, instance):
+        return self.payload_field(instance, 'output')
+    output_prettified.short_description = 'Output'
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'endpoint', 'status', 'created', 'finished']
+    list_filter = ['status', 'endpoint']
+    readonly_fields = ['created', 'finished', 'input_prettified', 'output_prettified']
     exclude = ['input', 'output']
 
     def input_prettified(self, instance):
@@ -32,3 +151,12 @@ class ActivityAdmin(admin.ModelAdmin):
     def output_prettified(self, instance):
         return pretty_json(instance, 'output')
     output_prettified.short_description = 'Output'
+
+
+@admin.register(UserTokenBudget)
+class UserTokenBudgetAdmin(admin.ModelAdmin):
+    list_display = ['user', 'daily_tokens', 'used_today']
+
+    def used_today(self, instance):
+        return tokens_used_today(instance.user)
+    used_today.short_description = 'Tokens used today'
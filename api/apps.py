@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Only processes that serve requests pick up the jobs a restart left unfinished,
+        # not management commands such as migrate
+        if settings.JOB_RESUME_ON_STARTUP:
+            from api.jobs import resume_pending_jobs_once
+            request_started.connect(resume_pending_jobs_once, dispatch_uid='resume_pending_jobs')
@@ -0,0 +1,165 @@
+import gzip
+import json
+import os
+import zlib
+from datetime import timedelta
+from pathlib import Path
+
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q, QuerySet, Sum
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from api.models import Activity, PayloadBlob
+
+
+# Usage fields of an activity, copied into its archive line
+USAGE_FIELDS = ['prompt_tokens', 'completion_tokens', 'llm_calls', 'llm_seconds', 'llm_cost']
+
+
+def expired_activities(retention_days: int, retention_days_by_endpoint: dict[str, int]) -> QuerySet:
+    """
+    The activities older than the retention of their endpoint, or 'retention_days' for other endpoints.
+    """
+    now = timezone.now()
+    expired = Q(created__lt=now - timedelta(days=retention_days)) & ~Q(endpoint__in=list(retention_days_by_endpoint))
+    for endpoint, days in retention_days_by_endpoint.items():
+        expired |= Q(endpoint=endpoint, created__lt=now - timedelta(days=days))
+    return Activity.objects.filter(expired)
+
+
+def unused_blobs(expired: QuerySet) -> QuerySet:
+    """
+    The payload blobs of the expired activities that no other activity refers to.
+    """
+    def referring(activities):
+        return Exists(activities.filter(Q(input_blob=OuterRef('pk')) | Q(output_blob=OuterRef('pk'))))
+
+    kept = Activity.objects.exclude(pk__in=expired.values('pk'))
+    return PayloadBlob.objects.filter(referring(expired)).exclude(referring(kept))
+
+
+def reclaimable(expired: QuerySet) -> dict:
+    """
+    What purging the expired activities would free: {'activities': {endpoint: count},
+    'blobs': count, 'blob_bytes': compressed size of their payloads, 'payload_bytes': size before compression}.
+    """
+    activities = dict(expired.values_list('endpoint').annotate(n=Count('pk')).order_by('endpoint'))
+    blobs = unused_blobs(expired).aggregate(blobs=Count('pk'), blob_bytes=Sum(Length('data')), payload_bytes=Sum('size'))
+    return {'activities': activities, **{key: value or 0 for key, value in blobs.items()}}
+
+
+def archive_month(activity: Activity) -> str:
+    return timezone.localtime(activity.created).strftime('%Y-%m')
+
+
+def archive_path(directory: Path, month: str) -> Path:
+    return directory / f'activities-{month}.jsonl.gz'
+
+
+def archive_line(activity: Activity, payloads: dict[str, bytes]) -> bytes:
+    """
+    One line of JSON with the fields of the activity, its user's name, and its input and output
+    copied from their blobs as they are, without parsing them.
+    """
+    fields = {
+        'id': activity.pk,
+        'user_id': activity.user_id,
+        'username': activity.user.username,
+        'endpoint': activity.endpoint,
+        'created': activity.created.isoformat(),
+        **{field: getattr(activity, field) for field in USAGE_FIELDS},
+    }
+    line = json.dumps(fields, ensure_ascii=False)[:-1].encode()
+    for name in ['input', 'output']:
+        digest = getattr(activity, f'{name}_blob_id')
+        line += f', "{name}": '.encode() + (zlib.decompress(payloads[digest]) if digest else b'null')
+    return line + b'}\n'
+
+
+def pending_path(path: Path) -> Path:
+    return path.with_name(path.name + '.pending')
+
+
+def recover_archives(directory: Path) -> int:
+    """
+    Finish what an interrupted archive_activities left: each '.pending' file holds the size
+    of an archive before a batch was added to it and the ids in that batch. If those activities
+    are still there, their deletion wasn't committed, so the batch is cut off again and will be
+    archived once more; otherwise the batch is complete. Returns the number of batches cut off.
+    """
+    cut = 0
+    for pending in sorted(directory.glob('*.jsonl.gz.pending')):
+        state = json.loads(pending.read_text())
+        path = pending.with_name(pending.name.removesuffix('.pending'))
+        if Activity.objects.filter(pk__in=state['ids']).exists() and path.exists():
+            with open(path, 'r+b') as file:
+                file.truncate(state['size'])
+            cut += 1
+        pending.unlink()
+    return cut
+
+
+def append_batch(path: Path, lines: list[bytes], ids: list[int]) -> Path:
+    """
+    Add the lines to the archive as one more gzip member, synced to disk, after noting
+    what was there before in a '.pending' file. Returns the '.pending' file, to be removed
+    once the activities have been deleted.
+    """
+    pending = pending_path(path)
+    pending.write_text(json.dumps({'size': path.stat().st_size if path.exists() else 0, 'ids': ids}))
+    with open(path, 'ab') as file:
+        with gzip.GzipFile(fileobj=file, mode='wb') as archive:
+            archive.writelines(lines)
+        file.flush()
+        os.fsync(file.fileno())
+    return pending
+
+
+def archive_activities(expired: QuerySet, directory: Path, batch_size: int = 100, stats: dict = None) -> None:
+    """
+    Move the expired activities to monthly archives in 'directory' (activities-2026-01.jsonl.gz,
+    gzipped JSON lines, one member per batch) and delete them, with the payload blobs no other
+    activity uses. Only one batch of activities and their compressed payloads is in memory at a time.
+    Every batch is on disk before it is deleted from the database, so the command can be
+    stopped at any point and run again. If 'stats' is given, 'activities', 'blobs' and 'bytes'
+    (written to the archives) are added to it.
+    """
+    if stats is not None:
+        stats.setdefault('activities', 0)
+        stats.setdefault('blobs', 0)
+        stats.setdefault('bytes', 0)
+    directory.mkdir(parents=True, exist_ok=True)
+    recover_archives(directory)
+
+    last = 0
+    while True:
+        batch = list(expired.filter(pk__gt=last).select_related('user').order_by('pk')[:batch_size])
+        if not batch:
+            break
+        last = batch[-1].pk
+        digests = {activity.input_blob_id for activity in batch} | {activity.output_blob_id for activity in batch}
+        digests.discard(None)
+        payloads = dict(PayloadBlob.objects.filter(pk__in=digests).values_list('digest', 'data'))
+
+        months = {}
+        for activity in batch:
+            months.setdefault(archive_month(activity), []).append(activity)
+        pendings = []
+        for month, activities in months.items():
+            lines = [archive_line(activity, payloads) for activity in activities]
+            pendings.append(append_batch(archive_path(directory, month), lines, [activity.pk for activity in activities]))
+            if stats is not None:
+                stats['bytes'] += sum(len(line) for line in lines)
+        del payloads
+
+        with transaction.atomic():
+            Activity.objects.filter(pk__in=[activity.pk for activity in batch]).delete()
+            in_use = Activity.objects.filter(Q(input_blob__in=digests) | Q(output_blob__in=digests))
+            in_use = set(in_use.values_list('input_blob', flat=True)) | set(in_use.values_list('output_blob', flat=True))
+            blobs, _ = PayloadBlob.objects.filter(pk__in=digests - in_use).delete()
+        for pending in pendings:
+            pending.unlink()
+        if stats is not None:
+            stats['activities'] += len(batch)
+            stats['blobs'] += blobs
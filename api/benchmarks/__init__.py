@@ -0,0 +1,18 @@
+"""
+Benchmarks, run with: ./manage.py benchmark <name>
+
+Each module in this package offers add_arguments(parser) and run(write, **options),
+where 'write' prints a line of output.
+The benchmarks replace the LLM and other remote services with local stand-ins,
+so they can run without an API key or network access.
+"""
+
+BENCHMARKS = {
+    'activity-logging': 'api.benchmarks.activity_logging',
+    'chunk-packing': 'api.benchmarks.chunk_packing',
+    'csv-chunking': 'api.benchmarks.csv_chunking',
+    'database-locks': 'api.benchmarks.database_locks',
+    'drop-classify-concurrency': 'api.benchmarks.drop_classify_concurrency',
+    'sparql-client': 'api.benchmarks.sparql_client',
+    'xml-chunking': 'api.benchmarks.xml_chunking',
+}
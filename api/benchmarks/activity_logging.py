@@ -0,0 +1,127 @@
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections
+
+from api.activity_log import ActivitySink
+from api.benchmarks.chunk_packing import sample_manuscripts
+from api.budgets import tokens_used_today
+from api.models import Activity
+
+
+def add_arguments(parser):
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 8, 16],
+                        help="Numbers of worker processes to try, as gunicorn workers")
+    parser.add_argument('--requests', type=int, default=100, help="Requests per worker")
+    parser.add_argument('--think', type=float, default=0.05,
+                        help="Mean seconds a request spends on other work between two database writes")
+    parser.add_argument('--payload-kb', type=int, default=50, help="Size of the input and of the output JSON")
+    parser.add_argument('--budget-check', action='store_true',
+                        help="Also sum the user's tokens of today before every request, as within_token_budget does")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def sample_payload(size, seed):
+    """
+    (input, output) of a drop-classify request, each about 'size' bytes as JSON.
+    """
+    manuscripts = []
+    for manuscript in sample_manuscripts(10**6, seed):
+        manuscripts.append(manuscript)
+        if len(json.dumps(manuscripts)) >= size:
+            break
+    input = {'data': "\n".join(",".join(manuscript.values()) for manuscript in manuscripts)}
+    return input, {'structured_data': manuscripts}
+
+
+def serve(mode, user_id, requests, think, payload, budget_check, seed, barrier, results):
+    """
+    One worker process: 'requests' requests, each logging its activity, either with
+    Activity.objects.create ('sync') or through an ActivitySink ('write-behind'),
+    after checking the token budget if 'budget_check'.
+    Puts (seconds per request, failed requests, seconds to write the rest of the queue, batches) on 'results'.
+    """
+    rng = random.Random(seed)
+    input, output = payload
+    sink = ActivitySink(batch_size=settings.ACTIVITY_BATCH_SIZE)
+    latencies, errors = [], 0
+    barrier.wait()
+    for _ in range(requests):
+        time.sleep(rng.uniform(0, 2 * think))
+        start = time.perf_counter()
+        try:
+            if budget_check:
+                tokens_used_today(user_id)
+            fields = dict(user_id=user_id, endpoint='drop_classify', input=input, output=output, prompt_tokens=1000)
+            if mode == 'sync':
+                Activity.objects.create(**fields)
+            else:
+                sink.add(Activity(**fields))
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    sink.flush()
+    results.put((latencies, errors, time.perf_counter() - start, sink.batches))
+    connections.close_all()
+
+
+def run_workers(mode, workers, user_id, requests, think, payload, budget_check, seed):
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    # The processes inherit the settings, not the connection
+    connections.close_all()
+    processes = [
+        context.Process(target=serve, args=(mode, user_id, requests, think, payload, budget_check, seed + i, barrier, results))
+        for i in range(workers)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return outcomes, time.perf_counter() - start
+
+
+def run(write, workers, requests, think, payload_kb, budget_check, seed, **options):
+    payload = sample_payload(payload_kb * 1024, seed)
+    with tempfile.TemporaryDirectory() as directory:
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user_id = User.objects.create(username='benchmark').pk
+            write(
+                f"{requests} requests per worker, {payload_kb} KB input and output JSON, "
+                f"{think * 1000:g}ms of other work between requests on average, {connection.vendor} database; "
+                f"latency of {'the budget check and ' if budget_check else ''}the activity log per request"
+            )
+            for count in workers:
+                for mode in ['sync', 'write-behind']:
+                    outcomes, elapsed = run_workers(mode, count, user_id, requests, think, payload, budget_check, seed)
+                    latencies = sorted(seconds for outcome in outcomes for seconds in outcome[0])
+                    errors = sum(outcome[1] for outcome in outcomes)
+                    drain = max(outcome[2] for outcome in outcomes)
+                    batches = sum(outcome[3] for outcome in outcomes)
+                    written = Activity.objects.count()
+                    Activity.objects.all().delete()
+
+                    def percentile(p):
+                        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+                    write(
+                        f"  {count:>2} workers {mode:<12} p50 {percentile(0.50):7.1f}ms  p99 {percentile(0.99):7.1f}ms  "
+                        f"max {latencies[-1] * 1000:7.1f}ms  failed {errors:>4}  written {written:>5} "
+                        f"in {elapsed:5.1f}s" + (f" ({batches} batches, queue written {drain:.2f}s after "
+                                                 f"the last request)" if mode == 'write-behind' else "")
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,103 @@
+import csv
+import io
+import json
+import random
+import xml.etree.ElementTree as ET
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from api.paths import drop_classify as drop_classify_module
+from api.paths.drop_classify import chunk_file_by_type, chunk_token_budget, count_tokens, get_encoding, model
+
+
+def add_arguments(parser):
+    parser.add_argument('--manuscripts', type=int, default=500, help="Number of manuscripts in every sample corpus")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+SUPPORTS = ["pergamena", "parchment", "carta", "papier", "membr."]
+SCRIPTS = ["littera textualis", "humanistica", "cursiva", "bastarda", "mercantesca"]
+AUTHORS = ["Petrarca", "Dante Alighieri", "Boccaccio", "Augustinus", "Cicero", "Seneca"]
+WORKS = ["Canzoniere", "Commedia", "Decameron", "De civitate Dei", "De officiis", "Epistulae morales"]
+
+
+def sample_manuscripts(count, seed):
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            "shelfmark": f"MS {rng.choice(['Lat.', 'Ital.', 'Add.'])} {1000 + i}",
+            "date": f"{rng.choice(['XIV', 'XV', 'XIII'])} sec.",
+            "support": rng.choice(SUPPORTS),
+            "dimensions": f"{rng.randint(180, 400)} x {rng.randint(120, 300)} mm",
+            "folia": f"II + {rng.randint(20, 300)} + I",
+            "script": rng.choice(SCRIPTS),
+            "author": rng.choice(AUTHORS),
+            "work": rng.choice(WORKS),
+            "notes": " ".join(rng.choice(["Iniziali", "rubricate", "in rosso", "e blu,", "legatura",
+                                          "moderna", "in pelle;", "note marginali", "di mano coeva."])
+                              for _ in range(rng.randint(5, 40))),
+        }
+
+
+def sample_corpora(count, seed):
+    manuscripts = list(sample_manuscripts(count, seed))
+
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=list(manuscripts[0]), lineterminator="\n")
+    writer.writeheader()
+    writer.writerows({key: value.replace(",", ";") for key, value in ms.items()} for ms in manuscripts)
+    yield "csv", out.getvalue()
+
+    yield "json", json.dumps(manuscripts, ensure_ascii=False, indent=2)
+
+    root = ET.Element("catalogue")
+    for ms in manuscripts:
+        element = ET.SubElement(root, "manuscript")
+        for key, value in ms.items():
+            ET.SubElement(element, key).text = value
+    yield "xml", ET.tostring(root, encoding="unicode")
+
+    yield "txt", "\n\n".join(
+        f"{ms['shelfmark']}. {ms['author']}, {ms['work']}. Sec. {ms['date']}; {ms['support']}; "
+        f"{ms['dimensions']}; ff. {ms['folia']}; {ms['script']}. {ms['notes']}"
+        for ms in manuscripts
+    )
+
+
+def fixed_size_chunks(content, extension):
+    """
+    The chunking used before packing: 50 CSV rows, one JSON array item or
+    XML element, or 2000 characters of text per chunk.
+    """
+    if extension == "csv":
+        lines = content.strip().split("\n")
+        return [lines[0] + "\n" + "\n".join(lines[i:i + 50]) for i in range(1, len(lines), 50)]
+    if extension == "json":
+        return [json.dumps([item], ensure_ascii=False) for item in json.loads(content)]
+    if extension == "xml":
+        return [ET.tostring(child, encoding="unicode") for child in ET.fromstring(content)]
+    splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200, separators=["\n\n", "\n", ".", " "])
+    return splitter.split_text(content)
+
+
+def run(write, manuscripts, seed, **options):
+    prompt_tokens = count_tokens(drop_classify_module.structurer_agent.system_message, model)
+    budget = chunk_token_budget()
+    counter = "tiktoken" if get_encoding(model) is not None else "characters / 4 (tiktoken encoding unavailable)"
+    write(f"{manuscripts} manuscripts per corpus, chunk budget {budget} tokens, "
+          f"Structurer prompt {prompt_tokens} tokens, tokens counted with {counter}")
+
+    for extension, content in sample_corpora(manuscripts, seed):
+        before = fixed_size_chunks(content, extension)
+        after = chunk_file_by_type(content, extension)
+
+        def tokens_sent(chunks):
+            # Every call repeats the system prompt
+            return sum(count_tokens(chunk, model) for chunk in chunks) + len(chunks) * prompt_tokens
+
+        saved = 1 - len(after) / len(before)
+        write(
+            f"  {extension:<4} LLM calls {len(before):>5} -> {len(after):>4} ({saved:.0%} fewer)  "
+            f"input tokens {tokens_sent(before):>8} -> {tokens_sent(after):>8}  "
+            f"largest chunk {max(count_tokens(chunk, model) for chunk in after)} tokens"
+        )
@@ -0,0 +1,88 @@
+import csv
+import io
+import os
+import random
+import tempfile
+import time
+
+from api.benchmarks.chunk_packing import sample_manuscripts
+from api.paths.drop_classify import chunk_token_budget, iter_file_chunks, iter_packed_units
+
+
+def add_arguments(parser):
+    parser.add_argument('--rows', type=int, default=100_000, help="Number of records in the CSV file")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+INCIPITS = [
+    'Nel mezzo del cammin di nostra vita\nmi ritrovai per una selva oscura',
+    'Voi ch\'ascoltate in rime sparse il suono\ndi quei sospiri ond\'io nudriva \'l core',
+    'In principio erat verbum, et verbum erat apud Deum',
+    'Incipit liber "de civitate Dei", prologus',
+    'Quod in omnibus',
+]
+
+
+def write_catalogue(file, rows, seed):
+    """
+    A CSV catalogue in which the incipits hold commas, quotes and line breaks.
+    """
+    rng = random.Random(seed)
+    manuscripts = sample_manuscripts(rows, seed)
+    first = next(manuscripts)
+    writer = csv.DictWriter(file, fieldnames=[*first, "incipit"], lineterminator="\r\n")
+    writer.writeheader()
+    for manuscript in [first, *manuscripts]:
+        writer.writerow({**manuscript, "incipit": rng.choice(INCIPITS)})
+
+
+def line_split_chunks(content, token_budget):
+    """
+    The CSV chunking used before: split the text at every newline, then join the fields with commas.
+    """
+    lines = content.strip().split("\n")
+    reader = csv.reader(lines)
+    header = next(reader)
+    rows = (",".join(row) for row in reader)
+    return list(iter_packed_units(rows, token_budget, head=",".join(header) + "\n"))
+
+
+def records_intact(chunks, records):
+    """
+    Number of the original records that come back unchanged when the chunks are parsed as CSV.
+    """
+    parsed = []
+    for chunk in chunks:
+        parsed.extend(list(csv.reader(io.StringIO(chunk, newline="")))[1:])
+    return sum(1 for a, b in zip(parsed, records) if a == b), len(parsed)
+
+
+def run(write, rows, seed, **options):
+    budget = chunk_token_budget()
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8", newline="", delete=False) as file:
+        write_catalogue(file, rows, seed)
+    try:
+        size = os.path.getsize(file.name) / 2**20
+        with open(file.name, encoding="utf-8", newline="") as f:
+            records = list(csv.reader(f))[1:]
+        write(f"CSV file with {rows} records ({size:.1f} MB) with multi-line quoted incipits, chunk budget {budget} tokens")
+
+        def read_and_split():
+            with open(file.name, encoding="utf-8") as f:
+                return line_split_chunks(f.read(), budget)
+
+        def streamed():
+            with open(file.name, "rb") as f:
+                return list(iter_file_chunks(f, "csv", budget))
+
+        for label, function in [("line split", read_and_split), ("streamed", streamed)]:
+            start = time.perf_counter()
+            chunks = function()
+            seconds = time.perf_counter() - start
+            intact, parsed = records_intact(chunks, records)
+            write(
+                f"  {label:<10} chunks {len(chunks):>5}  {seconds:6.2f}s  {rows / seconds:>8.0f} records/s  "
+                f"{size / seconds:5.1f} MB/s  records parsed back {parsed:>6}, intact {intact:>6} ({intact / rows:.1%})"
+            )
+    finally:
+        os.remove(file.name)
@@ -0,0 +1,133 @@
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import OperationalError, close_old_connections, connection, connections
+
+from api.benchmarks.activity_logging import sample_payload
+from api.budgets import tokens_used_today
+from api.models import Activity
+from manuscriptai_ru_backend_v2.database import sqlite_settings
+
+
+OPERATIONS = ['session', 'budget', 'activity']
+
+
+def add_arguments(parser):
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 8, 16],
+                        help="Numbers of worker processes to try, as gunicorn workers")
+    parser.add_argument('--requests', type=int, default=50, help="Requests per worker")
+    parser.add_argument('--think', type=float, default=0.02,
+                        help="Mean seconds a request spends on other work")
+    parser.add_argument('--payload-kb', type=int, default=50, help="Size of the input and of the output JSON")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def configurations(directory):
+    """
+    Name => (database settings to try, CONN_MAX_AGE): SQLite as it was set up before, and as it is now.
+    """
+    return {
+        'before': ({'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory, 'before.sqlite3')}, 0),
+        'after': (sqlite_settings(os.path.join(directory, 'after.sqlite3'), busy_timeout=20), 600),
+    }
+
+
+def serve(user_id, requests, think, payload, seed, barrier, results):
+    """
+    One worker process handling 'requests' requests as the views do: save the session,
+    check the token budget and store the activity, then let go of the connection
+    as Django does at the end of a request. Puts the seconds per operation,
+    with None for one that failed on a lock, on 'results'.
+    """
+    rng = random.Random(seed)
+    input, output = payload
+    session = SessionStore()
+    session['user'] = user_id
+    session.create()
+    close_old_connections()
+    seconds = {operation: [] for operation in OPERATIONS}
+
+    def timed(operation, function):
+        start = time.perf_counter()
+        try:
+            function()
+        except OperationalError:
+            seconds[operation].append(None)
+        else:
+            seconds[operation].append(time.perf_counter() - start)
+
+    def save_session():
+        session['requests'] = session.get('requests', 0) + 1
+        session.save()
+
+    barrier.wait()
+    for _ in range(requests):
+        time.sleep(rng.uniform(0, 2 * think))
+        timed('session', save_session)
+        timed('budget', lambda: tokens_used_today(user_id))
+        timed('activity', lambda: Activity.objects.create(user_id=user_id, endpoint='drop_classify', input=input,
+                                                          output=output, prompt_tokens=1000))
+        close_old_connections()
+    results.put(seconds)
+    connections.close_all()
+
+
+def run_workers(workers, user_id, requests, think, payload, seed):
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    connections.close_all()
+    processes = [
+        context.Process(target=serve, args=(user_id, requests, think, payload, seed + i, barrier, results))
+        for i in range(workers)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return outcomes, time.perf_counter() - start
+
+
+def run(write, workers, requests, think, payload_kb, seed, **options):
+    payload = sample_payload(payload_kb * 1024, seed)
+    settings_dict = connection.settings_dict
+    original = {key: settings_dict.get(key) for key in ['NAME', 'OPTIONS', 'CONN_MAX_AGE']}
+    write(
+        f"{requests} requests per worker, each saving its session, checking the token budget and storing "
+        f"an activity with {payload_kb} KB input and output JSON, {think * 1000:g}ms of other work on average; "
+        f"seconds per operation, mostly waiting for locks, and the operations failing with 'database is locked'"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            for count in workers:
+                for label, (database, conn_max_age) in configurations(directory).items():
+                    settings_dict['OPTIONS'] = database.get('OPTIONS', {})
+                    settings_dict['CONN_MAX_AGE'] = conn_max_age
+                    settings_dict['TEST'] = {**settings_dict.get('TEST', {}), 'NAME': database['NAME']}
+                    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+                    try:
+                        user_id = User.objects.create(username='benchmark').pk
+                        outcomes, elapsed = run_workers(count, user_id, requests, think, payload, seed)
+                    finally:
+                        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+                    line = f"  {count:>2} workers {label:<6}"
+                    total = 0.0
+                    for operation in OPERATIONS:
+                        timings = [seconds for outcome in outcomes for seconds in outcome[operation]]
+                        succeeded = sorted(seconds for seconds in timings if seconds is not None)
+                        total += sum(succeeded)
+                        p99 = succeeded[min(len(succeeded) - 1, int(0.99 * len(succeeded)))] if succeeded else 0.0
+                        line += (f"  {operation} p99 {p99 * 1000:7.1f}ms, "
+                                 f"locked {len(timings) - len(succeeded):>3}")
+                    write(f"{line}  in database {total / (count * requests) * 1000:6.1f}ms per request, "
+                          f"total {elapsed:5.1f}s")
+        finally:
+            settings_dict.update(original)
@@ -0,0 +1,57 @@
+import json
+import time
+from unittest import mock
+
+from api.paths import drop_classify as drop_classify_module
+
+
+def add_arguments(parser):
+    parser.add_argument('--chunks', type=int, default=64, help="Number of chunks in the generated CSV")
+    parser.add_argument('--latency', type=float, default=0.2, help="Seconds the stub LLM takes per reply")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16], help="Concurrency levels to compare")
+
+
+def make_stub_llm(latency):
+    """
+    Stand-in for structure_chunk_cached(): waits 'latency' seconds, like an LLM round trip,
+    and returns one manuscript per CSV row, with the ID only on the first row so the
+    merge has to attach the other rows to the right manuscript.
+    It never answers from the cache, so every concurrency level does the same work.
+    """
+    def stub(chunk_text):
+        time.sleep(latency)
+        rows = [row.split(",") for row in chunk_text.splitlines()[1:]]
+        replies = [{"manuscript_ID": rows[0][0], "support_type": rows[0][1]}]
+        replies += [{"manuscript_ID": None, "additional_notes": row[2]} for row in rows[1:]]
+        return json.dumps(replies), False
+    return stub
+
+
+def run(write, chunks, latency, workers, **options):
+    # Fixed chunks of 50 rows, whatever the token budget
+    rows_per_chunk = 50
+    header = "shelfmark,support,notes"
+    csv_chunks = [
+        header + "\n" + "\n".join(f"ms{i},parchment,row {i}" for i in range(start, start + rows_per_chunk))
+        for start in range(0, chunks * rows_per_chunk, rows_per_chunk)
+    ]
+    data = {"content": "", "extension": "csv"}
+
+    write(f"{chunks} chunks, stub LLM latency {latency}s")
+    baseline = None
+    baseline_time = None
+    with mock.patch.object(drop_classify_module, 'structure_chunk_cached', make_stub_llm(latency)), \
+            mock.patch.object(drop_classify_module, 'chunk_file_by_type', lambda content, extension, stats=None: csv_chunks):
+        for max_workers in workers:
+            start = time.perf_counter()
+            output = drop_classify_module.drop_classify(data, max_workers=max_workers)
+            elapsed = time.perf_counter() - start
+
+            if baseline is None:
+                baseline, baseline_time = output, elapsed
+            identical = "yes" if output == baseline else "NO"
+            write(
+                f"  concurrency {max_workers:>3}: {elapsed:7.2f}s  "
+                f"speedup {baseline_time / elapsed:5.1f}x  "
+                f"manuscripts {len(output['structured_data'])}  same output: {identical}"
+            )
@@ -0,0 +1,89 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeSparqlServer:
+    """
+    Local stand-in for a SPARQL endpoint that answers every query with an empty result,
+    or with the bindings answer(query) returns, after 'delay' seconds. The first 'fail_first'
+    requests and a fraction 'error_rate' of the others fail with 'error_status',
+    with a Retry-After header when 'retry_after' is set. The queries received are in 'queries'.
+
+        with FakeSparqlServer(delay=0.05, error_rate=0.2) as server:
+            SparqlClient(server.endpoint).query("SELECT ...")
+    """
+
+    def __init__(self, delay: float = 0.0, error_rate: float = 0.0, error_status: int = 503,
+                 retry_after: float | None = None, seed: int = 0, fail_first: int = 0, answer=None):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.fail_first = fail_first
+        self.answer = answer
+        self.queries = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/sparql"
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 keeps the connection open, so pooled clients can reuse it
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with fake.lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query).get('query', [''])[0]
+                with fake.lock:
+                    fake.requests += 1
+                    fake.queries.append(query)
+                    failing = fake.requests <= fake.fail_first or fake.random.random() < fake.error_rate
+                time.sleep(fake.delay)
+
+                if failing:
+                    body = b'Service Unavailable'
+                    self.send_response(fake.error_status)
+                    if fake.retry_after is not None:
+                        self.send_header('Retry-After', str(fake.retry_after))
+                else:
+                    bindings = fake.answer(query) if fake.answer else []
+                    body = json.dumps({"head": {"vars": []}, "results": {"bindings": bindings}}).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/sparql-results+json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
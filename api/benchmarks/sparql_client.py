@@ -0,0 +1,74 @@
+import time
+
+import requests
+
+from api.benchmarks.fake_sparql import FakeSparqlServer
+from api.paths.concurrency import bounded_map
+from api.paths.sparql_client import LatencyStats, SparqlClient
+
+
+QUERY = "SELECT ?item WHERE { ?item ?p ?o } LIMIT 1"
+
+
+def add_arguments(parser):
+    parser.add_argument('--queries', type=int, default=200, help="Number of queries per run")
+    parser.add_argument('--workers', type=int, default=8, help="Queries running at once")
+    parser.add_argument('--delay', type=float, default=0.02, help="Seconds the fake endpoint takes per reply")
+    parser.add_argument('--error-rate', type=float, default=0.1, help="Fraction of replies that fail")
+    parser.add_argument('--error-status', type=int, default=503, help="HTTP status of the failing replies")
+    parser.add_argument('--rate', type=float, default=20.0, help="Requests per second allowed by the pooled client")
+
+
+def plain_query(endpoint, stats):
+    """
+    How the lookups used to query: a new connection per request and no retries.
+    """
+    start = time.perf_counter()
+    try:
+        response = requests.get(endpoint, params={"query": QUERY, "format": "json"}, timeout=10)
+        response.raise_for_status()
+        response.json()
+        ok = True
+    except requests.RequestException:
+        ok = False
+    stats.record(time.perf_counter() - start, ok=ok)
+    return ok
+
+
+def pooled_query(client):
+    try:
+        client.query(QUERY)
+        return True
+    except requests.RequestException:
+        return False
+
+
+def report(write, label, server, outcomes, elapsed, stats):
+    summary = stats.summary()
+    write(
+        f"  {label:<7} success {sum(outcomes) / len(outcomes):6.1%}  total {elapsed:6.2f}s  "
+        f"p50 {summary['p50_seconds'] * 1000:6.1f}ms  p95 {summary['p95_seconds'] * 1000:6.1f}ms  "
+        f"requests {server.requests:>4}  retries {summary['retries']:>3}  connections {server.connections:>4}  "
+        f"({server.requests / elapsed:.1f} requests/s)"
+    )
+
+
+def run(write, queries, workers, delay, error_rate, error_status, rate, **options):
+    write(
+        f"{queries} queries, {workers} at once, fake endpoint delay {delay}s, "
+        f"{error_rate:.0%} of the replies fail with {error_status}"
+    )
+
+    with FakeSparqlServer(delay=delay, error_rate=error_rate, error_status=error_status, retry_after=0.05) as server:
+        stats = LatencyStats()
+        start = time.perf_counter()
+        outcomes = list(bounded_map(lambda _: plain_query(server.endpoint, stats), range(queries), workers))
+        report(write, "plain", server, outcomes, time.perf_counter() - start, stats)
+
+    with FakeSparqlServer(delay=delay, error_rate=error_rate, error_status=error_status, retry_after=0.05) as server:
+        # Burst of one, so the rate limit holds from the first request on
+        client = SparqlClient(server.endpoint, rate=rate, burst=1, max_retries=3, pool_size=workers)
+        start = time.perf_counter()
+        outcomes = list(bounded_map(lambda _: pooled_query(client), range(queries), workers))
+        report(write, "pooled", server, outcomes, time.perf_counter() - start, client.stats)
+        write(f"  the pooled client was limited to {rate:g} requests/s")
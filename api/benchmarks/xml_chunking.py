@@ -0,0 +1,100 @@
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from xml.sax.saxutils import escape
+
+from api.benchmarks.chunk_packing import AUTHORS, SCRIPTS, SUPPORTS, WORKS
+from api.paths.drop_classify import chunk_token_budget, count_tokens, iter_xml_chunks, iter_xml_units, model
+
+
+def add_arguments(parser):
+    parser.add_argument('--manuscripts', type=int, default=5000, help="Number of <msDesc> elements in the TEI file")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def write_tei_catalogue(file, count, seed):
+    """
+    A TEI catalogue with 'count' manuscript descriptions in its body, in the TEI default namespace.
+    """
+    rng = random.Random(seed)
+    file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<TEI xmlns="http://www.tei-c.org/ns/1.0" xmlns:xi="http://www.w3.org/2001/XInclude">\n'
+               '<teiHeader><fileDesc><titleStmt><title>Catalogue</title></titleStmt>'
+               '<sourceDesc><p>Generated</p></sourceDesc></fileDesc></teiHeader>\n<text><body><div>\n')
+    for i in range(count):
+        notes = " ".join(rng.choice(["Iniziali", "rubricate", "in rosso", "e blu,", "legatura", "moderna",
+                                     "in pelle;", "note marginali", "di mano coeva."]) for _ in range(rng.randint(5, 40)))
+        file.write(
+            f'<msDesc xml:id="ms{i}" xml:lang="it">'
+            f'<msIdentifier><settlement>Firenze</settlement><idno>MS Lat. {1000 + i}</idno></msIdentifier>'
+            f'<msContents><msItem n="1"><author>{rng.choice(AUTHORS)}</author><title>{rng.choice(WORKS)}</title></msItem></msContents>'
+            f'<physDesc><objectDesc form="codex"><supportDesc material="{rng.choice(SUPPORTS)}">'
+            f'<extent>ff. {rng.randint(20, 300)}<dimensions unit="mm"><height>{rng.randint(180, 400)}</height>'
+            f'<width>{rng.randint(120, 300)}</width></dimensions></extent></supportDesc></objectDesc>'
+            f'<handDesc><handNote script="{rng.choice(SCRIPTS)}"/></handDesc></physDesc>'
+            f'<history><origin><origDate>{rng.choice(["XIV", "XV", "XIII"])} sec.</origDate></origin></history>'
+            f'<additional><adminInfo><note>{escape(notes)}</note></adminInfo></additional>'
+            f'<xi:include href="images/ms{i}.xml"/>'
+            f'</msDesc>\n'
+        )
+    file.write('</div></body></text>\n</TEI>\n')
+
+
+def measure(function):
+    """
+    Runs function() and goes through the chunks it returns, as the Structurer would:
+    (number of chunks, largest chunk, whether all chunks keep the TEI
+    default namespace, seconds), and the peak memory in MB of a second run
+    traced with tracemalloc. Streamed chunks are let go as soon as they have been counted.
+    """
+    def consume():
+        count, largest, namespaced = 0, "", True
+        for chunk in function():
+            count += 1
+            if len(chunk) > len(largest):
+                largest = chunk
+            if "ns0:" in chunk or 'xmlns="http://www.tei-c.org/ns/1.0"' not in chunk:
+                namespaced = False
+        return count, largest, namespaced
+
+    start = time.perf_counter()
+    count, largest, namespaced = consume()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        consume()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return count, largest, namespaced, seconds, peak / 2**20
+
+
+def run(write, manuscripts, seed, **options):
+    budget = chunk_token_budget()
+    with tempfile.NamedTemporaryFile("w", suffix=".xml", encoding="utf-8", delete=False) as file:
+        write_tei_catalogue(file, manuscripts, seed)
+    try:
+        size = os.path.getsize(file.name) / 2**20
+        write(f"TEI file with {manuscripts} <msDesc> elements, {size:.1f} MB, chunk budget {budget} tokens")
+
+        def streamed(chunker, *args):
+            def function():
+                with open(file.name, "rb") as f:
+                    yield from chunker(f, *args)
+            return function
+
+        runs = [
+            ("iter_xml_units", streamed(iter_xml_units)),
+            ("iter_xml_chunks", streamed(iter_xml_chunks, budget)),
+        ]
+        for label, function in runs:
+            count, largest, namespaced, seconds, peak = measure(function)
+            write(
+                f"  {label:<20} chunks {count:>5}  largest {count_tokens(largest, model):>8} tokens  "
+                f"{seconds:6.2f}s ({size / seconds:5.1f} MB/s)  peak memory {peak:6.1f} MB  "
+                f"TEI namespace prefixes kept: {'yes' if namespaced else 'no'}"
+            )
+    finally:
+        os.remove(file.name)
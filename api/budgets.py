@@ -0,0 +1,46 @@
+from functools import wraps
+
+from django.db.models import F, Sum
+from django.http.response import JsonResponse
+from django.utils import timezone
+
+from api.activity_log import unwritten_tokens
+from api.models import Activity, JobChunk, UserTokenBudget
+
+
+def tokens_used_today(user) -> int:
+    """
+    Prompt and completion tokens of the user's requests today,
+    including the chunks of jobs that haven't finished yet and the activities still queued to be written.
+    """
+    today = timezone.localdate()
+    tokens = F('prompt_tokens') + F('completion_tokens')
+    activities = Activity.objects.filter(user=user, created__date=today).aggregate(total=Sum(tokens))['total']
+    running_jobs = JobChunk.objects.filter(
+        job__user=user, job__finished__isnull=True, job__created__date=today
+    ).aggregate(total=Sum(tokens))['total']
+    return (activities or 0) + (running_jobs or 0) + unwritten_tokens(user)
+
+
+def token_budget_status(user) -> dict | None:
+    """
+    {'daily_tokens': ..., 'used_today': ...} for a user with a token budget, else None.
+    """
+    budget = UserTokenBudget.objects.filter(user=user).first()
+    if budget is None:
+        return None
+    return {'daily_tokens': budget.daily_tokens, 'used_today': tokens_used_today(user)}
+
+
+def within_token_budget(view):
+    """
+    Reject a request with 429 before any LLM call when the user has used up their daily token budget.
+    Put it below @login_required.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        status = token_budget_status(request.user)
+        if status is not None and status['used_today'] >= status['daily_tokens']:
+            return JsonResponse({'error': 'Daily token budget used up, try again tomorrow', **status}, status=429)
+        return view(request, *args, **kwargs)
+    return wrapper
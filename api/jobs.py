@@ -0,0 +1,253 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from api.activity_log import log_activity
+from api.models import Job, JobChunk
+from api.paths.dedup import iter_unique_chunks
+from api.paths.drop_classify import chunk_file_by_type, merge_structured_results, structure_chunk_cached
+from api.paths.metering import metering
+
+
+# One worker pool per process, created on first use
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix="job-worker")
+    return _executor
+
+
+def submit_drop_classify_job(user, data) -> Job:
+    """
+    Split the uploaded file into chunks, store them, less the duplicates, as a job in the database
+    and hand the chunks to the worker pool. Returns without waiting for the LLM.
+    """
+    raw_text = data.get("content", "")
+    extension = data.get("extension", "txt").lower().strip()
+    chunks = list(iter_unique_chunks(chunk_file_by_type(raw_text, extension)))
+
+    with transaction.atomic():
+        job = Job.objects.create(user=user, endpoint='drop_classify', input=data)
+        JobChunk.objects.bulk_create(
+            [JobChunk(job=job, index=index, text=chunk_text) for index, chunk_text in enumerate(chunks)]
+        )
+        transaction.on_commit(lambda: schedule_job(job.pk))
+    return job
+
+
+def schedule_job(job_id: int) -> list:
+    """
+    Queue every pending chunk of a job on the worker pool.
+    Returns the futures, so callers may wait for them.
+    """
+    chunk_ids = list(
+        JobChunk.objects.filter(job_id=job_id, status=Job.PENDING).values_list('pk', flat=True)
+    )
+    if not chunk_ids:
+        finish_job_if_complete(job_id)
+        return []
+
+    executor = get_executor()
+    return [executor.submit(process_chunk, chunk_id) for chunk_id in chunk_ids]
+
+
+def requeue_stale_chunks(stale_seconds: float) -> int:
+    """
+    Put the chunks that have been running for more than 'stale_seconds', and were most likely
+    left behind by a worker that died, back in the queue; those that have used up their
+    JOB_CHUNK_MAX_ATTEMPTS are marked as failed instead. Returns the number of chunks queued again.
+    """
+    stale = JobChunk.objects.filter(status=Job.RUNNING, job__finished__isnull=True)
+    if stale_seconds > 0:
+        # Chunks from before 'claimed' was recorded have none
+        stale = stale.exclude(claimed__gte=timezone.now() - timedelta(seconds=stale_seconds))
+    stale.filter(attempts__gte=settings.JOB_CHUNK_MAX_ATTEMPTS).update(
+        status=Job.FAILED, error=f"Abandoned by its worker {settings.JOB_CHUNK_MAX_ATTEMPTS} times"
+    )
+    return stale.filter(status=Job.RUNNING).update(status=Job.PENDING)
+
+
+def resume_pending_jobs(requeue_running: bool = False) -> list:
+    """
+    Queue the chunks of all unfinished jobs, e.g. after a restart, with the chunks that have been
+    running for longer than JOB_CHUNK_STALE_SECONDS. With 'requeue_running', all running chunks
+    are retried, as when no other process is working on the queue.
+    """
+    requeued = requeue_stale_chunks(0 if requeue_running else settings.JOB_CHUNK_STALE_SECONDS)
+    if requeued:
+        print(f"[job worker] Queued {requeued} chunks again that were left running")
+
+    futures = []
+    for job_id in Job.objects.filter(finished__isnull=True).values_list('pk', flat=True):
+        futures.extend(schedule_job(job_id))
+    return futures
+
+
+_resumed = False
+
+
+def resume_pending_jobs_once(**kwargs) -> None:
+    """
+    request_started receiver: resume the unfinished jobs when a server process handles its
+    first request, in the background, so that request doesn't wait. Several processes may do
+    this at once; a chunk is only ever claimed by one of them.
+    """
+    global _resumed
+    with _executor_lock:
+        if _resumed:
+            return
+        _resumed = True
+
+    def resume():
+        close_old_connections()
+        try:
+            resume_pending_jobs()
+        except Exception as e:
+            print(f"[job worker] Error resuming the unfinished jobs: {e}")
+        finally:
+            close_old_connections()
+
+    threading.Thread(target=resume, name="job-resume", daemon=True).start()
+
+
+def process_chunk(chunk_id: int) -> None:
+    """
+    Worker task: claim one chunk, send it to the Structurer and store the reply.
+    The claim is a conditional UPDATE, so a chunk is never processed twice,
+    even when several processes work on the same queue. A chunk that fails is put back
+    and claimed again after JOB_CHUNK_RETRY_SECONDS, doubled after every attempt,
+    until it has been tried JOB_CHUNK_MAX_ATTEMPTS times.
+    """
+    close_old_connections()
+    try:
+        while True:
+            claimed = JobChunk.objects.filter(pk=chunk_id, status=Job.PENDING).update(
+                status=Job.RUNNING, claimed=timezone.now(), attempts=F('attempts') + 1
+            )
+            if not claimed:
+                return
+            chunk = JobChunk.objects.get(pk=chunk_id)
+            Job.objects.filter(pk=chunk.job_id, status=Job.PENDING).update(status=Job.RUNNING)
+
+            with metering() as meter:
+                try:
+                    reply, _ = structure_chunk_cached(chunk.text)
+                except Exception as e:
+                    retry = chunk.attempts < settings.JOB_CHUNK_MAX_ATTEMPTS
+                    print(f"[job {chunk.job_id}] Chunk {chunk.index} failed (attempt {chunk.attempts} of "
+                          f"{settings.JOB_CHUNK_MAX_ATTEMPTS}): {e}")
+                    status, reply, error = Job.PENDING if retry else Job.FAILED, '', str(e)
+                else:
+                    status, error = Job.DONE, ''
+
+            # The usage of all attempts adds up
+            JobChunk.objects.filter(pk=chunk_id).update(
+                status=status, reply=reply, error=error,
+                **{field: F(field) + value for field, value in meter.as_fields().items()}
+            )
+            if status != Job.PENDING:
+                break
+            # Exponential backoff with jitter, so the workers that failed together don't retry together
+            time.sleep(settings.JOB_CHUNK_RETRY_SECONDS * 2 ** (chunk.attempts - 1) * random.uniform(0.5, 1.5))
+
+        finish_job_if_complete(chunk.job_id)
+    except Exception as e:
+        # Nobody waits on these futures, so make sure the error ends up in the logs
+        print(f"[job worker] Error processing chunk {chunk_id}: {e}")
+    finally:
+        close_old_connections()
+
+
+def finish_job_if_complete(job_id: int) -> None:
+    """
+    Once no chunk is waiting or running, merge all replies, store the output
+    and write the Activity record. Only one worker gets to finish a job.
+    The chunk texts and replies are emptied then: the output has all that is used of them.
+    """
+    if JobChunk.objects.filter(job_id=job_id, status__in=[Job.PENDING, Job.RUNNING]).exists():
+        return
+
+    chunks = list(JobChunk.objects.filter(job_id=job_id).order_by('index'))
+    failed = [chunk.index for chunk in chunks if chunk.status == Job.FAILED]
+    output = merge_structured_results(
+        [(chunk.reply, chunk.text) for chunk in chunks if chunk.status == Job.DONE]
+    )
+    status = Job.FAILED if chunks and len(failed) == len(chunks) else Job.DONE
+    error = f"{len(failed)} of {len(chunks)} chunks failed: {failed}" if failed else ""
+
+    finished = Job.objects.filter(pk=job_id, finished__isnull=True).update(
+        status=status, output=output, error=error, finished=timezone.now()
+    )
+    if finished:
+        JobChunk.objects.filter(job_id=job_id).update(text='', reply='')
+        job = Job.objects.get(pk=job_id)
+        usage = JobChunk.objects.filter(job_id=job_id).aggregate(
+            prompt_tokens=Sum('prompt_tokens'),
+            completion_tokens=Sum('completion_tokens'),
+            llm_calls=Sum('llm_calls'),
+            llm_seconds=Sum('llm_seconds'),
+            llm_cost=Sum('llm_cost'),
+        )
+        log_activity(user_id=job.user_id, endpoint=job.endpoint, input=job.input, output=output,
+                     **{field: total or 0 for field, total in usage.items()})
+
+
+def job_status(job: Job) -> dict:
+    counts = dict(job.chunks.values_list('status').annotate(n=Count('pk')).order_by())
+    return {
+        'job_id': job.pk,
+        'status': job.status,
+        'chunks_total': sum(counts.values()),
+        'chunks_done': counts.get(Job.DONE, 0),
+        'chunks_failed': counts.get(Job.FAILED, 0),
+        'created': job.created,
+        'finished': job.finished,
+        'error': job.error,
+    }
+
+
+def job_result(job: Job) -> dict:
+    """
+    The final output of a finished job, or the merge of the replies received so far.
+    A partial result only covers the chunks up to the first one that is still
+    being processed, so records are never attached to the wrong manuscript.
+    """
+    result = job_status(job)
+    if job.output is not None:
+        result['partial'] = False
+        result.update(job.output)
+        return result
+
+    ready = []
+    for chunk in job.chunks.order_by('index'):
+        if chunk.status in (Job.PENDING, Job.RUNNING):
+            break
+        if chunk.status == Job.DONE:
+            ready.append((chunk.reply, chunk.text))
+    result['partial'] = True
+    result.update(merge_structured_results(ready))
+    return result
+
+
+def purge_finished_jobs(retention_days: int, dry_run: bool = False) -> int:
+    """
+    Delete the jobs that finished more than 'retention_days' ago, with their chunks;
+    their input and output are kept with their Activity. Returns the number of jobs.
+    """
+    finished = Job.objects.filter(finished__lt=timezone.now() - timedelta(days=retention_days))
+    if dry_run:
+        return finished.count()
+    _, deleted = finished.delete()
+    return deleted.get('api.Job', 0)
@@ -0,0 +1,76 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.archive import archive_activities, expired_activities, reclaimable
+from api.jobs import purge_finished_jobs
+
+
+class Command(BaseCommand):
+    help = ("Move activities older than their retention to compressed monthly JSONL archives "
+            "and delete them from the database, with the jobs that finished before JOB_RETENTION_DAYS")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.ACTIVITY_RETENTION_DAYS,
+            help="Days to keep activities of endpoints without a retention of their own "
+                 f"(default: ACTIVITY_RETENTION_DAYS, {settings.ACTIVITY_RETENTION_DAYS})"
+        )
+        parser.add_argument(
+            '--endpoint-days', action='append', default=[], metavar='ENDPOINT=DAYS',
+            help="Days to keep the activities of one endpoint, e.g. drop_classify=90; "
+                 "added to those in ACTIVITY_RETENTION_DAYS_BY_ENDPOINT"
+        )
+        parser.add_argument(
+            '--job-days', type=int, default=settings.JOB_RETENTION_DAYS,
+            help=f"Days to keep finished jobs (default: JOB_RETENTION_DAYS, {settings.JOB_RETENTION_DAYS})"
+        )
+        parser.add_argument('--archive-dir', type=Path, default=settings.ACTIVITY_ARCHIVE_DIR,
+                            help="Where the archives go (default: ACTIVITY_ARCHIVE_DIR)")
+        parser.add_argument('--batch-size', type=int, default=100, help="Activities read and deleted at a time")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only tell how many activities would be archived and how much space that frees")
+        parser.add_argument('--vacuum', action='store_true',
+                            help="Afterwards rebuild the SQLite file, so it shrinks by the space freed; "
+                                 "this blocks all other requests until it is done")
+
+    def handle(self, *args, **options):
+        retention_by_endpoint = dict(settings.ACTIVITY_RETENTION_DAYS_BY_ENDPOINT)
+        for item in options['endpoint_days']:
+            endpoint, _, days = item.partition('=')
+            if not days.isdigit():
+                raise CommandError(f"--endpoint-days takes ENDPOINT=DAYS, not '{item}'")
+            retention_by_endpoint[endpoint] = int(days)
+        retention = ", ".join(f"{endpoint} {days} days" for endpoint, days in sorted(retention_by_endpoint.items()))
+        self.stdout.write(f"Keeping activities for {options['days']} days" + (f" ({retention})" if retention else ""))
+
+        expired = expired_activities(options['days'], retention_by_endpoint)
+        if options['dry_run']:
+            freed = reclaimable(expired)
+            for endpoint, count in freed['activities'].items():
+                self.stdout.write(f"  {endpoint}: {count} activities")
+            self.stdout.write(
+                f"Would archive {sum(freed['activities'].values())} activities and free {freed['blobs']} payload blobs, "
+                f"{freed['blob_bytes'] / 2**20:.1f} MB in the database ({freed['payload_bytes'] / 2**20:.1f} MB "
+                f"before compression)"
+            )
+            jobs = purge_finished_jobs(options['job_days'], dry_run=True)
+            self.stdout.write(f"Would delete {jobs} jobs finished more than {options['job_days']} days ago")
+            return
+
+        stats = {}
+        archive_activities(expired, options['archive_dir'], options['batch_size'], stats=stats)
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {stats['activities']} activities ({stats['bytes'] / 2**20:.1f} MB of JSON) "
+            f"in {options['archive_dir']}, deleted {stats['blobs']} payload blobs"
+        ))
+        jobs = purge_finished_jobs(options['job_days'])
+        self.stdout.write(f"Deleted {jobs} jobs finished more than {options['job_days']} days ago")
+
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+                cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.stdout.write("Rebuilt the database file")
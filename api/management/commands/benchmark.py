@@ -0,0 +1,19 @@
+import importlib
+
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run one of the performance benchmarks in api/benchmarks"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', required=True)
+        for name, module_name in BENCHMARKS.items():
+            module = importlib.import_module(module_name)
+            module.add_arguments(subparsers.add_parser(name))
+
+    def handle(self, *args, **options):
+        module = importlib.import_module(BENCHMARKS[options['benchmark']])
+        module.run(self.stdout.write, **options)
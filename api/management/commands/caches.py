@@ -0,0 +1,71 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from api.paths.caches import CACHES, cache_stats, get_cache
+
+
+class Command(BaseCommand):
+    help = "Show statistics of the caches shared by the workers, list their entries or purge them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', choices=[[]] + list(CACHES), help="Caches to use (default: all)")
+        parser.add_argument('--list', action='store_true', help="List the matching entries")
+        parser.add_argument('--purge', action='store_true', help="Delete the matching entries")
+        parser.add_argument('--match', help="Only entries whose key contains this text, e.g. 'person|Petrarca'")
+        parser.add_argument(
+            '--status', choices=['hit', 'miss', 'error'],
+            help="Only Wikidata lookups with this outcome, e.g. '--status error --purge' to retry failed lookups"
+        )
+        parser.add_argument('--expired', action='store_true', help="Remove entries whose time to live has passed")
+
+    def handle(self, *args, **options):
+        filtering = options['match'] or options['status']
+        for name in options['names'] or CACHES:
+            cache = get_cache(name)
+
+            if options['expired']:
+                self.stdout.write(f"{name}: removed {cache.expire()} expired entries")
+
+            if options['list'] or options['purge']:
+                # Reading entries here shouldn't count as hits or misses
+                cache.stats(enable=False)
+                try:
+                    matching = [
+                        (key, value, expire_time) for key, value, expire_time in self.entries(cache)
+                        if self.matches(key, value, options)
+                    ]
+                finally:
+                    cache.stats(enable=True)
+
+                if options['list']:
+                    for key, value, expire_time in matching:
+                        expires = datetime.fromtimestamp(expire_time).isoformat(' ', 'seconds') if expire_time else 'never'
+                        self.stdout.write(f"{key} => {value} (expires: {expires})")
+                if options['purge']:
+                    if filtering:
+                        purged = sum(cache.delete(key) for key, _, _ in matching)
+                    else:
+                        purged = cache.clear()
+                    self.stdout.write(self.style.SUCCESS(f"{name}: purged {purged} entries"))
+
+            stats = cache_stats(name)
+            self.stdout.write(
+                f"{name}: {stats['entries']} entries, {stats['size_bytes'] / 2 ** 20:.1f} MB, "
+                f"{stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.0%}"
+            )
+
+    @staticmethod
+    def entries(cache):
+        for key in cache.iterkeys():
+            value, expire_time = cache.get(key, expire_time=True)
+            if value is not None:
+                yield key, value, expire_time
+
+    @staticmethod
+    def matches(key, value, options):
+        if options['match'] and options['match'] not in str(key):
+            return False
+        if options['status'] and not (isinstance(value, dict) and value.get('status') == options['status']):
+            return False
+        return True
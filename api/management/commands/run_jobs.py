@@ -0,0 +1,22 @@
+from concurrent.futures import wait
+
+from django.core.management.base import BaseCommand
+
+from api.jobs import resume_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Process the chunks of all unfinished drop-classify jobs, e.g. after a restart"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requeue-running', action='store_true',
+            help="Also retry chunks left in 'running' by a worker that died. "
+                 "Only use this when no other process is working on the queue."
+        )
+
+    def handle(self, *args, **options):
+        futures = resume_pending_jobs(requeue_running=options['requeue_running'])
+        self.stdout.write(f"Queued {len(futures)} chunks")
+        wait(futures)
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:14
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_job'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='completion_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='llm_calls',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='llm_cost',
+            field=models.FloatField(default=0.0, help_text='In USD, as estimated by autogen'),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='llm_seconds',
+            field=models.FloatField(default=0.0, help_text='Wall time of the agent conversations, added up'),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='prompt_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='jobchunk',
+            name='completion_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='jobchunk',
+            name='llm_calls',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='jobchunk',
+            name='llm_cost',
+            field=models.FloatField(default=0.0, help_text='In USD, as estimated by autogen'),
+        ),
+        migrations.AddField(
+            model_name='jobchunk',
+            name='llm_seconds',
+            field=models.FloatField(default=0.0, help_text='Wall time of the agent conversations, added up'),
+        ),
+        migrations.AddField(
+            model_name='jobchunk',
+            name='prompt_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='UserTokenBudget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('daily_tokens', models.PositiveIntegerField(help_text='Prompt and completion tokens per day')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='token_budget', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,146 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:49
+
+import hashlib
+import json
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Activities converted at a time, so only this many payloads are in memory at once
+BATCH_SIZE = 100
+
+# Copies of the helpers in api.models as they were when this migration was written,
+# so changing those later doesn't change what this migration does
+
+COMPRESSION_LEVEL = 6
+
+
+def encode_payload(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def payload_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def summarize_payload(value, size: int) -> str:
+    if isinstance(value, dict):
+        description = ", ".join(
+            f"{key}: {len(item)} items" if isinstance(item, list) else key for key, item in value.items()
+        )
+    elif isinstance(value, list):
+        description = f"{len(value)} items"
+    elif isinstance(value, str):
+        description = " ".join(value[:100].split())
+    else:
+        description = json.dumps(value)
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    size = f"{size} bytes" if unit == 'bytes' else f"{size:.1f} {unit}"
+    return f"{description[:180]} -- {size}"
+
+
+def move_payloads_to_blobs(apps, schema_editor):
+    Activity = apps.get_model('api', 'Activity')
+    PayloadBlob = apps.get_model('api', 'PayloadBlob')
+    last = 0
+    while True:
+        activities = list(Activity.objects.filter(pk__gt=last).order_by('pk').only('pk', 'input', 'output')[:BATCH_SIZE])
+        if not activities:
+            break
+        blobs = {}
+        for activity in activities:
+            for name in ['input', 'output']:
+                value = getattr(activity, name)
+                data = encode_payload(value)
+                digest = payload_digest(data)
+                if digest not in blobs:
+                    blobs[digest] = PayloadBlob(digest=digest, size=len(data),
+                                                data=zlib.compress(data, COMPRESSION_LEVEL))
+                setattr(activity, f'{name}_blob_id', digest)
+                setattr(activity, f'{name}_summary', summarize_payload(value, len(data)))
+        stored = set(PayloadBlob.objects.filter(digest__in=blobs).values_list('digest', flat=True))
+        PayloadBlob.objects.bulk_create([blob for digest, blob in blobs.items() if digest not in stored])
+        Activity.objects.bulk_update(activities, ['input_blob', 'output_blob', 'input_summary', 'output_summary'])
+        last = activities[-1].pk
+
+
+def move_payloads_from_blobs(apps, schema_editor):
+    Activity = apps.get_model('api', 'Activity')
+    PayloadBlob = apps.get_model('api', 'PayloadBlob')
+    last = 0
+    while True:
+        activities = list(Activity.objects.filter(pk__gt=last).order_by('pk').only('pk', 'input_blob', 'output_blob')[:BATCH_SIZE])
+        if not activities:
+            break
+        digests = {activity.input_blob_id for activity in activities} | {activity.output_blob_id for activity in activities}
+        data = dict(PayloadBlob.objects.filter(digest__in=digests).values_list('digest', 'data'))
+        for activity in activities:
+            for name in ['input', 'output']:
+                digest = getattr(activity, f'{name}_blob_id')
+                setattr(activity, name, json.loads(zlib.decompress(data[digest])) if digest else None)
+        Activity.objects.bulk_update(activities, ['input', 'output'])
+        last = activities[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_llm_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayloadBlob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.PositiveIntegerField(help_text='Bytes of JSON before compression')),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='input_summary',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='output_summary',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='input_blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.payloadblob'),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='output_blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.payloadblob'),
+        ),
+        # Nullable, so the columns can be added back empty when the migration is reversed
+        migrations.AlterField(
+            model_name='activity',
+            name='input',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='output',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(move_payloads_to_blobs, move_payloads_from_blobs),
+        migrations.RemoveField(
+            model_name='activity',
+            name='input',
+        ),
+        migrations.RemoveField(
+            model_name='activity',
+            name='output',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-17 01:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_activity_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobchunk',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Times a worker has claimed the chunk'),
+        ),
+        migrations.AddField(
+            model_name='jobchunk',
+            name='claimed',
+            field=models.DateTimeField(blank=True, help_text='When a worker last claimed the chunk', null=True),
+        ),
+    ]
@@ -1,13 +1,316 @@
-from django.db import models
+import abc
+import hashlib
+import json
+import os
+import zlib
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
 
 
-class Activity(models.Model):
+# zlib level of PayloadBlob data; 6 is zlib's default, 9 is a little smaller and a lot slower
+PAYLOAD_COMPRESSION_LEVEL = int(os.getenv('PAYLOAD_COMPRESSION_LEVEL', '6'))
+
+
+class LLMUsage(models.Model):
+    """
+    LLM usage of a request or job chunk, as recorded by api.paths.metering.
+    """
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    llm_calls = models.PositiveIntegerField(default=0)
+    llm_seconds = models.FloatField(default=0.0, help_text="Wall time of the agent conversations, added up")
+    llm_cost = models.FloatField(default=0.0, help_text="In USD, as estimated by autogen")
+
+    class Meta:
+        abstract = True
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+
+def encode_payload(value) -> bytes:
+    """
+    The JSON of a payload, the same bytes for equal values with their keys in the same order.
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def payload_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def summarize_payload(value, size: int) -> str:
+    """
+    A line about a payload for the admin list, e.g. "content, extension, filename -- 1.2 MB"
+    or "structured_data: 12 items -- 80.4 KB".
+    """
+    if isinstance(value, dict):
+        description = ", ".join(
+            f"{key}: {len(item)} items" if isinstance(item, list) else key for key, item in value.items()
+        )
+    elif isinstance(value, list):
+        description = f"{len(value)} items"
+    elif isinstance(value, str):
+        description = " ".join(value[:100].split())
+    else:
+        description = json.dumps(value)
+    return f"{description[:180]} -- {format_size(size)}"
+
+
+def format_size(size: int) -> str:
+    """
+    e.g. "512 bytes" or "80.4 KB".
+    """
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return f"{size} bytes" if unit == 'bytes' else f"{size:.1f} {unit}"
+
+
+class PayloadBlob(models.Model):
+    """
+    An Activity input or output, as zlib compressed JSON. Blobs are named after the SHA-256
+    of their JSON, so a file that is uploaded again is stored only once.
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    size = models.PositiveIntegerField(help_text="Bytes of JSON before compression")
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.digest[:12]} -- {self.size} bytes, {len(self.data)} compressed'
+
+    @classmethod
+    def of(cls, value) -> 'PayloadBlob':
+        """
+        The unsaved blob of a payload.
+        """
+        data = encode_payload(value)
+        return cls(digest=payload_digest(data), size=len(data), data=zlib.compress(data, PAYLOAD_COMPRESSION_LEVEL))
+
+    @classmethod
+    def store(cls, blobs: list['PayloadBlob']) -> None:
+        """
+        Insert the blobs that aren't stored yet; another process may be storing the same ones.
+        """
+        unique = {blob.digest: blob for blob in blobs}
+        stored = set(cls.objects.filter(digest__in=unique).values_list('digest', flat=True))
+        cls.objects.bulk_create([blob for digest, blob in unique.items() if digest not in stored],
+                                ignore_conflicts=True)
+
+    @property
+    def value(self):
+        return json.loads(zlib.decompress(self.data))
+
+    def iter_json(self, chunk_size: int = 2**16):
+        """
+        The JSON bytes, decompressed a piece at a time.
+        """
+        decompressor = zlib.decompressobj()
+        for start in range(0, len(self.data), chunk_size):
+            yield decompressor.decompress(self.data[start:start + chunk_size])
+        yield decompressor.flush()
+
+
+class StreamedPayload(abc.ABC):
+    """
+    A payload written a piece at a time, e.g. a response as it is sent, compressed as it comes:
+    only the compressed data is kept. Set it as an Activity 'input' or 'output' like the value itself;
+    its blob has the digest of PayloadBlob.of(value).
+    """
+    opening = closing = b''
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(PAYLOAD_COMPRESSION_LEVEL)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.data = []
+        self.add(self.opening)
+
+    def add(self, data: bytes) -> None:
+        self.hash.update(data)
+        self.size += len(data)
+        self.data.append(self.compressor.compress(data))
+
+    def blob(self) -> PayloadBlob:
+        self.add(self.closing)
+        self.data.append(self.compressor.flush())
+        return PayloadBlob(digest=self.hash.hexdigest(), size=self.size, data=b''.join(self.data))
+
+    @abc.abstractmethod
+    def summary(self, size: int) -> str:
+        """
+        The input_summary or output_summary of the payload, 'size' bytes of JSON.
+        """
+
+
+class StreamedString(StreamedPayload):
+    """
+    A string written in pieces, e.g. the RDF of a streamed transform.
+    """
+    opening = closing = b'"'
+
+    def __init__(self):
+        super().__init__()
+        self.head = ''
+
+    def write(self, text: str) -> None:
+        # A JSON string is escaped character by character, so the pieces can be escaped one at a time
+        self.add(json.dumps(text, ensure_ascii=False)[1:-1].encode())
+        if len(self.head) < 100:
+            self.head += text[:100 - len(self.head)]
+
+    def summary(self, size: int) -> str:
+        return summarize_payload(self.head, size)
+
+
+class Activity(LLMUsage):
+    """
+    One request. Its input and output are kept in PayloadBlobs, read only when they are used;
+    set them as 'input' and 'output', e.g. Activity(user=..., endpoint=..., input=..., output=...).
+    """
     user = models.ForeignKey(User, on_delete=models.PROTECT, related_name="activities")
     endpoint =  models.CharField(max_length=64)
     created = models.DateTimeField(auto_now_add=True)
+    input_blob = models.ForeignKey(PayloadBlob, on_delete=models.PROTECT, related_name='+', null=True)
+    output_blob = models.ForeignKey(PayloadBlob, on_delete=models.PROTECT, related_name='+', null=True)
+    input_summary = models.CharField(max_length=200, blank=True)
+    output_summary = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created'], name='activity_created_idx'),
+            models.Index(fields=['user', 'created'], name='activity_user_created_idx'),
+            models.Index(fields=['endpoint', 'created'], name='activity_endpoint_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'User: {self.user} -- Endpoint: {self.endpoint} -- Created: {self.created}'
+
+    @property
+    def payloads(self) -> dict:
+        """
+        'input' and 'output' as set or read, by name.
+        """
+        return self.__dict__.setdefault('_payloads', {})
+
+    def payload(self, name: str):
+        if name not in self.payloads:
+            blob = getattr(self, f'{name}_blob')
+            self.payloads[name] = None if blob is None else blob.value
+        return self.payloads[name]
+
+    def set_payload(self, name: str, value) -> None:
+        if isinstance(value, StreamedPayload):
+            # Already compressed; read back from the blob if it is used
+            blob = value.blob()
+            setattr(self, f'{name}_blob', blob)
+            setattr(self, f'{name}_summary', value.summary(blob.size))
+            self.payloads.pop(name, None)
+            self.__dict__.setdefault('_unstored', {})[name] = blob
+            return
+        self.payloads[name] = value
+        # Name => its blob, once made
+        self.__dict__.setdefault('_unstored', {})[name] = None
+
+    @property
+    def input(self):
+        return self.payload('input')
+
+    @input.setter
+    def input(self, value):
+        self.set_payload('input', value)
+
+    @property
+    def output(self):
+        return self.payload('output')
+
+    @output.setter
+    def output(self, value):
+        self.set_payload('output', value)
+
+    @classmethod
+    def store_payloads(cls, activities: list['Activity']) -> None:
+        """
+        Compress and store the inputs and outputs that were set since the activities were loaded,
+        with one query for all of them, and point the activities to their blobs.
+        Call it in the transaction that saves the activities: a blob that nothing refers to
+        may be deleted by archive_activities. Calling it again, after a rollback, stores the same blobs.
+        """
+        blobs = []
+        for activity in activities:
+            unstored = activity.__dict__.get('_unstored', {})
+            for name, blob in unstored.items():
+                if blob is None:
+                    value = activity.payloads[name]
+                    blob = unstored[name] = PayloadBlob.of(value)
+                    setattr(activity, f'{name}_blob', blob)
+                    setattr(activity, f'{name}_summary', summarize_payload(value, blob.size))
+                blobs.append(blob)
+        if blobs:
+            PayloadBlob.store(blobs)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            self.store_payloads([self])
+            super().save(*args, **kwargs)
+        self.__dict__.pop('_unstored', None)
+
+
+class Job(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name="jobs")
+    endpoint = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
     input = models.JSONField()
-    output = models.JSONField()
+    output = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Job {self.pk} -- User: {self.user} -- Endpoint: {self.endpoint} -- Status: {self.status}'
+
+
+class JobChunk(LLMUsage):
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="chunks")
+    index = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=Job.STATUS_CHOICES, default=Job.PENDING, db_index=True)
+    text = models.TextField()
+    reply = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0, help_text="Times a worker has claimed the chunk")
+    claimed = models.DateTimeField(null=True, blank=True, help_text="When a worker last claimed the chunk")
+
+    class Meta:
+        ordering = ['job', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'index'], name='unique_job_chunk_index'),
+        ]
+
+    def __str__(self):
+        return f'Job {self.job_id} -- Chunk {self.index} -- Status: {self.status}'
+
+
+class UserTokenBudget(models.Model):
+    """
+    Optional limit on the LLM tokens a user may use per day; users without one are unlimited.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="token_budget")
+    daily_tokens = models.PositiveIntegerField(help_text="Prompt and completion tokens per day")
 
     def __str__(self):
-        return f'User: {self.user} -- Endpoint: {self.endpoint} -- Created: {self.created}'
\ No newline at end of file
+        return f'User: {self.user} -- {self.daily_tokens} tokens per day'
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import diskcache
+
+
+# The caches live next to the database in the writable volume, so all gunicorn
+# workers share them and they survive a restart of the container.
+CACHE_DIR = Path(os.getenv(
+    'MANUSCRIPTAI_CACHE_DIR',
+    Path(__file__).resolve().parent.parent.parent.parent / 'writable' / 'cache'
+))
+
+# Name => default size limit in MB; override with e.g. CLASSIFICATIONS_CACHE_SIZE_MB
+CACHES = {
+    'classifications': 64,
+    'wikidata': 64,
+    'extractions': 256,
+    'admin_previews': 32,
+}
+
+# State shared between the processes, e.g. rate limits; no statistics and not listed by './manage.py caches'
+INTERNAL_CACHES = {
+    'rate_limits': 1,
+}
+
+_open_caches = {}
+_open_caches_lock = threading.Lock()
+_checked_versions = set()
+_checked_versions_lock = threading.Lock()
+
+
+def get_cache(name: str) -> diskcache.Cache:
+    """
+    Return the named cache, opening it on first use.
+    The caches are SQLite based, so they are safe to use from several threads
+    and processes at once. When a cache grows beyond its size limit,
+    the least recently used entries are evicted.
+    """
+    with _open_caches_lock:
+        cache = _open_caches.get(name)
+        if cache is None:
+            default_size_mb = CACHES[name] if name in CACHES else INTERNAL_CACHES[name]
+            size_limit_mb = int(os.getenv(f'{name.upper()}_CACHE_SIZE_MB', default_size_mb))
+            cache = diskcache.Cache(
+                str(CACHE_DIR / name),
+                size_limit=size_limit_mb * 2 ** 20,
+                eviction_policy='least-recently-used',
+                statistics=name in CACHES,
+                tag_index=True
+            )
+            _open_caches[name] = cache
+    return cache
+
+
+def prompt_version(system_message: str) -> str:
+    """
+    Short hash of a system prompt, used in cache keys so that editing a prompt
+    never returns answers that were given to the old one.
+    """
+    return hashlib.sha256(system_message.encode('utf-8')).hexdigest()[:16]
+
+
+def reply_cache_key(tag: str, system_message: str, model: str, message: str) -> str:
+    """
+    Content-addressed key of an agent reply: the same message sent to an agent with
+    the same prompt and model gets the same key, e.g. 'drop_classify|<prompt>|gpt-4o|<sha256 of message>'.
+    """
+    digest = hashlib.sha256(message.encode('utf-8')).hexdigest()
+    return "|".join([tag, prompt_version(system_message), model, digest])
+
+
+def ensure_prompt_version(cache: diskcache.Cache, tag: str, version: str) -> None:
+    """
+    Evict all entries stored with 'tag' when they were made with another prompt version.
+    Checked once per process; the entries can no longer be hit anyway, this just frees the space.
+    """
+    if (cache.directory, tag, version) in _checked_versions:
+        return
+    # Locked over threads and processes, so nobody evicts the entries another worker
+    # has just stored for the new version
+    with _checked_versions_lock, diskcache.Lock(cache, f'prompt_version_lock|{tag}'):
+        # A membership test doesn't count towards the hit/miss statistics, unlike get()
+        version_key = f'prompt_version|{tag}|{version}'
+        if version_key not in cache:
+            cache.evict(tag)
+            cache.set(version_key, True, tag=tag)
+        _checked_versions.add((cache.directory, tag, version))
+
+
+def cache_stats(name: str) -> dict:
+    cache = get_cache(name)
+    hits, misses = cache.stats()
+    return {
+        'entries': len(cache),
+        'size_bytes': cache.volume(),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+    }
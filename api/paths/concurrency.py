@@ -0,0 +1,59 @@
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from autogen import ConversableAgent
+
+
+# Per-thread copies of the module-level agents, keyed by id() of the original
+_local = threading.local()
+
+
+def thread_local_agent(agent: ConversableAgent) -> ConversableAgent:
+    """
+    Return a copy of 'agent' that belongs to the current thread.
+    A ConversableAgent keeps its chat history on the instance, so two threads
+    running a chat between the same pair of agents would overwrite each other's
+    messages. The main thread keeps using the module-level agent itself.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return agent
+
+    if not hasattr(_local, "agents"):
+        _local.agents = {}
+
+    clone = _local.agents.get(id(agent))
+    if clone is None:
+        clone = ConversableAgent(
+            name=agent.name,
+            system_message=agent.system_message,
+            llm_config=agent.llm_config,
+            is_termination_msg=agent._is_termination_msg,
+            human_input_mode=agent.human_input_mode
+        )
+        _local.agents[id(agent)] = clone
+    return clone
+
+
+def bounded_map(fn, items, max_workers: int):
+    """
+    Like map(fn, items), but with up to 'max_workers' calls running at once.
+    Results are yielded in the order of 'items', whatever order the calls finish in.
+    'items' is consumed lazily, so it may be a generator; at most twice
+    'max_workers' items are in flight at any time.
+    Every call runs in a copy of the caller's context, so context variables
+    such as the current meter are seen by the worker threads too.
+    With max_workers <= 1 everything runs in the calling thread.
+    """
+    if max_workers <= 1:
+        yield from map(fn, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(contextvars.copy_context().run, fn, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
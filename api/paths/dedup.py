@@ -0,0 +1,128 @@
+import hashlib
+import heapq
+import os
+import zlib
+from typing import Iterable, Iterator
+
+
+# Estimated share of word shingles two chunks must have in common to be reported as near-duplicates;
+# above 1 none are looked for. Near-duplicates are still sent: two manuscripts may share a long text,
+# such as an incipit or a list of contents, and differ only in their shelfmark or dimensions
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('DROP_CLASSIFY_NEAR_DUPLICATE_THRESHOLD', '0.95'))
+
+# Words per shingle
+SHINGLE_WORDS = 5
+# Hashes kept per chunk (bottom-k MinHash); the similarity estimate is off by about 0.02 around 0.9
+SKETCH_SIZE = 256
+# Smallest hashes under which a chunk is indexed; near-duplicates share nearly all of them
+INDEXED_HASHES = 8
+
+
+def normalize(text: str) -> str:
+    """
+    The text with all runs of whitespace as a single space,
+    so copies that differ only in layout are exact duplicates.
+    """
+    return " ".join(text.split())
+
+
+def text_digest(text: str) -> bytes:
+    """
+    Digest of the normalized text, the same for exact duplicates.
+    """
+    return hashlib.blake2b(normalize(text).encode(), digest_size=16).digest()
+
+
+def minhash_sketch(text: str) -> frozenset[int]:
+    """
+    The SKETCH_SIZE smallest hashes of the word shingles of a normalized text.
+    """
+    words = text.split(" ")
+    if len(words) <= SHINGLE_WORDS:
+        shingles = {text}
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    return frozenset(heapq.nsmallest(SKETCH_SIZE, {zlib.crc32(shingle.encode()) for shingle in shingles}))
+
+
+def estimate_similarity(a: frozenset[int], b: frozenset[int]) -> float:
+    """
+    Estimated Jaccard similarity of the shingles of two texts, from their sketches:
+    the share of the smallest hashes of both together that is in each of them.
+    """
+    union = heapq.nsmallest(SKETCH_SIZE, a | b)
+    return sum(1 for h in union if h in a and h in b) / len(union) if union else 1.0
+
+
+class ChunkDeduplicator:
+    """
+    Remembers the chunks of one upload and recognises copies of earlier ones:
+    exact duplicates by a hash of the normalized text, near-duplicates (a date written
+    differently, a typo fixed, or another manuscript with the same text) by MinHash.
+    """
+
+    def __init__(self, threshold: float = None):
+        self.threshold = NEAR_DUPLICATE_THRESHOLD if threshold is None else threshold
+        self.count = 0
+        self.digests = {}  # digest of normalized text => chunk index
+        self.sketches = []  # chunk index => sketch
+        self.index = {}  # indexed hash => chunk indices
+
+    def duplicate_of(self, text: str) -> tuple[int | None, bool]:
+        """
+        (index of the earlier chunk 'text' duplicates, whether it is only a near-duplicate),
+        or (None, False) for a new chunk. New chunks and near-duplicates are remembered
+        under the next index; indices count all chunks seen, duplicates included.
+        """
+        index = self.count
+        self.count += 1
+
+        digest = text_digest(text)
+        if digest in self.digests:
+            return self.digests[digest], False
+
+        self.digests[digest] = index
+        if self.threshold > 1:
+            return None, False
+
+        sketch = minhash_sketch(normalize(text))
+        smallest = heapq.nsmallest(INDEXED_HASHES, sketch)
+        candidates = sorted({candidate for h in smallest for candidate in self.index.get(h, ())})
+        original = next(
+            (self.sketches[candidate][0] for candidate in candidates
+             if estimate_similarity(sketch, self.sketches[candidate][1]) >= self.threshold),
+            None
+        )
+        for h in smallest:
+            self.index.setdefault(h, []).append(len(self.sketches))
+        self.sketches.append((index, sketch))
+        return original, original is not None
+
+
+def iter_unique_chunks(chunks: Iterable[str], stats: dict = None, threshold: float = None) -> Iterator[str]:
+    """
+    The chunks without the exact copies of earlier ones, consumed lazily.
+    Only the first copy goes to the Structurer, so the manuscripts it holds come out once,
+    with that copy, the same text, as their data_analyzed. Near-duplicates are sent like any other chunk,
+    they may well describe other manuscripts. Both are logged with the chunk they resemble.
+    If 'stats' is given, 'duplicate_chunks' (skipped chunks, i.e. the LLM calls avoided)
+    and 'near_duplicate_chunks' (chunks sent that resemble an earlier one) are added to it.
+    """
+    if stats is not None:
+        stats.setdefault("duplicate_chunks", 0)
+        stats.setdefault("near_duplicate_chunks", 0)
+    deduplicator = ChunkDeduplicator(threshold)
+
+    for index, chunk_text in enumerate(chunks):
+        original, near = deduplicator.duplicate_of(chunk_text)
+        if original is None:
+            yield chunk_text
+        elif near:
+            print(f"[dedup] Chunk {index} is a near-duplicate of chunk {original}, sent anyway")
+            if stats is not None:
+                stats["near_duplicate_chunks"] += 1
+            yield chunk_text
+        else:
+            print(f"[dedup] Chunk {index} is a copy of chunk {original}, skipped")
+            if stats is not None:
+                stats["duplicate_chunks"] += 1
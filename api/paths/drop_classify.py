@@ -1,11 +1,23 @@
+import functools
+import io
+import itertools
 import os
 from autogen import ConversableAgent
 from dotenv import load_dotenv
 import csv
 import json
+import rdflib
+from rdflib.namespace import RDF
 import xml.etree.ElementTree as ET
+from typing import Iterable, Iterator
+from xml.sax.saxutils import escape
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from api.paths.caches import ensure_prompt_version, get_cache, prompt_version, reply_cache_key
+from api.paths.concurrency import bounded_map, thread_local_agent
+from api.paths.dedup import iter_unique_chunks, text_digest
+from api.paths.metering import metered_chat
+
 
 try:
     import tiktoken
@@ -130,299 +142,960 @@ structurer_agent = ConversableAgent(
 # Token Counting
 #######################
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    """
+    The tiktoken encoding of 'model_name', loaded once per process.
+    None if tiktoken is absent or can't load the encoding (it is downloaded on first use).
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except Exception as e:
+        print(f"[WARNING] No tiktoken encoding for {model_name}, estimating tokens as characters / 4: {e}")
+        return None
+
+
 def count_tokens(text: str, model_name: str = "gpt-3.5-turbo-16k") -> int:
     """
     Use tiktoken (if installed) to count tokens for 'text'
     under the given 'model_name'. If tiktoken is absent,
     fallback to len(text)//4 as a naive approximation.
     """
-    if tiktoken is None:
+    encoding = get_encoding(model_name)
+    if encoding is None:
         # fallback
         return len(text) // 4
     else:
-        encoding = tiktoken.encoding_for_model(model_name)
-        return len(encoding.encode(text))
+        return len(encoding.encode(text, disallowed_special=()))
+
+
+# Tokens per Structurer request: system prompt, chunk and reply together,
+# leaving some margin in the 16k context of the model
+TOKEN_THRESHOLD = int(os.getenv('DROP_CLASSIFY_TOKEN_THRESHOLD', '14000'))
+
+# The Structurer copies the data verbatim into JSON, so its reply is expected to be
+# about this many times as long as the chunk
+REPLY_TOKEN_RATIO = float(os.getenv('DROP_CLASSIFY_REPLY_TOKEN_RATIO', '1.0'))
+
+# Role and separators the chat format adds to every message
+MESSAGE_OVERHEAD_TOKENS = 8
 
+# The message that carries a chunk to the Structurer
+DATA_MESSAGE = "Here is the data:\n{}"
+
+
+@functools.lru_cache(maxsize=None)
+def chunk_token_budget() -> int:
+    """
+    Tokens a chunk may have: what is left of TOKEN_THRESHOLD after the Structurer's
+    system prompt and the message around the chunk, shared between the chunk and the expected reply.
+    """
+    prompt_tokens = (
+        count_tokens(structurer_agent.system_message, model)
+        + count_tokens(DATA_MESSAGE.format(""), model)
+        + 2 * MESSAGE_OVERHEAD_TOKENS
+    )
+    return max(256, int((TOKEN_THRESHOLD - prompt_tokens) / (1 + REPLY_TOKEN_RATIO)))
 
-TOKEN_THRESHOLD = 14000
 
 #######################
 # Chunking Functions
 #######################
 
-CHUNK_SIZE = 2000  # approx chars per chunk
 OVERLAP_PERCENT = 10  # 10% overlap
 
+# Number of chunks sent to the Structurer at the same time (1 = sequential)
+MAX_CONCURRENT_CHUNKS = int(os.getenv('DROP_CLASSIFY_CONCURRENCY', '4'))
+
+# Leave out units (CSV rows, JSON items, ...) that repeat an earlier one. Off by default: a unit isn't
+# always a record of its own, e.g. a row without an ID that continues the manuscript above it
+SKIP_DUPLICATE_RECORDS = os.getenv('DROP_CLASSIFY_SKIP_DUPLICATE_RECORDS', 'False') == 'True'
+
+
+def iter_packed_units(units: Iterable[str], token_budget: int, head: str = "", separator: str = "\n", tail: str = "",
+                      stats: dict = None, skip_duplicates: bool = None) -> Iterator[str]:
+    """
+    Pack whole units (CSV rows, JSON array items, XML elements, ...) into as few chunks as possible:
+    head + units joined by separator + tail, each chunk within 'token_budget' tokens.
+    A unit is never split; one that doesn't fit the budget on its own becomes a chunk by itself.
+    With 'skip_duplicates' (default: SKIP_DUPLICATE_RECORDS) copies of earlier units,
+    e.g. the same row in several sheets, are left out.
+    'units' is consumed lazily and every chunk is yielded as soon as it is full.
+    If 'stats' is given, the number of units left out is added to its 'duplicate_records'.
+    """
+    if skip_duplicates is None:
+        skip_duplicates = SKIP_DUPLICATE_RECORDS
+    fixed_tokens = count_tokens(head + tail, model)
+    separator_tokens = count_tokens(separator, model)
+    if stats is not None:
+        stats.setdefault("duplicate_records", 0)
+
+    seen = set()
+    current: list[str] = []
+    current_tokens = fixed_tokens
+    for unit in units:
+        if skip_duplicates:
+            digest = text_digest(unit)
+            if digest in seen:
+                if stats is not None:
+                    stats["duplicate_records"] += 1
+                continue
+            seen.add(digest)
+        # One extra token per unit keeps the sum of the parts on the safe side of the whole
+        unit_tokens = count_tokens(unit, model) + separator_tokens + 1
+        if current and current_tokens + unit_tokens > token_budget:
+            yield head + separator.join(current) + tail
+            current, current_tokens = [], fixed_tokens
+        if not current and fixed_tokens + unit_tokens > token_budget:
+            print(f"[WARNING] A unit of {unit_tokens} tokens exceeds the chunk budget of {token_budget} tokens")
+        current.append(unit)
+        current_tokens += unit_tokens
+
+    if current:
+        yield head + separator.join(current) + tail
+
+
+def pack_units(units: Iterable[str], token_budget: int, head: str = "", separator: str = "\n", tail: str = "",
+               stats: dict = None, skip_duplicates: bool = None) -> list[str]:
+    return list(iter_packed_units(units, token_budget, head, separator, tail, stats, skip_duplicates))
 
-def chunk_plain_text(text: str) -> list[str]:
+
+def chunk_plain_text(text: str, token_budget: int = None) -> list[str]:
     """
-    Use RecursiveCharacterTextSplitter for smart context-aware splitting.
+    Use RecursiveCharacterTextSplitter for smart context-aware splitting,
+    into chunks of up to 'token_budget' tokens.
     """
+    if token_budget is None:
+        token_budget = chunk_token_budget()
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=int(CHUNK_SIZE * OVERLAP_PERCENT / 100),
+        chunk_size=token_budget,
+        chunk_overlap=int(token_budget * OVERLAP_PERCENT / 100),
+        length_function=lambda piece: count_tokens(piece, model),
         separators=["\n\n", "\n", ".", " "]
     )
     return text_splitter.split_text(text)
 
 
-def chunk_csv_tsv(content: str, is_tsv=False, max_rows=50) -> list[str]:
+def chunk_csv_tsv(content: str, is_tsv=False, token_budget: int = None, stats: dict = None) -> list[str]:
     """
-    Splits CSV or TSV data into chunk_str blocks, each with up to `max_rows` rows.
+    Packs CSV or TSV records into chunk_str blocks of up to 'token_budget' tokens.
     Repeats the header row in each chunk to maintain context.
     """
-    delimiter = "\t" if is_tsv else ","
-    lines = content.strip().split("\n")
-    reader = csv.reader(lines, delimiter=delimiter)
-
-    header = next(reader, None)
-    if not header:
-        return []
-
-    chunks = []
-    current_rows = [header]
-    row_count = 0
-
-    for row in reader:
-        current_rows.append(row)
-        row_count += 1
-        if row_count >= max_rows:
-            chunk_str = "\n".join(delimiter.join(r) for r in current_rows)
-            chunks.append(chunk_str)
-            current_rows = [header]  # reset with header again
-            row_count = 0
-
-    # leftover rows
-    if len(current_rows) > 1:
-        chunk_str = "\n".join(delimiter.join(r) for r in current_rows)
-        chunks.append(chunk_str)
-
-    # Optionally, you could do some overlap of the last 1-2 rows if your scenario requires it,
-    # but typically for CSV data you don't overlap entire rows.
-    return chunks
+    return list(iter_csv_tsv_chunks(io.StringIO(content, newline=""), is_tsv, token_budget, stats))
 
 
-def chunk_json(content: str) -> list[str]:
+def iter_csv_tsv_chunks(lines: Iterable[str], is_tsv=False, token_budget: int = None, stats: dict = None) -> Iterator[str]:
     """
-    Splits JSON data by top-level objects if it's an array,
-    or returns a single chunk if it's just one object.
+    Like chunk_csv_tsv(), but reads the records lazily from 'lines', e.g. a file opened with newline="".
+    Records are read with the csv module, so quoted fields may hold delimiters and newlines,
+    and written out again quoted where needed, as csv.writer does.
+    A record is never split over chunks; empty lines are left out.
+    """
+    if token_budget is None:
+        token_budget = chunk_token_budget()
+    delimiter = "\t" if is_tsv else ","
+    reader = csv.reader(lines, delimiter=delimiter)
+    header = next((row for row in reader if row), None)
+    if header is None:
+        return
+
+    def format_row(row: list[str]) -> str:
+        # What csv.writer writes with its default, minimal quoting, but several times faster
+        if len(row) == 1 and not row[0]:
+            return '""'
+        return delimiter.join([
+            '"' + field.replace('"', '""') + '"'
+            if delimiter in field or '"' in field or "\n" in field or "\r" in field else field
+            for field in row
+        ])
+
+    # Typically for CSV data you don't overlap entire rows.
+    rows = (format_row(row) for row in reader if row)
+    yield from iter_packed_units(rows, token_budget, head=format_row(header) + "\n", stats=stats)
+
+
+def chunk_json(content: str, token_budget: int = None, stats: dict = None) -> list[str]:
+    """
+    Packs the items of a top-level JSON array into chunks of up to 'token_budget' tokens,
+    each a valid JSON array, or returns a single chunk if it's just one object.
     If invalid JSON, fallback to plain text chunking.
     """
+    if token_budget is None:
+        token_budget = chunk_token_budget()
     try:
         data = json.loads(content)
     except json.JSONDecodeError:
         # fallback => treat as plain text with chunk overlap
-        return chunk_plain_text(content)
+        return chunk_plain_text(content, token_budget)
 
     if isinstance(data, list):
-        # create one chunk per item in the list
-        # each chunk is a valid JSON array with a single element
-        chunks = []
-        for item in data:
-            chunk_text = json.dumps([item], ensure_ascii=False)
-            chunks.append(chunk_text)
-        return chunks
+        items = (json.dumps(item, ensure_ascii=False) for item in data)
+        return pack_units(items, token_budget, head="[", separator=", ", tail="]", stats=stats)
     else:
         # single JSON object => single chunk
         return [json.dumps(data, ensure_ascii=False)]
 
 
-# we are not using this function at the moment
-def chunk_tei_by_msdesc(content: str) -> list[str]:
+def chunk_xml(content: str, token_budget: int = None, stats: dict = None) -> list[str]:
     """
-    Splits TEI XML into separate chunks per <msDesc> element
-    in the TEI namespace (http://www.tei-c.org/ns/1.0).
-    If no <msDesc> is found, returns the entire content as a single chunk.
+    Chunks XML that is in memory already with the streaming chunker, iter_xml_chunks():
+    one <msDesc> per unit for TEI, one top-level child per unit otherwise.
+    Falls back to chunk_plain_text if the XML turns out to be malformed.
     """
+    if token_budget is None:
+        token_budget = chunk_token_budget()
     try:
-        root = ET.fromstring(content)
+        return list(iter_xml_chunks(io.StringIO(content), token_budget, stats))
     except ET.ParseError:
-        # fallback => plain text chunk
-        return chunk_plain_text(content)
+        return chunk_plain_text(content, token_budget)
 
-    # TEI namespace
-    ns = {'tei': 'http://www.tei-c.org/ns/1.0'}
 
-    # check if this is actually TEI by looking at the root tag
-    # often root.tag == '{http://www.tei-c.org/ns/1.0}TEI'
-    if not root.tag.endswith('TEI'):
-        # Not a TEI root => fallback or standard chunk_xml approach
-        return [content]
-
-    msdesc_list = root.findall(".//tei:msDesc", ns)  # or ms:item?
-    if not msdesc_list:
-        # No <msDesc> => return entire TEI as a single chunk
-        return [content]
-
-    # Return each <msDesc> as its own chunk (XML string)
-    chunks = []
-    for msdesc in msdesc_list:
-        chunk_str = ET.tostring(msdesc, encoding="unicode")
-        chunks.append(chunk_str)
+def chunk_turtle(content: str, token_budget: int = None) -> list[str]:
+    """
+    Parses the Turtle and packs the description of every subject into chunks of up to
+    'token_budget' tokens, each starting with the prefixes of the document. There is no overlap:
+    a subject is described in one chunk only, together with the blank nodes it refers to
+    and the other subjects that refer to those.
+    Falls back to chunk_plain_text if the content is not valid Turtle.
+    """
+    if token_budget is None:
+        token_budget = chunk_token_budget()
+    graph = rdflib.Graph(bind_namespaces="none")
+    try:
+        graph.parse(data=content, format="turtle")
+    except (SyntaxError, ValueError) as e:
+        print(f"[WARNING] Turtle could not be parsed, chunking it as text: {e}")
+        return chunk_plain_text(content, token_budget)
 
-    return chunks
+    prefixes = "".join(f"@prefix {prefix}: <{namespace}> .\n" for prefix, namespace in graph.namespaces())
+    return pack_units(iter_turtle_subjects(graph), token_budget, head=prefixes + "\n", separator="\n\n")
 
 
-def chunk_xml_general(content: str) -> list[str]:
+def iter_turtle_subjects(graph: rdflib.Graph) -> Iterator[str]:
     """
-    1. Parse the XML.
-    2. Split by top-level child elements.
-    3. If any child's string is longer than CHUNK_SIZE, chunk it further.
-    4. If no children exist, or parsing fails, fall back to chunk_plain_text.
+    Yields the Turtle descriptions of the subjects in the graph, without prefixes, one unit per
+    group of subjects linked by blank nodes. A blank node that is the object of exactly one triple
+    is written inline, as [ ... ], in the description that refers to it rather than as a subject
+    of its own. A blank node referred to more than once is described in the same unit as all
+    the subjects that refer to it: its label only means something within one chunk.
+    rdflib keeps no order, so subjects, predicates and objects are sorted and blank nodes
+    relabelled (_:b0, _:b1, ...), for the same Turtle to give the same chunks every time;
+    otherwise they would never be found in the reply cache.
     """
-    try:
-        root = ET.fromstring(content)
-    except ET.ParseError:
-        return chunk_plain_text(content)
+    references = {}
+    for node in graph.objects():
+        if isinstance(node, rdflib.BNode):
+            references[node] = references.get(node, 0) + 1
+    inline = {node for node, count in references.items() if count == 1}
+    written = set()
+    labels = {}
+
+    def pair_order(predicate_object: tuple) -> tuple:
+        # rdf:type first; blank nodes last, as their labels mean nothing
+        predicate, obj = predicate_object
+        blank = isinstance(obj, rdflib.BNode)
+        return predicate != RDF.type, str(predicate), blank, "" if blank else str(obj)
+
+    def subject_order(subject) -> tuple:
+        # IRIs alphabetically, then blank nodes by what they say
+        if isinstance(subject, rdflib.BNode):
+            return True, "", sorted(pair_order(pair) for pair in graph.predicate_objects(subject))
+        return False, str(subject), []
+
+    def name(node) -> str:
+        if isinstance(node, rdflib.BNode):
+            return f"_:b{labels.setdefault(node, len(labels))}"
+        try:
+            return node.n3(graph.namespace_manager)
+        except Exception:
+            # rdflib parses some IRIs it refuses to write, like ones with spaces; keep them as they were
+            return f"<{node}>"
+
+    def term(node, indent: str) -> str:
+        if node in inline and node not in written:
+            written.add(node)
+            return f"[\n{properties(node, indent + '    ')}\n{indent}]"
+        return name(node)
+
+    def properties(subject, indent: str) -> str:
+        objects_by_predicate = {}
+        for predicate, obj in sorted(graph.predicate_objects(subject), key=pair_order):
+            objects_by_predicate.setdefault(predicate, []).append(obj)
+        return " ;\n".join(
+            f"{indent}{'a' if predicate == RDF.type else name(predicate)} "
+            + " , ".join(term(obj, indent) for obj in objects)
+            for predicate, objects in objects_by_predicate.items()
+        )
 
-    children = list(root)
+    def description(subject) -> str:
+        written.add(subject)
+        return f"{name(subject)}\n{properties(subject, '    ')} ."
 
-    # If no top-level children, just chunk the entire doc
-    if not children:
-        entire_doc_str = ET.tostring(root, encoding="unicode")
-        # If this entire doc is bigger than CHUNK_SIZE, chunk it
-        if len(entire_doc_str) > CHUNK_SIZE:
-            return chunk_plain_text(entire_doc_str)
-        else:
-            return [entire_doc_str]
+    # Group the subjects linked by blank nodes, with union-find
+    parent = {}
 
-    # Otherwise, for each top-level child, check size
-    chunks = []
-    for child in children:
-        child_str = ET.tostring(child, encoding="unicode")
+    def group(node):
+        while parent.get(node, node) != node:
+            node = parent[node]
+        return node
 
-        if len(child_str) > CHUNK_SIZE:
-            # If the child is still too big, do text-based chunking
-            sub_chunks = chunk_plain_text(child_str)
-            chunks.extend(sub_chunks)
-        else:
-            # Child is small enough to be a single chunk
-            chunks.append(child_str)
+    for subject, obj in graph.subject_objects():
+        if isinstance(obj, rdflib.BNode) and group(obj) != group(subject):
+            parent[group(obj)] = group(subject)
+
+    # In the order of their first subject
+    subjects = sorted(set(graph.subjects()), key=subject_order)
+    groups = {}
+    for subject in subjects:
+        groups.setdefault(group(subject), []).append(subject)
 
-    # 'chunks' now contains all children, with big children chunked further
-    return chunks
+    for members in groups.values():
+        descriptions = [description(subject) for subject in members if subject not in inline and subject not in written]
+        # Blank nodes that only refer to each other in a cycle
+        descriptions += [description(subject) for subject in members if subject not in written]
+        if descriptions:
+            yield "\n\n".join(descriptions)
 
 
-def chunk_turtle(content: str) -> list[str]:
+def chunk_file_by_type(content: str, extension: str, stats: dict = None) -> list[str]:
     """
-    Naive: Splits Turtle data by double newlines, with overlap in characters.
+    Decide chunking strategy based on extension.
+    If 'stats' is given, 'duplicate_records' is added to it for the formats made of records.
     """
-    blocks = content.strip().split("\n\n")
-    chunk_size = CHUNK_SIZE
-    overlap = int(chunk_size * OVERLAP_PERCENT / 100)
+    ext = extension.lower().strip()
+    if ext in ("csv", "tsv"):
+        return chunk_csv_tsv(content, is_tsv=(ext == "tsv"), stats=stats)
+    elif ext == "json":
+        return chunk_json(content, stats=stats)
+    elif ext in ("xml", "tei"):
+        return chunk_xml(content, stats=stats)
+    elif ext in ("ttl", "turtle"):
+        return chunk_turtle(content)
+    else:
+        return chunk_plain_text(content)
 
-    chunks = []
-    i = 0
-    total_blocks = len(blocks)
 
-    while i < total_blocks:
-        end = min(i + chunk_size, total_blocks)
-        # join the blocks from i..end as a single chunk
-        joined = "\n\n".join(blocks[i:end])
-        chunks.append(joined)
+#######################
+# Streaming Chunkers
+#######################
+
+# Characters read from an uploaded file at a time
+READ_SIZE = 64 * 1024
 
-        i = end - overlap
-        if i < 0:
-            i = end
 
-    return chunks
+def iter_text_pieces(text_file, size: int = READ_SIZE) -> Iterator[str]:
+    while piece := text_file.read(size):
+        yield piece
 
 
-def chunk_file_by_type(content: str, extension: str) -> list[str]:
+def iter_file_chunks(binary_file, extension: str, token_budget: int = None, stats: dict = None) -> Iterator[str]:
     """
-    Decide chunking strategy based on extension.
+    Like chunk_file_by_type(), but reads the file a piece at a time and yields every chunk
+    as soon as it is complete, so memory stays proportional to a chunk rather than the file.
+    The bytes are decoded incrementally as UTF-8; undecodable bytes are replaced.
     """
+    if token_budget is None:
+        token_budget = chunk_token_budget()
     ext = extension.lower().strip()
+    if ext in ("xml", "tei"):
+        yield from iter_xml_chunks(binary_file, token_budget, stats)
+        return
+
+    # newline="" leaves line endings inside quoted CSV fields to the csv module
+    text_file = io.TextIOWrapper(binary_file, encoding="utf-8-sig", errors="replace", newline="")
     if ext in ("csv", "tsv"):
-        return chunk_csv_tsv(content, is_tsv=(ext == "tsv"))
+        yield from iter_csv_tsv_chunks(text_file, is_tsv=(ext == "tsv"), token_budget=token_budget, stats=stats)
     elif ext == "json":
-        return chunk_json(content)
-    elif ext in ("xml", "tei"):
-        return chunk_xml_general(content)
+        yield from iter_json_chunks(iter_text_pieces(text_file), token_budget, stats)
     elif ext in ("ttl", "turtle"):
-        return chunk_turtle(content)
+        # Not streamed: rdflib parses the whole document, as subjects can be described anywhere in it
+        yield from chunk_turtle(text_file.read(), token_budget)
     else:
-        return chunk_plain_text(content)
+        yield from iter_plain_text_chunks(iter_text_pieces(text_file), token_budget)
+
+
+def iter_plain_text_chunks(pieces: Iterable[str], token_budget: int) -> Iterator[str]:
+    """
+    chunk_plain_text() over text that arrives in pieces: whenever about two chunks worth
+    of text are buffered, all chunks but the last are yielded; the last one is split
+    again together with the text that follows.
+    """
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) > 8 * token_budget:
+            chunks = chunk_plain_text(buffer, token_budget)
+            yield from chunks[:-1]
+            buffer = chunks[-1] if chunks else ""
+    if buffer.strip():
+        yield from chunk_plain_text(buffer, token_budget)
+
+
+def iter_json_chunks(pieces: Iterable[str], token_budget: int, stats: dict = None) -> Iterator[str]:
+    """
+    chunk_json() over text that arrives in pieces. The items of a top-level array are
+    decoded one at a time; anything else is read completely and given to chunk_json().
+    Invalid JSON falls back to plain text, as in chunk_json(), if it is found before the first
+    chunk is complete; after that the chunks can't be taken back and json.JSONDecodeError is raised.
+    """
+    pieces = iter(pieces)
+    # The text read, kept until the first chunk is yielded
+    read = []
+
+    def recorded() -> Iterator[str]:
+        for piece in pieces:
+            if read is not None:
+                read.append(piece)
+            yield piece
+
+    buffer = ""
+    while not buffer.strip():
+        piece = next(pieces, None)
+        if piece is None:
+            return
+        buffer += piece
+
+    if not buffer.lstrip().startswith("["):
+        yield from chunk_json(buffer + "".join(pieces), token_budget, stats)
+        return
+
+    items = (json.dumps(item, ensure_ascii=False) for item in iter_json_array_items(buffer, recorded()))
+    try:
+        for chunk in iter_packed_units(items, token_budget, head="[", separator=", ", tail="]", stats=stats):
+            read = None
+            yield chunk
+    except json.JSONDecodeError:
+        if read is None:
+            raise
+        yield from iter_plain_text_chunks(itertools.chain([buffer], read, pieces), token_budget)
+
+
+def iter_json_array_items(buffer: str, pieces: Iterator[str]) -> Iterator:
+    """
+    Decode the items of the JSON array that starts in 'buffer' and continues in 'pieces'.
+    The decoded part of the buffer is only dropped when a piece is added, and an item that
+    continues in later pieces is decoded again once the text read of it has doubled,
+    so the work stays linear in the size of the array.
+    Raises json.JSONDecodeError if the array is not valid JSON, or if anything but whitespace follows it.
+    """
+    decoder = json.JSONDecoder()
+    pos = buffer.index("[") + 1
+    exhausted = False
+
+    def refill(at_least: int = 0) -> bool:
+        """
+        Drop the decoded part of the buffer and add one piece, or as many as it takes
+        to have 'at_least' characters that aren't decoded yet. False if there were no more.
+        """
+        nonlocal buffer, pos, exhausted
+        unread = [buffer[pos:]]
+        size = len(unread[0])
+        while len(unread) == 1 or size < at_least:
+            piece = next(pieces, None)
+            if piece is None:
+                exhausted = True
+                break
+            unread.append(piece)
+            size += len(piece)
+        buffer, pos = "".join(unread), 0
+        return len(unread) > 1
+
+    def next_char(end: bool = False) -> str:
+        """
+        Skip whitespace up to the next character, reading more pieces when needed.
+        "" at the end of the text if that is where it may 'end'.
+        """
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not refill():
+                if end:
+                    return ""
+                raise json.JSONDecodeError("Unterminated array", buffer, pos)
+
+    def close() -> None:
+        nonlocal pos
+        pos += 1
+        if next_char(end=True):
+            raise json.JSONDecodeError("Extra data", buffer, pos)
+
+    if next_char() == "]":
+        close()
+        return
+    while True:
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The item continues in the next pieces
+            if not refill(2 * (len(buffer) - pos)):
+                raise
+            continue
+        # A number at the end of the buffer may go on in the next piece, as in "1" + "2" or "1." + "5"
+        number = isinstance(item, (int, float)) and not buffer[end:].strip("0123456789.eE+-")
+        if number and not exhausted and refill():
+            continue
+        yield item
+        pos = end
+
+        char = next_char()
+        if char == "]":
+            close()
+            return
+        if char != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+        pos += 1
+        next_char()
+
+
+TEI_NAMESPACE = "http://www.tei-c.org/ns/1.0"
+MSDESC_TAG = f"{{{TEI_NAMESPACE}}}msDesc"
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
+# Characters to escape in attribute values, besides &, < and >
+ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+
+
+def iter_xml_chunks(xml_file, token_budget: int, stats: dict = None) -> Iterator[str]:
+    """
+    Streaming XML chunker: packs the units of iter_xml_units() into chunks of up to 'token_budget' tokens.
+    'xml_file' is a binary file, or a text file for XML that has been decoded already.
+    Falls back to plain text if the file is not XML at all.
+    """
+    state = {}
+    try:
+        yield from iter_packed_units(iter_xml_units(xml_file, state), token_budget, stats=stats)
+    except ET.ParseError:
+        if "root" in state:
+            raise
+        xml_file.seek(0)
+        text_file = xml_file if isinstance(xml_file, io.TextIOBase) else \
+            io.TextIOWrapper(xml_file, encoding="utf-8-sig", errors="replace")
+        yield from iter_plain_text_chunks(iter_text_pieces(text_file), token_budget)
+        return
+
+    # No units at all: the root is the only content
+    if state.get("root") is not None and not state["units"]:
+        entire_doc_str = serialize_element(state["root"], state["namespaces"])
+        if count_tokens(entire_doc_str, model) > token_budget:
+            yield from chunk_plain_text(entire_doc_str, token_budget)
+        else:
+            yield entire_doc_str
+
+
+def iter_xml_units(xml_file, state: dict = None) -> Iterator[str]:
+    """
+    Reads an XML file with iterparse and yields, as soon as its end tag has been read:
+    - every <msDesc> of a TEI document, or
+    - every top-level child of any other XML document.
+    A TEI document without any <msDesc> yields its top-level children too.
+    Elements are removed from the tree once done with, so only the unit being read
+    is kept in memory. Units keep the document's own namespace prefixes.
+    'state' receives the root element, the namespaces and the number of units.
+    """
+    if state is None:
+        state = {}
+    namespaces = state["namespaces"] = {}
+    state["units"] = 0
+    stack = []
+    tei = False
+    in_msdesc = 0
+
+    for event, item in ET.iterparse(xml_file, events=("start-ns", "start", "end")):
+        if event == "start-ns":
+            prefix, uri = item
+            namespaces.setdefault(uri, prefix)
+            continue
+        element = item
+        if event == "start":
+            if not stack:
+                state["root"] = element
+                tei = element.tag.startswith(f"{{{TEI_NAMESPACE}}}")
+            stack.append(element)
+            if element.tag == MSDESC_TAG:
+                in_msdesc += 1
+            continue
+
+        stack.pop()
+        if not stack:
+            break
+        parent = stack[-1]
+        if tei:
+            if element.tag == MSDESC_TAG:
+                in_msdesc -= 1
+                if in_msdesc == 0:
+                    state["units"] += 1
+                    yield serialize_element(element, namespaces)
+                    parent.remove(element)
+            elif in_msdesc == 0 and state["units"]:
+                # Headers and texts around the manuscript descriptions; kept until the
+                # first <msDesc>, in case there is none and the top-level children are the units
+                parent.remove(element)
+        elif len(stack) == 1:
+            state["units"] += 1
+            yield serialize_element(element, namespaces)
+            parent.remove(element)
+
+    root = state.get("root")
+    if tei and not state["units"] and root is not None:
+        for child in list(root):
+            state["units"] += 1
+            yield serialize_element(child, namespaces)
+            root.remove(child)
+
+
+def serialize_element(element: ET.Element, namespaces: dict[str, str]) -> str:
+    """
+    ET.tostring() of an element, but with the prefixes the document declared ('namespaces' maps
+    namespace URI to prefix, '' being the default namespace) instead of ns0, ns1, ...
+    The namespaces in use are declared on the element itself, so it can be parsed on its own.
+    The tail of the element is left out.
+    """
+    declared = {}  # prefix => namespace URI
+    qualified = {}  # (name, attribute) => prefixed name
+
+    def qualify(name: str, attribute: bool = False) -> str:
+        if name[:1] != "{":
+            return name
+        if (name, attribute) in qualified:
+            return qualified[name, attribute]
+        uri, local = name[1:].split("}", 1)
+        if uri == XML_NAMESPACE:
+            return f"xml:{local}"
+        prefix = namespaces.get(uri)
+        # Unprefixed attributes have no namespace, so those need a prefix even in the default namespace
+        if prefix is None or (attribute and not prefix) or declared.get(prefix, uri) != uri:
+            prefix = next((p for p, u in declared.items() if p and u == uri), None)
+            if prefix is None:
+                used = set(declared) | set(namespaces.values())
+                prefix = next(f"ns{n}" for n in itertools.count() if f"ns{n}" not in used)
+        declared[prefix] = uri
+        qualified[name, attribute] = f"{prefix}:{local}" if prefix else local
+        return qualified[name, attribute]
+
+    # Collect the prefixes first, so they can all be declared on the outermost element
+    for node in element.iter():
+        qualify(node.tag)
+        for name in node.attrib:
+            qualify(name, attribute=True)
+
+    parts = []
+
+    def write(node: ET.Element, default_namespace: str | None, declarations: str) -> None:
+        tag = qualify(node.tag)
+        if ":" not in tag:
+            namespace = declared.get("") if node.tag[:1] == "{" else None
+            if namespace != default_namespace:
+                declarations += f' xmlns="{escape(namespace or "", ATTRIBUTE_ENTITIES)}"'
+                default_namespace = namespace
+        attributes = "".join(
+            f' {qualify(name, attribute=True)}="{escape(value, ATTRIBUTE_ENTITIES)}"'
+            for name, value in node.attrib.items()
+        )
+        parts.append(f"<{tag}{declarations}{attributes}")
+        if node.text or len(node):
+            parts.append(">")
+            if node.text:
+                parts.append(escape(node.text))
+            for child in node:
+                write(child, default_namespace, "")
+                if child.tail:
+                    parts.append(escape(child.tail))
+            parts.append(f"</{tag}>")
+        else:
+            parts.append("/>")
+
+    declarations = "".join(
+        f' xmlns:{prefix}="{escape(uri, ATTRIBUTE_ENTITIES)}"' for prefix, uri in declared.items() if prefix
+    )
+    write(element, None, declarations)
+    return "".join(parts)
 
 
 ###############
 # Main function
 ###############
-def drop_classify(data):
-    raw_text = data.get("content", "")
-    extension = data.get("extension", "txt").lower().strip()
+def structure_chunk(chunk_text: str) -> str:
+    """
+    Send a single chunk to the Structurer and return its raw reply.
+    Safe to call from worker threads: every thread talks through its own
+    copy of the agents.
+    """
+    conversation_result = metered_chat(
+        thread_local_agent(data_drop_agent),
+        thread_local_agent(structurer_agent),
+        message=DATA_MESSAGE.format(chunk_text),
+        max_turns=1
+    )
+    # The structurer agent's final message is the last message => must be valid JSON (object or array)
+    return conversation_result.chat_history[-1]["content"]
 
-    # 1) Split the file into chunks
-    chunks = chunk_file_by_type(raw_text, extension)
 
-    # 2) Process each chunk sequentially, keeping both reply and chunk
-    results: list[tuple[str, str]] = []
-    for chunk_text in chunks:
-        conversation_result = data_drop_agent.initiate_chat(
-            recipient=structurer_agent,
-            message=f"Here is the data:\n{chunk_text}",
-            max_turns=1
-        )
-        # The structurer agent's final message is the last message => must be valid JSON (object or array)
-        final_msg = conversation_result.chat_history[-1]["content"]
-        results.append((final_msg, chunk_text))
+def structure_chunk_cached(chunk_text: str) -> tuple[str, bool]:
+    """
+    Like structure_chunk(), but a chunk that was structured before, with the same
+    Structurer prompt and model, is answered from the 'extractions' cache.
+    Returns (reply, from_cache). Only replies that parse as JSON are cached.
+    """
+    cache = get_cache("extractions")
+    ensure_prompt_version(cache, "drop_classify", prompt_version(structurer_agent.system_message))
+    key = reply_cache_key("drop_classify", structurer_agent.system_message, model, chunk_text)
 
-    # 3) Parse every agent reply into a flat list of (parsed_json, chunk_text)
-    parsed_sequence: list[tuple[dict, str]] = []
-    for structurer_json, chunk_text in results:
-        try:
-            parsed = json.loads(structurer_json)
-        except json.JSONDecodeError:
-            print("[WARNING] Could not parse Structurer JSON:\n", structurer_json)
+    reply = cache.get(key)
+    if reply is not None:
+        return reply, True
+
+    reply = structure_chunk(chunk_text)
+    try:
+        json.loads(reply)
+    except json.JSONDecodeError:
+        return reply, False
+    cache.set(key, reply, tag="drop_classify")
+    return reply, False
+
+
+def parse_structurer_reply(structurer_json: str) -> list[dict]:
+    """
+    The manuscripts in one Structurer reply: a JSON object or an array of them.
+    """
+    try:
+        parsed = json.loads(structurer_json)
+    except json.JSONDecodeError:
+        print("[WARNING] Could not parse Structurer JSON:\n", structurer_json)
+        return []
+
+    if isinstance(parsed, dict):
+        return [parsed]
+    elif isinstance(parsed, list):
+        return parsed
+    else:
+        print("[WARNING] Unexpected JSON shape:", type(parsed))
+        return []
+
+
+def normalize_manuscript_id(manuscript_id) -> str:
+    """
+    The manuscript_ID as compared between records: case and runs of whitespace don't matter.
+    """
+    return " ".join(str(manuscript_id).split()).casefold()
+
+
+# Key under which the merged fields of dict values are kept, among the other values of a field
+NESTED = object()
+# Key of an empty value, kept for fields that never get another one
+EMPTY = object()
+
+
+def collect_fields(fields: dict, source: dict) -> None:
+    """
+    Add the fields of a record to 'fields', which maps every field to its distinct values
+    (skip manuscript_ID). Dict values are merged field by field.
+    """
+    for key, val_src in source.items():
+        if key == "manuscript_ID":
             continue
 
-        if isinstance(parsed, dict):
-            parsed_sequence.append((parsed, chunk_text))
-        elif isinstance(parsed, list):
-            for item in parsed:
-                parsed_sequence.append((item, chunk_text))
+        values = fields.setdefault(key, {})
+        if val_src in (None, "", [], {}):
+            values.setdefault(EMPTY, val_src)
+        elif isinstance(val_src, dict):
+            collect_fields(values.setdefault(NESTED, {}), val_src)
         else:
-            print("[WARNING] Unexpected JSON shape:", type(parsed))
+            # Lists can't be dict keys; their JSON can
+            values.setdefault(json.dumps(val_src, sort_keys=True) if isinstance(val_src, list) else val_src, val_src)
 
-    # 4) Helper: merge source→target (skip manuscript_ID, skip empty values)
-    def merge_dicts_in_place(target: dict, source: dict) -> None:
-        for key, val_src in source.items():
-            if key == "manuscript_ID" or val_src in (None, "", [], {}):
-                continue
 
-            val_tgt = target.get(key)
-            if isinstance(val_src, dict) and isinstance(val_tgt, dict):
-                merge_dicts_in_place(val_tgt, val_src)
-            elif not val_tgt:
-                target[key] = val_src
-            elif val_tgt != val_src:
-                target[key] = f"{val_tgt} / {val_src}"
+def render_fields(fields: dict) -> dict:
+    """
+    The fields collected by collect_fields() as a record: a field with several distinct values
+    gets them joined as "a / b", in the order they were found; a field without any the empty value.
+    """
+    record = {}
+    for key, values in fields.items():
+        rendered = [render_fields(val) if value_key is NESTED else val
+                    for value_key, val in values.items() if value_key is not EMPTY]
+        if not rendered:
+            record[key] = values[EMPTY]
+        else:
+            record[key] = rendered[0] if len(rendered) == 1 else " / ".join(str(val) for val in rendered)
+    return record
 
-    # 5) Merge records, using chunk_text to build data_analyzed
-    merged_manuscripts: list[dict] = []
-    last_with_id: dict | None = None
 
-    for ms_dict, chunk_text in parsed_sequence:
-        has_id = bool(ms_dict.get("manuscript_ID") and str(ms_dict["manuscript_ID"]).strip())
+class ManuscriptAssembler:
+    """
+    Merges the records of the Structurer replies into manuscripts. Records are indexed by
+    their normalized manuscript_ID, so all records of a manuscript end up in one, wherever
+    they are in the file. Records without a manuscript_ID continue the last record with one.
+    Every field keeps its distinct values and data_analyzed its chunks, until a manuscript
+    is rendered, which keeps the work linear in the size of the replies.
+    A chunk text is kept by the manuscripts that came from it, until they are released.
+    """
+
+    def __init__(self):
+        self.manuscripts = []  # index => {"manuscript_ID" (as first found), "fields", "chunks"}
+        self.index_by_id = {}  # normalized manuscript_ID => index
+        self.chunk_count = 0
+        self.last_with_id: int | None = None
+
+    def add_reply(self, structurer_json: str, chunk_text: str) -> list[int]:
+        """
+        Merge the records of one reply, in chunk order; returns the indices of the manuscripts it changed.
+        """
+        chunk = self.chunk_count
+        self.chunk_count += 1
+        changed = {}
+        for ms_dict in parse_structurer_reply(structurer_json):
+            changed[self.add_record(ms_dict, chunk, chunk_text)] = None
+        return list(changed)
+
+    def add_record(self, ms_dict: dict, chunk: int, chunk_text: str) -> int:
+        manuscript_id = ms_dict.get("manuscript_ID")
+        has_id = bool(manuscript_id and str(manuscript_id).strip())
         if has_id:
-            #  initialize data_analyzed to this chunk
-            ms_dict["data_analyzed"] = chunk_text
-            merged_manuscripts.append(ms_dict)
-            last_with_id = ms_dict
+            index = self.index_by_id.get(normalize_manuscript_id(manuscript_id))
+            if index is None:
+                index = self.new_manuscript(ms_dict)
+                self.index_by_id[normalize_manuscript_id(manuscript_id)] = index
+            self.last_with_id = index
+        elif self.last_with_id is not None:
+            # Merge other fields into the manuscript the record continues
+            index = self.last_with_id
         else:
-            if last_with_id is not None:
-                # Merge other fields
-                merge_dicts_in_place(last_with_id, ms_dict)
-                # Append this chunk to data_analyzed
-                existing = last_with_id.get("data_analyzed", "")
-                last_with_id["data_analyzed"] = (existing + "\n" + chunk_text).strip()
-            else:
-                # No prior ID: treat this as its own record, but still record the chunk
-                ms_dict["data_analyzed"] = chunk_text
-                # Edge-case: first record has no ID
-                merged_manuscripts.append(ms_dict)
-
-    # 6) Return the merged list
-    return {"structured_data": merged_manuscripts}
+            # No prior ID: treat this as its own record, but still record the chunk
+            # Edge-case: first record has no ID
+            index = self.new_manuscript(ms_dict)
+
+        manuscript = self.manuscripts[index]
+        collect_fields(manuscript["fields"], ms_dict)
+        manuscript["chunks"][chunk] = chunk_text
+        return index
+
+    def new_manuscript(self, ms_dict: dict) -> int:
+        manuscript = {"fields": {}, "chunks": {}}
+        if "manuscript_ID" in ms_dict:
+            manuscript["manuscript_ID"] = ms_dict["manuscript_ID"]
+        self.manuscripts.append(manuscript)
+        return len(self.manuscripts) - 1
+
+    def render(self, index: int) -> dict:
+        """
+        The manuscript as returned to the frontend, with the chunks it came from as data_analyzed.
+        """
+        manuscript = self.manuscripts[index]
+        record = {"manuscript_ID": manuscript["manuscript_ID"]} if "manuscript_ID" in manuscript else {}
+        record.update(render_fields(manuscript["fields"]))
+        record["data_analyzed"] = "\n".join(manuscript["chunks"].values())
+        return record
+
+    def release(self, index: int) -> None:
+        """
+        Forget the chunk texts of a manuscript that has been sent. If a later chunk adds to it,
+        its data_analyzed only has the chunks from then on.
+        """
+        self.manuscripts[index]["chunks"].clear()
+
+    def render_all(self) -> list[dict]:
+        return [self.render(index) for index in range(len(self.manuscripts))]
+
+
+def iter_merged_manuscripts(results: Iterable[tuple[str, str]]) -> Iterator[tuple[int, dict]]:
+    """
+    Merge the (structurer reply, chunk text) pairs, in chunk order, into manuscripts,
+    yielding (index, manuscript) as soon as a manuscript is complete for now: after each reply,
+    every changed manuscript except the one the next records may continue.
+    A manuscript that a later chunk adds to is yielded again, under the same index, with
+    the chunks since it was last yielded as data_analyzed: the chunk texts of a manuscript
+    are let go once it is yielded. 'results' is consumed lazily.
+    """
+    assembler = ManuscriptAssembler()
+    changed = {}
+
+    for structurer_json, chunk_text in results:
+        for index in assembler.add_reply(structurer_json, chunk_text):
+            changed[index] = None
+        for index in [index for index in changed if index != assembler.last_with_id]:
+            del changed[index]
+            yield index, assembler.render(index)
+            assembler.release(index)
+
+    for index in changed:
+        yield index, assembler.render(index)
+        assembler.release(index)
+
+
+def merge_structured_results(results: Iterable[tuple[str, str]]) -> dict:
+    """
+    Turn the (structurer reply, chunk text) pairs, in chunk order,
+    into the merged list of manuscripts returned to the frontend.
+    """
+    assembler = ManuscriptAssembler()
+    for structurer_json, chunk_text in results:
+        assembler.add_reply(structurer_json, chunk_text)
+    return {"structured_data": assembler.render_all()}
+
+
+def structure_chunks(chunks: Iterable[str], max_workers: int = None, stats: dict = None) -> Iterator[tuple[str, str]]:
+    """
+    Yield the (structurer reply, chunk text) pairs in chunk order, while up to
+    'max_workers' chunks are processed concurrently. 'chunks' is consumed lazily,
+    so it may be a generator. Chunks that didn't change since an earlier upload come from the cache.
+    If 'stats' is given, 'chunks' and 'chunks_from_cache' are added to it as the chunks are consumed.
+    """
+    if max_workers is None:
+        max_workers = MAX_CONCURRENT_CHUNKS
+    if stats is not None:
+        stats.setdefault("chunks", 0)
+        stats.setdefault("chunks_from_cache", 0)
+
+    def structure(chunk_text):
+        reply, from_cache = structure_chunk_cached(chunk_text)
+        return reply, from_cache, chunk_text
 
+    for reply, from_cache, chunk_text in bounded_map(structure, chunks, max_workers):
+        if stats is not None:
+            stats["chunks"] += 1
+            stats["chunks_from_cache"] += from_cache
+        yield reply, chunk_text
 
+
+def drop_classify(data, max_workers: int = None, stats: dict = None):
+    """
+    Split an uploaded file into chunks, structure them and merge the replies into manuscripts.
+    If 'stats' is given, 'chunks_from_cache', 'duplicate_records' and 'duplicate_chunks' are added to it.
+    """
+    return merge_structured_results(structure_chunks(drop_classify_chunks(data, stats), max_workers, stats))
+
+
+def iter_drop_classify(data, max_workers: int = None, stats: dict = None) -> Iterator[tuple[int, dict]]:
+    """
+    Like drop_classify(), but yields (index, manuscript) for each merged manuscript as soon as
+    it is complete, while the later chunks are still being processed. A manuscript that a later
+    chunk adds to is yielded again with the same index; the last one yielded is final,
+    but for its data_analyzed, which only has the chunks since it was yielded before.
+    If 'stats' is given, 'chunks', 'chunks_from_cache', 'duplicate_records' and 'duplicate_chunks' are added to it.
+    """
+    # The replies come in chunk order, so the merge gives exactly the same result
+    # as processing the chunks one by one
+    yield from iter_merged_manuscripts(structure_chunks(drop_classify_chunks(data, stats), max_workers, stats))
+
+
+def drop_classify_chunks(data, stats: dict = None) -> Iterator[str]:
+    """
+    The chunks of the file in drop_classify's input, leaving out the ones that repeat earlier chunks.
+    """
+    raw_text = data.get("content", "")
+    extension = data.get("extension", "txt").lower().strip()
+    return iter_unique_chunks(chunk_file_by_type(raw_text, extension, stats), stats)
+
+
+def iter_drop_classify_file(binary_file, extension: str, max_workers: int = None, stats: dict = None) -> Iterator[tuple[int, dict]]:
+    """
+    Like iter_drop_classify(), but for an uploaded file, which is read and chunked
+    while the first chunks are already with the Structurer.
+    """
+    chunks = iter_unique_chunks(iter_file_chunks(binary_file, extension, stats=stats), stats)
+    yield from iter_merged_manuscripts(structure_chunks(chunks, max_workers, stats))
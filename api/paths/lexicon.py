@@ -0,0 +1,192 @@
+import re
+import unicodedata
+
+
+#######################
+# Normalization
+#######################
+
+# Words, numbers and ordinal markers such as "4°"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+°?")
+
+
+def normalize(text: str) -> str:
+    """
+    Case-fold and strip diacritics, e.g. "Vélin" => "velin", "Pergament" => "pergament".
+    The degree sign survives, because it distinguishes "4°" (quarto) from a plain number.
+    """
+    decomposed = unicodedata.normalize("NFKD", text.replace("º", "°"))
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return stripped.casefold()
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(normalize(text))
+
+
+#######################
+# Lexicons
+#######################
+
+# Words that may appear around a recognized term without changing its meaning,
+# e.g. "su pergamena", "parchment and paper", "in-4°"
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "on", "in", "with",   # English
+    "e", "ed", "o", "di", "del", "della", "su", "con",          # Italian
+    "und", "oder", "auf", "aus", "mit",                         # German
+    "et", "ou", "sur", "en", "avec", "du",                      # French
+    "op", "van", "met",                                         # Dutch
+    "y", "sobre",                                               # Spanish
+}
+
+# Per row field: canonical value (from valid_materials, valid_scripts, ...) => phrases
+# in several languages. Phrases are normalized and tokenized like the input.
+LEXICONS = {
+    "support_type": {
+        "parchment": [
+            "parchment", "pergamena", "pergamenaceo", "pergamenacea", "membrana", "membranaceo",
+            "membranacea", "membranaceus", "membranaceum", "membr", "pergament", "perkament",
+            "parchemin", "pergamino", "pergaminho",
+        ],
+        "vellum": ["vellum", "velin", "vitello", "kalbspergament"],
+        "paper": [
+            "paper", "carta", "cartaceo", "cartacea", "chartaceus", "chartaceum", "chart",
+            "papier", "papel",
+        ],
+        "papyrus": ["papyrus", "papiro"],
+        "silk": ["silk", "seta", "seide", "soie", "zijde", "seda"],
+        "sheepskin": ["sheepskin", "sheep skin", "pelle di pecora", "schafleder", "basane"],
+        "deerskin": ["deerskin", "deer skin", "pelle di cervo", "hirschleder"],
+        "pigskin": ["pigskin", "pig skin", "pelle di maiale", "schweinsleder", "peau de truie"],
+        "velvet": ["velvet", "velluto", "samt", "velours", "fluweel", "terciopelo"],
+        "satin": ["satin", "raso"],
+        "morocco": ["morocco", "marocchino", "maroquin", "saffian", "marokijn"],
+        "calico": ["calico"],
+        "canvas": ["canvas"],
+        "bark": ["bark", "birch bark", "corteccia"],
+        "palmLeaves": ["palm leaves", "palm leaf", "foglie di palma", "palmblatter", "feuilles de palmier"],
+        "marbledPaper": ["marbled paper", "carta marmorizzata", "marmorpapier", "papier marbre"],
+        "uterineVellum": ["uterine vellum"],
+        "russiaLeather": ["russia leather", "russian leather", "juchtenleder", "cuir de russie"],
+        "donkeySkin": ["donkey skin", "donkeyskin"],
+        "naturalGoatskin": ["natural goatskin"],
+        "roughSkin": ["rough skin"],
+    },
+    "handwriting_form": {
+        "textualis": [
+            "textualis", "littera textualis", "gothica textualis", "littera gothica textualis",
+            "gotica textualis", "textura", "gotische textura", "gotica libraria",
+        ],
+        "rotunda": ["rotunda", "rotonda", "littera rotunda", "gotica rotonda", "gothica rotunda"],
+        "cursiva": ["cursiva", "littera cursiva", "corsiva", "kursive", "cursive", "gotische kursive"],
+        "bastarda": ["bastarda", "littera bastarda", "batarde", "lettre batarde"],
+        "mercantesca": ["mercantesca", "minuscola mercantesca"],
+        "notarile": ["notarile", "minuscola notarile"],
+        "humanistic": [
+            "humanistic", "humanistic minuscule", "humanistica", "littera antiqua", "umanistica",
+            "minuscola umanistica", "humanistische minuskel", "humanistique",
+        ],
+        "uncial": ["uncial", "uncialis", "onciale", "unziale", "oncial", "onciaal"],
+        "halfUncial": ["half uncial", "halfuncial", "semiuncial", "semionciale", "semi onciale", "halbunziale", "semi oncial"],
+        "carolingianMinuscule": [
+            "carolingian minuscule", "caroline minuscule", "carolina", "minuscola carolina",
+            "karolingische minuskel", "minuscule caroline",
+        ],
+        "anglosaxonMinuscule": ["anglo saxon minuscule", "anglosaxon minuscule"],
+        "insularScript": ["insular", "insular script", "insular minuscule", "insulare"],
+        "beneventan": ["beneventan", "beneventana", "beneventana minuscola", "minuscola beneventana"],
+        "visigothic": ["visigothic", "visigotica", "westgotische schrift"],
+        "merovingian": ["merovingian", "merovingica", "merowingische schrift"],
+        "chanceryHand": ["chancery hand", "cancelleresca", "chancery"],
+        "cyrillicScript": ["cyrillic", "cyrillic script", "cirillico", "kyrillisch"],
+        "devanagari": ["devanagari"],
+        "naskh": ["naskh"],
+        "kufic": ["kufic", "cufico", "kufi"],
+        "maghrebi": ["maghrebi", "maghribi"],
+    },
+    "format": {
+        "folio": ["folio", "in folio", "2°", "2to", "fol", "in fol", "infolio"],
+        "quarto": ["quarto", "in quarto", "4°", "in 4", "in 4°", "4to", "quart", "in quart"],
+        "octavo": ["octavo", "in octavo", "ottavo", "in ottavo", "8°", "in 8", "in 8°", "8vo", "oktav"],
+        "duodecimo": ["duodecimo", "in duodecimo", "dodicesimo", "12°", "in 12", "in 12°", "12mo"],
+        "sextodecimo": ["sextodecimo", "in sextodecimo", "sedicesimo", "16°", "in 16", "in 16°", "16mo"],
+    },
+    "ink": {
+        "ironGallInk": [
+            "iron gall ink", "iron gall", "irongall ink", "inchiostro ferrogallico", "ferrogallico",
+            "eisengallustinte", "encre ferrogallique", "encre ferro gallique", "ijzergalinkt",
+        ],
+        "carbonInk": ["carbon ink", "carbon based ink", "inchiostro al carbonio", "russtinte", "encre au carbone"],
+        "redInk": ["red ink", "inchiostro rosso", "rote tinte", "encre rouge", "rode inkt", "tinta roja"],
+        "coloredInk": ["colored ink", "coloured ink", "inchiostro colorato", "farbige tinte", "encre de couleur"],
+        "copperGallInk": ["copper gall ink"],
+        "invisibleInk": ["invisible ink", "inchiostro simpatico"],
+        "organicInk": ["organic ink"],
+    },
+    "binding": {
+        "limpVellumBinding": ["limp vellum", "limp vellum binding", "limp parchment binding"],
+        "copticBinding": ["coptic binding", "legatura copta"],
+        "carolingianBinding": ["carolingian binding", "legatura carolingia"],
+        "romanesqueBinding": ["romanesque binding", "legatura romanica"],
+        "gothicBinding": ["gothic binding", "legatura gotica"],
+        "sewnOnCordsBinding": ["sewn on cords", "sewn on cords binding", "sewn on raised cords"],
+    },
+}
+
+# Values longer than this are descriptions rather than labels; leave them to the classifier
+MAX_TOKENS = 8
+
+
+def build_trie(lexicon: dict) -> dict:
+    """
+    Token trie over all phrases: { token: { token: { ..., None: canonical value } } }.
+    """
+    trie = {}
+    for canonical, phrases in lexicon.items():
+        for phrase in phrases:
+            node = trie
+            for token in tokenize(phrase):
+                node = node.setdefault(token, {})
+            node[None] = canonical
+    return trie
+
+
+TRIES = {key: build_trie(lexicon) for key, lexicon in LEXICONS.items()}
+
+
+def resolve(key: str, text: str) -> list[str] | None:
+    """
+    Resolve a short property value locally, e.g. resolve("format", "in-4°") => ["quarto"].
+    Every token must be part of a known phrase (longest match wins) or a stopword;
+    otherwise, or if nothing matched at all, returns None and the classifier has to decide.
+    """
+    trie = TRIES.get(key)
+    if trie is None:
+        return None
+
+    tokens = tokenize(text)
+    if not tokens or len(tokens) > MAX_TOKENS:
+        return None
+
+    values = []
+    i = 0
+    while i < len(tokens):
+        # Longest phrase starting at token i
+        node, match, match_end = trie, None, i
+        for j in range(i, len(tokens)):
+            node = node.get(tokens[j])
+            if node is None:
+                break
+            if None in node:
+                match, match_end = node[None], j + 1
+
+        if match is not None:
+            if match not in values:
+                values.append(match)
+            i = match_end
+        elif tokens[i] in STOPWORDS:
+            i += 1
+        else:
+            return None
+
+    return values or None
@@ -0,0 +1,106 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from autogen import ConversableAgent
+from autogen.agentchat.utils import gather_usage_summary
+
+
+class Meter:
+    """
+    LLM usage of one request or job chunk, added up over all its agent conversations.
+    Conversations may run in several threads at once, hence the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+        self.llm_cost = 0.0
+
+    def record(self, prompt_tokens: int, completion_tokens: int, llm_calls: int, llm_seconds: float, llm_cost: float) -> None:
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.llm_calls += llm_calls
+            self.llm_seconds += llm_seconds
+            self.llm_cost += llm_cost
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def as_fields(self) -> dict:
+        """
+        The totals as the usage fields of Activity and JobChunk.
+        """
+        with self.lock:
+            return {
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'llm_calls': self.llm_calls,
+                'llm_seconds': round(self.llm_seconds, 3),
+                'llm_cost': self.llm_cost,
+            }
+
+
+# The meter of the request being handled; bounded_map passes it on to its worker threads
+current_meter: ContextVar[Meter | None] = ContextVar('current_meter', default=None)
+
+
+@contextmanager
+def metering():
+    """
+    Record the usage of every metered_chat() in the block, including those in bounded_map threads:
+        with metering() as meter:
+            output = drop_classify(input)
+        log_activity(..., **meter.as_fields())
+    """
+    meter = Meter()
+    token = current_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        current_meter.reset(token)
+
+
+def usage_totals(agents: list[ConversableAgent]) -> tuple[int, int, float]:
+    """
+    (prompt tokens, completion tokens, cost in USD) the agents have used so far, over all models.
+    """
+    summary = gather_usage_summary(agents)["usage_excluding_cached_inference"]
+    prompt_tokens = sum(usage.get("prompt_tokens", 0) for model, usage in summary.items() if model != "total_cost")
+    completion_tokens = sum(usage.get("completion_tokens", 0) for model, usage in summary.items() if model != "total_cost")
+    return prompt_tokens, completion_tokens, summary.get("total_cost", 0)
+
+
+def metered_chat(sender: ConversableAgent, recipient: ConversableAgent, **kwargs):
+    """
+    sender.initiate_chat(recipient=recipient, **kwargs), recording its usage in the current meter.
+    The agents only keep running totals, so the usage of this conversation is the difference
+    before and after; use it with agents that belong to the current thread (thread_local_agent).
+    Every reply after the opening message is an LLM call.
+    """
+    meter = current_meter.get()
+    if meter is None:
+        return sender.initiate_chat(recipient=recipient, **kwargs)
+
+    before = usage_totals([sender, recipient])
+    start = time.perf_counter()
+    llm_calls = 0
+    try:
+        result = sender.initiate_chat(recipient=recipient, **kwargs)
+        llm_calls = max(0, len(result.chat_history) - 1)
+        return result
+    finally:
+        after = usage_totals([sender, recipient])
+        meter.record(
+            prompt_tokens=after[0] - before[0],
+            completion_tokens=after[1] - before[1],
+            llm_calls=llm_calls,
+            llm_seconds=time.perf_counter() - start,
+            llm_cost=after[2] - before[2],
+        )
@@ -3,16 +3,26 @@ from autogen import ConversableAgent
 from dotenv import load_dotenv
 import json
 
+from api.paths.caches import ensure_prompt_version, get_cache, prompt_version, reply_cache_key
+from api.paths.concurrency import bounded_map, thread_local_agent
+from api.paths.metering import metered_chat
+
 # Load environment variables
 load_dotenv()
 
+# Number of manuscript boxes structured at the same time,
+# and seconds a single box may wait for the LLM before it is reported as failed
+MAX_CONCURRENT_MANUSCRIPTS = int(os.getenv('SEND_MANUSCRIPTS_CONCURRENCY', '8'))
+MANUSCRIPT_TIMEOUT = int(os.getenv('SEND_MANUSCRIPTS_TIMEOUT', '300'))
+
 # LLM Configuration
 model = "gpt-3.5-turbo-16k"
 llm_config = {
     "model": model,
     "temperature": 0.0,
     "api_key": os.getenv('OPENAI_API_KEY'),
-    "cache": None
+    "cache": None,
+    "timeout": MANUSCRIPT_TIMEOUT
 }
 
 # --- Agents ---
@@ -121,10 +131,65 @@ structurer_agent = ConversableAgent(
 )
 
 
-def send_manuscipts(data):
+def structure_manuscript(manuscript_key, manuscript_value):
+    """
+    Runs one Analyzer -> Structurer conversation for a single manuscript box.
+    Returns ({ manuscript_key: "structured JSON" }, from_cache), or
+    ({ manuscript_key: { "error": "..." } }, False) if the conversation failed or timed out,
+    so one bad box doesn't fail the others.
+    A box that was structured before, with the same prompt and model, comes from the 'extractions' cache.
+    """
+    # ----- STEP A: Prepare the text for the Analyzer agent -----
+    analyzer_input_text = f"Here is the data for {manuscript_key}:\n\n{manuscript_value}\n\n"
+
+    cache = get_cache("extractions")
+    ensure_prompt_version(cache, "property_structuring", prompt_version(structurer_agent.system_message))
+    key = reply_cache_key("property_structuring", structurer_agent.system_message, model, analyzer_input_text)
+    cached = cache.get(key)
+    if cached is not None:
+        print(f"{manuscript_key} is unchanged, using the cached structure")
+        return {manuscript_key: cached}, True
+
+    print(f"Sending {manuscript_key} to Analyzer ({len(analyzer_input_text)} characters)")
+
+    try:
+        # ----- STEP B: Initiate the conversation with Analyzer, specifying that it should
+        #               forward the data to Structurer. -----
+        conversation_result = metered_chat(
+            thread_local_agent(analyzer_agent),
+            thread_local_agent(structurer_agent),
+            message=analyzer_input_text,
+            max_turns=1
+        )
+    except Exception as e:
+        print(f"[ERROR] Structuring {manuscript_key} failed: {e}")
+        return {manuscript_key: {"error": str(e)}}, False
+
+    # conversation_result contains the entire conversation (Analyzer + Structurer).
+    # We'll retrieve the Structurer's final response:
+    final_response = conversation_result.chat_history[-1]["content"]
+
+    # The Structurer's response usually ended with "STRUCTURING COMPLETE".
+    final_response_trimmed = final_response.rstrip("STRUCTURING COMPLETE")
+
+    # Only cache replies that parse, so a garbled one is asked again next time
+    try:
+        json.loads(final_response_trimmed)
+    except json.JSONDecodeError:
+        pass
+    else:
+        cache.set(key, final_response_trimmed, tag="property_structuring")
+
+    # ----- STEP C: Return the final structured JSON -----
+    # We store the result as something like: { "Manuscript1": "structured JSON" }
+    return {manuscript_key: final_response_trimmed}, False
+
+
+def send_manuscipts(data, max_workers: int = None, stats: dict = None):
     """
     Receives the text of the (potentially) multiple manuscript boxes from the frontend
     and sends them separately to the Agents for processing.
+    If 'stats' is given, 'chunks_from_cache' is added to it.
     """
     # 1. Read the incoming JSON data:
     # data might look like:
@@ -133,43 +198,20 @@ def send_manuscipts(data):
     #   "Manuscript2": "<manuscript> ... </manuscript>",
     #   ...
     # }
+    if max_workers is None:
+        max_workers = MAX_CONCURRENT_MANUSCRIPTS
 
-    # 2. We'll store individual structured results here:
+    # 2. Every manuscript box gets its own conversation with the Analyzer agent,
+    #    which then hands off to the Structurer agent. Up to max_workers boxes
+    #    are processed at the same time; the results keep the order of the input keys.
     results = []
+    chunks_from_cache = 0
+    for result, from_cache in bounded_map(lambda item: structure_manuscript(*item), data.items(), max_workers):
+        results.append(result)
+        chunks_from_cache += from_cache
 
-    # 3. For each manuscript key in the incoming data, we start a new conversation
-    #    with the Analyzer agent, which then hands off to the Structurer agent.
-    for manuscript_key, manuscript_value in data.items():
-        # ----- STEP A: Prepare the text for the Analyzer agent -----
-
-        # This is what is sent to the Analyzer agent:
-        analyzer_input_text = f"Here is the data for {manuscript_key}:\n\n{manuscript_value}\n\n"
-
-        # Show it in server logs so we can see EXACTLY how the text looks before sending.
-        print("\n----------")
-        print(f"Sending to Analyzer for {manuscript_key}:")
-        print(analyzer_input_text)
-        print("----------\n")
-
-        # ----- STEP B: Initiate the conversation with Analyzer, specifying that it should
-        #               forward the data to Structurer. -----
-        conversation_result = analyzer_agent.initiate_chat(
-            recipient=structurer_agent,
-            message=analyzer_input_text,
-            max_turns=1
-        )
-
-        # conversation_result contains the entire conversation (Analyzer + Structurer).
-        # We'll retrieve the Structurer's final response:
-        final_response = conversation_result.chat_history[-1]["content"]
-
-        # The Structurer's response usually ended with "STRUCTURING COMPLETE".
-        final_response_trimmed = final_response.rstrip("STRUCTURING COMPLETE")
-
-        # ----- STEP C: Append the final structured JSON to our results -----
-        # We store the result as something like: { "Manuscript1": "structured JSON" }
-        results.append({manuscript_key: final_response_trimmed})
-        print(results)
+    if stats is not None:
+        stats["chunks_from_cache"] = stats.get("chunks_from_cache", 0) + chunks_from_cache
 
-    # 4. Return all the results as a JSON array back to your frontend
+    # 3. Return all the results as a JSON array back to your frontend
     return {"structured_results": results}, 200
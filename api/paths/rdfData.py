@@ -2,11 +2,18 @@ import rdflib
 import re
 from rdflib.namespace import RDFS
 from autogen import ConversableAgent
-import requests
 import os
 from dotenv import load_dotenv
 from datetime import datetime
 import random
+from collections import namedtuple
+from typing import Iterator
+
+from api.paths import lexicon
+from api.paths.caches import ensure_prompt_version, get_cache, prompt_version
+from api.paths.concurrency import bounded_map, thread_local_agent
+from api.paths.metering import metered_chat
+from api.paths.sparql_client import SparqlClient
 
 # Load environment variables
 load_dotenv()
@@ -307,103 +314,154 @@ ink_classifier_agent = ConversableAgent(
 #  Agents with tools
 # ===============================
 
-def wikidata_query_with_mwapi(name: str) -> str:
-    query = f"""
-    SELECT ?item WHERE {{
-      SERVICE wikibase:mwapi {{
-        bd:serviceParam wikibase:endpoint "www.wikidata.org";
-                        wikibase:api "EntitySearch";
-                        mwapi:search "{name}";
-                        mwapi:language "en".
-        ?item wikibase:apiOutputItem mwapi:item.
-      }}
-      ?item wdt:P31 wd:Q5.  # must be a human
-    }}
-    LIMIT 1
-    """
-    # Now do the GET:
-    params = {
-        "query": query,
-        "format": "json"
-    }
-    endpoint = "https://query.wikidata.org/sparql"
-    try:
-        r = requests.get(endpoint, params=params, timeout=10)
-        data = r.json()
-        bindings = data.get("results", {}).get("bindings", [])
-        if bindings:
-            return bindings[0]["item"]["value"]
-    except Exception as e:
-        print(f"[mwapi tool] Error searching for '{name}': {e}")
-    return ""  # no match or error
+# SPARQL endpoint for the lookups; point it to a local stand-in for testing
+WIKIDATA_SPARQL_ENDPOINT = os.getenv('WIKIDATA_SPARQL_ENDPOINT', "https://query.wikidata.org/sparql")
+
+# One client for all lookups of this process: pooled connections, retries with backoff,
+# at most WIKIDATA_RATE_LIMIT requests per second over all workers together, and
+# the latencies of the requests logged every WIKIDATA_LATENCY_LOG_SECONDS
+wikidata_client = SparqlClient(
+    WIKIDATA_SPARQL_ENDPOINT,
+    rate=float(os.getenv('WIKIDATA_RATE_LIMIT', '5')),
+    burst=int(os.getenv('WIKIDATA_RATE_BURST', '10')),
+    max_retries=int(os.getenv('WIKIDATA_MAX_RETRIES', '3')),
+    log_interval=float(os.getenv('WIKIDATA_LATENCY_LOG_SECONDS', '300'))
+)
 
+# Seconds a lookup is cached: found URIs, names without a match, and failed requests
+WIKIDATA_HIT_TTL = int(os.getenv('WIKIDATA_HIT_TTL', str(30 * 24 * 3600)))
+WIKIDATA_MISS_TTL = int(os.getenv('WIKIDATA_MISS_TTL', str(24 * 3600)))
+WIKIDATA_ERROR_TTL = int(os.getenv('WIKIDATA_ERROR_TTL', str(10 * 60)))
 
 
-names_wikidata_agent = ConversableAgent(
-    name="AuthorsWikidataAgent",
-    system_message="""
-    You are a 'Wikidata lookup' agent.
+def wikidata_cache_key(kind: str, term: str) -> str:
+    return f"{kind}|{' '.join(term.split())}"
 
-You receive a list of personal names (e.g., "Alice, Bob"), and for each name:
-  1) Call the function 'wikidata_query_with_mwapi' exactly once.
-  2) If there's a Wikidata URI, collect it (e.g., "http://www.wikidata.org/entity/Q999").
-  3) If no URI is found, collect nothing for that name.
 
-At the end:
-  - If you found one or more URIs, output them in a single comma-separated line, e.g.:
-       http://www.wikidata.org/entity/Q999, http://www.wikidata.org/entity/Q123
-  - If none were found, output just the word "null".
+def store_wikidata_lookup(cache, kind: str, term: str, uri: str, error: Exception = None) -> None:
+    key = wikidata_cache_key(kind, term)
+    if error is not None:
+        cache.set(key, {"uri": "", "status": "error", "error": str(error)[:200]}, expire=WIKIDATA_ERROR_TTL, tag=kind)
+    elif uri:
+        cache.set(key, {"uri": uri, "status": "hit"}, expire=WIKIDATA_HIT_TTL, tag=kind)
+    else:
+        cache.set(key, {"uri": "", "status": "miss"}, expire=WIKIDATA_MISS_TTL, tag=kind)
 
-No extra commentary. No repeated lines. 
-Produce exactly one final message, then end immediately.
-""",
-    llm_config=llm_config,
-    is_termination_msg=lambda msg: False,
-    human_input_mode="NEVER"
-)
 
-# We register the function for LLM usage (the agent can “see” it and call it by name).
-names_wikidata_agent.register_for_llm(
-    name="wikidata_query_with_mwapi",
-    description="Queries Wikidata for an author name and returns a single URI or empty string"
-)(wikidata_query_with_mwapi)
+def cached_wikidata_lookup(kind: str, term: str, lookup) -> str:
+    """
+    Return the Wikidata URI for 'term' from the 'wikidata' cache, or call lookup(term)
+    and cache its answer. Found URIs are kept for WIKIDATA_HIT_TTL seconds; misses and
+    errors are cached as well ("negative caching"), but for a shorter time, so the same
+    unknown name doesn't cost a SPARQL request on every transform.
+    """
+    cache = get_cache("wikidata")
+    cached = cache.get(wikidata_cache_key(kind, term))
+    if cached is not None:
+        return cached["uri"]
 
-# The agent that actually executes the calls:
-user_proxy = ConversableAgent(
-    name="LocalUserProxy",
-    is_termination_msg=lambda msg: False,
-    human_input_mode="NEVER"
-)
+    try:
+        uri = lookup(term)
+    except Exception as e:
+        print(f"[{kind} lookup] Error searching for '{term}': {e}")
+        store_wikidata_lookup(cache, kind, term, "", error=e)
+        return ""
 
-# 3) Register the real Python function under the same name:
-user_proxy.register_for_execution(name="wikidata_query_with_mwapi")(wikidata_query_with_mwapi)
+    store_wikidata_lookup(cache, kind, term, uri)
+    return uri
 
 
-def wikidata_query_for_work(work_title: str = None) -> str:
-    """
-    Queries Wikidata for a creative/literary work **by title only**.
+# Number of names per batched SPARQL query
+WIKIDATA_BATCH_SIZE = int(os.getenv('WIKIDATA_BATCH_SIZE', '20'))
 
-    Returns:
-      - The matched work's URI (e.g. "http://www.wikidata.org/entity/QXXXX"), or
-      - An empty string if no match is found.
+
+def sparql_string(value: str) -> str:
+    """
+    Quote 'value' as a SPARQL string literal.
     """
-    #  TODO: check if importing the module is needed
-    import requests
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    return f'"{escaped}"'
 
-    # Trim whitespace
-    work_title = (work_title or "").strip()
 
-    # If no title, nothing to query
-    if not work_title:
-        return ""
+def query_persons(names: list[str]) -> dict:
+    """
+    SPARQL lookup of humans by name, with one request for all 'names'.
+    For every name the best ranked search result that is a human is returned.
+    Names without a match are left out.
+    Raises if the request fails.
+    """
+    values = " ".join(sparql_string(name) for name in names)
+    query = f"""
+    SELECT ?name ?item ?ordinal WHERE {{
+      VALUES ?name {{ {values} }}
+      SERVICE wikibase:mwapi {{
+        bd:serviceParam wikibase:endpoint "www.wikidata.org";
+                        wikibase:api "EntitySearch";
+                        mwapi:search ?name;
+                        mwapi:language "en".
+        ?item wikibase:apiOutputItem mwapi:item.
+        ?ordinal wikibase:apiOrdinal true.
+      }}
+      ?item wdt:P31 wd:Q5.  # must be a human
+    }}
+    """
+    best = {}
+    for binding in wikidata_client.query(query, timeout=30).get("results", {}).get("bindings", []):
+        name = binding["name"]["value"]
+        ordinal = int(binding.get("ordinal", {}).get("value", 0))
+        if name not in best or ordinal < best[name][0]:
+            best[name] = (ordinal, binding["item"]["value"])
+    return {name: uri for name, (_, uri) in best.items()}
+
 
+def resolve_persons(names: list[str]) -> dict:
+    """
+    Map every name to its Wikidata URI ("" if not found), without any LLM calls.
+    Names in the 'wikidata' cache are answered from there; the others are looked up
+    in batches of WIKIDATA_BATCH_SIZE, and the answers are cached like single lookups.
+    """
+    cache = get_cache("wikidata")
+    uris = {}
+    missing = []
+    for name in names:
+        cached = cache.get(wikidata_cache_key("person", name))
+        if cached is not None:
+            uris[name] = cached["uri"]
+        else:
+            missing.append(name)
+
+    queries = 0
+    for start in range(0, len(missing), WIKIDATA_BATCH_SIZE):
+        batch = missing[start:start + WIKIDATA_BATCH_SIZE]
+        queries += 1
+        error = None
+        try:
+            found = query_persons(batch)
+        except Exception as e:
+            print(f"[person lookup] Error searching for {len(batch)} names: {e}")
+            found, error = {}, e
+        for name in batch:
+            uris[name] = found.get(name, "")
+            store_wikidata_lookup(cache, "person", name, uris[name], error=error)
+
+    print(f"[person lookup] {len(names)} names, {len(names) - len(missing)} from cache, "
+          f"{len(missing)} looked up in {queries} queries")
+    return uris
+
+
+
+def query_work(work_title: str) -> str:
+    """
+    SPARQL lookup of a creative/literary work by title. Returns the URI or "" if there
+    is no match; raises if the request fails.
+    """
     # Title-only query: checks for an entity that is (or subclasses) a "creative work" (Q47461344)
     query = f"""
     SELECT ?work WHERE {{
       SERVICE wikibase:mwapi {{
         bd:serviceParam wikibase:endpoint "www.wikidata.org";
                         wikibase:api "EntitySearch";
-                        mwapi:search "{work_title}";
+                        mwapi:search {sparql_string(work_title)};
                         mwapi:language "en".
         ?work wikibase:apiOutputItem mwapi:item.
       }}
@@ -412,20 +470,29 @@ def wikidata_query_for_work(work_title: str = None) -> str:
     LIMIT 1
     """
 
-    endpoint = "https://query.wikidata.org/sparql"
-    params = {"query": query, "format": "json"}
+    bindings = wikidata_client.query(query, timeout=10).get("results", {}).get("bindings", [])
+    if bindings:
+        # Return the first match's URI (e.g. "http://www.wikidata.org/entity/QXXXX")
+        return bindings[0]["work"]["value"]
+    return ""
 
-    try:
-        response = requests.get(endpoint, params=params, timeout=10)
-        data = response.json()
-        bindings = data.get("results", {}).get("bindings", [])
-        if bindings:
-            # Return the first match's URI (e.g. "http://www.wikidata.org/entity/QXXXX")
-            return bindings[0]["work"]["value"]
-    except Exception as e:
-        print(f"[work lookup] Error searching for '{work_title}': {e}")
 
-    return ""
+def wikidata_query_for_work(work_title: str = None) -> str:
+    """
+    Queries Wikidata for a creative/literary work **by title only**.
+
+    Returns:
+      - The matched work's URI (e.g. "http://www.wikidata.org/entity/QXXXX"), or
+      - An empty string if no match is found.
+    """
+    # Trim whitespace
+    work_title = (work_title or "").strip()
+
+    # If no title, nothing to query
+    if not work_title:
+        return ""
+
+    return cached_wikidata_lookup("work", work_title, query_work)
 
 
 works_wikidata_agent = ConversableAgent(
@@ -529,6 +596,186 @@ def safe_uri_or_none(candidate: str) -> str:
     return ""
 
 
+# ===============================
+# Property classification
+# ===============================
+
+# Number of presenter -> classifier chats running at the same time, over the manuscripts classified together
+MAX_CONCURRENT_CLASSIFICATIONS = int(os.getenv('RDF_CLASSIFIER_CONCURRENCY', '8'))
+
+# Manuscripts classified together before their graphs are streamed by iter_rdf(); each has up to
+# len(PROPERTY_CLASSIFIERS) chats, so the default keeps MAX_CONCURRENT_CLASSIFICATIONS busy
+RDF_STREAM_WINDOW = int(os.getenv('RDF_STREAM_WINDOW', '4'))
+
+PropertyClassifier = namedtuple(
+    "PropertyClassifier", ["key", "presenter", "classifier", "valid_values", "predicate", "label"]
+)
+
+# The row field, agents, accepted answers and ms4ai predicate of every classified property
+PROPERTY_CLASSIFIERS = [
+    PropertyClassifier("support_type", support_presenter_agent, material_classifier_agent,
+                       valid_materials, "hasSupport", "SUPPORT"),
+    PropertyClassifier("handwriting_form", script_presenter_agent, script_classifier_agent,
+                       valid_scripts, "hasScript", "SCRIPT"),
+    PropertyClassifier("decorations", decorations_presenter_agent, decorations_classifier_agent,
+                       valid_decorations, "hasDecoration", "DECORATIONS"),
+    PropertyClassifier("format", format_presenter_agent, format_classifier_agent,
+                       valid_formats, "hasFormat", "FORMAT"),
+    PropertyClassifier("binding", binding_presenter_agent, binding_classifier_agent,
+                       valid_bindings, "hasBinding", "BINDING"),
+    PropertyClassifier("ink", ink_presenter_agent, ink_classifier_agent,
+                       valid_inks, "hasInk", "INK"),
+]
+
+
+def classify_property(spec: PropertyClassifier, value: str) -> str:
+    """
+    Single-turn presenter -> classifier chat for one property value.
+    Returns the classifier's final reply, e.g. "parchment, paper" or "null".
+    """
+    conversation = metered_chat(
+        thread_local_agent(spec.presenter),
+        thread_local_agent(spec.classifier),
+        message=f"Guess what is this data about? [DATA: {value}]",
+        max_turns=1
+    )
+    final_msg = conversation.chat_history[-1]["content"].strip()
+
+    # Log the conversation in one go, so concurrent chats don't interleave
+    lines = [f"\n=== {spec.label} CONVERSATION ==="]
+    for turn in conversation.chat_history:
+        who = turn.get("sender") or turn.get("role") or "unknown"
+        lines.append(f"{who} => {turn.get('content', '')}")
+    lines.append(f"=== END {spec.label} ===")
+    lines.append(f"[DEBUG] {spec.key}='{value}', classifier_reply='{final_msg}'\n")
+    print("\n".join(lines))
+
+    return final_msg
+
+
+def classifier_cache_key(spec: PropertyClassifier, value: str) -> str:
+    """
+    Cache key of a classification: (classifier, normalized input, prompt version, model).
+    """
+    classifier = spec.classifier
+    normalized = " ".join(lexicon.normalize(value).split())
+    return "|".join([
+        classifier.name,
+        prompt_version(classifier.system_message),
+        classifier.llm_config["model"],
+        normalized
+    ])
+
+
+def classify_properties(rows: list[dict], stats: dict = None) -> dict:
+    """
+    Classify every property of every manuscript row. Values the lexicon recognizes
+    are resolved locally, earlier answers come from the 'classifications' cache,
+    and the rest go to the classifier agents, with up to
+    MAX_CONCURRENT_CLASSIFICATIONS chats running at the same time.
+    Returns { (row index, PROPERTY_CLASSIFIERS index): classifier reply }.
+    If 'stats' is given, 'llm_calls_avoided' (lexicon) and 'classifier_cache_hits' are added to it.
+    """
+    cache = get_cache("classifications")
+    for spec in PROPERTY_CLASSIFIERS:
+        ensure_prompt_version(cache, spec.classifier.name, prompt_version(spec.classifier.system_message))
+
+    replies = {}
+    resolved_count = 0
+    cache_hits = 0
+    # cache key => (PROPERTY_CLASSIFIERS index, value), and the cells waiting for that answer
+    tasks = {}
+    waiting = {}
+    for ms_index, row in enumerate(rows):
+        for spec_index, spec in enumerate(PROPERTY_CLASSIFIERS):
+            value = (row.get(spec.key) or "").strip()
+            if not value:
+                continue
+
+            resolved = lexicon.resolve(spec.key, value)
+            if resolved is not None:
+                print(f"[DEBUG] {spec.key}='{value}', lexicon={resolved}")
+                replies[(ms_index, spec_index)] = ", ".join(resolved)
+                resolved_count += 1
+                continue
+
+            key = classifier_cache_key(spec, value)
+            if key in tasks:
+                # Same value earlier in this request: one chat answers both
+                waiting[key].append((ms_index, spec_index))
+                cache_hits += 1
+                continue
+
+            cached = cache.get(key)
+            if cached is not None:
+                replies[(ms_index, spec_index)] = cached
+                cache_hits += 1
+            else:
+                tasks[key] = (spec_index, value)
+                waiting[key] = [(ms_index, spec_index)]
+
+    if stats is not None:
+        stats["llm_calls_avoided"] = stats.get("llm_calls_avoided", 0) + resolved_count
+        stats["classifier_cache_hits"] = stats.get("classifier_cache_hits", 0) + cache_hits
+
+    def classify_and_cache(item):
+        key, (spec_index, value) = item
+        spec = PROPERTY_CLASSIFIERS[spec_index]
+        reply = classify_property(spec, value)
+        cache.set(key, reply, tag=spec.classifier.name)
+        return reply
+
+    llm_replies = bounded_map(classify_and_cache, tasks.items(), MAX_CONCURRENT_CLASSIFICATIONS)
+    for key, reply in zip(tasks, llm_replies):
+        for cell in waiting[key]:
+            replies[cell] = reply
+    return replies
+
+
+def classified_items(reply: str, valid_values: set) -> list[str]:
+    """
+    Split a comma-separated classifier reply and keep only the recognized values.
+    """
+    if reply == "null":
+        return []
+    return [item.strip() for item in reply.split(",") if item.strip() in valid_values]
+
+
+# ===============================
+# Person names
+# ===============================
+
+# Row field => ms4ai predicate linking the manuscript to the person's Wikidata URI
+PERSON_ROLES = [
+    ("authors", "hasAttributedAuthor"),
+    ("copyists", "hasAttributedCopyist"),
+    ("miniaturists", "hasAttributedMiniaturist"),
+    ("bookbinders", "hasAttributedBookbinder"),
+    ("illuminators", "hasAttributedIlluminator"),
+    ("rubricators", "hasAttributedRubricator"),
+]
+
+
+def split_names(value) -> list[str]:
+    """
+    "Alice, Bob" => ["Alice", "Bob"], with the whitespace inside each name collapsed.
+    """
+    names = [" ".join(name.split()) for name in (value or "").split(",")]
+    return [name for name in names if name]
+
+
+def collect_person_names(rows: list[dict]) -> list[str]:
+    """
+    All distinct person names over all manuscripts and roles, in order of appearance.
+    """
+    names = {}
+    for row in rows:
+        for key, _ in PERSON_ROLES:
+            for name in split_names(row.get(key)):
+                names[name] = True
+    return list(names)
+
+
 # ===============================
 # 4) RDF + Classification Logic
 # ===============================
@@ -539,21 +786,70 @@ def sanitize_for_uri(value: str) -> str:
     return re.sub(r'[^A-Za-z0-9_-]+', '', value)
 
 
-def transform_data_into_rdf(data):
+# Namespaces
+EX = rdflib.Namespace("http://example.org/")
+RDF_ = rdflib.Namespace("http://www.w3.org/1999/02/22-rdf-syntax-ns#")
+XSD = rdflib.Namespace("http://www.w3.org/2001/XMLSchema#")
+MS4AI = rdflib.Namespace("http://ontology.tno.nl/manuscriptAI/")
+
+# Prefixes of the Turtle output
+PREFIXES = {
+    "ex": EX,
+    "rdf": RDF_,
+    "rdfs": rdflib.Namespace(str(RDFS)),
+    "xsd": XSD,
+    "ms4ai": MS4AI,
+}
+
+
+def new_graph() -> rdflib.Graph:
     g = rdflib.Graph()
+    for prefix, namespace in PREFIXES.items():
+        g.namespace_manager.bind(prefix, namespace)
+    return g
+
+
+def transform_data_into_rdf(data, stats: dict = None):
+    g = new_graph()
+    for ms_graph in iter_manuscript_graphs(data, stats):
+        g += ms_graph
+    return g.serialize(format="turtle")
 
-    # Namespaces
-    EX = rdflib.Namespace("http://example.org/")
-    RDF_ = rdflib.Namespace("http://www.w3.org/1999/02/22-rdf-syntax-ns#")
-    XSD = rdflib.Namespace("http://www.w3.org/2001/XMLSchema#")
-    MS4AI = rdflib.Namespace("http://ontology.tno.nl/manuscriptAI/")
 
-    # Bind prefixes
-    g.namespace_manager.bind("ex", EX)
-    g.namespace_manager.bind("rdf", RDF_)
-    g.namespace_manager.bind("xsd", XSD)
-    g.namespace_manager.bind("ms4ai", MS4AI)
+def iter_rdf(data, rdf_format: str = "turtle", stats: dict = None) -> Iterator[str]:
+    """
+    Serialize the RDF of transform_data_into_rdf() piece by piece, one manuscript at a time,
+    as N-Triples ("nt") or Turtle. The Turtle prefixes come first, so the first piece is sent
+    before anything is classified; a prefix used by a manuscript but not declared yet
+    is declared right before it. Together the pieces parse to the same graph.
+    The manuscripts are classified RDF_STREAM_WINDOW at a time.
+    """
+    declared = set()
+    if rdf_format == "turtle":
+        header = [f"@prefix {prefix}: <{namespace}> ." for prefix, namespace in PREFIXES.items()]
+        declared.update(header)
+        yield "\n".join(header) + "\n\n"
+
+    for ms_graph in iter_manuscript_graphs(data, stats, RDF_STREAM_WINDOW):
+        if rdf_format == "nt":
+            yield ms_graph.serialize(format="nt")
+            continue
+
+        lines = ms_graph.serialize(format="turtle").splitlines()
+        prefixes = [line for line in lines if line.startswith("@prefix ")]
+        triples = [line for line in lines if not line.startswith("@prefix ")]
+        new_prefixes = [line for line in prefixes if line not in declared]
+        declared.update(new_prefixes)
+        yield "\n".join(new_prefixes + triples).strip("\n") + "\n\n"
 
+
+def iter_manuscript_graphs(data, stats: dict = None, window_size: int = None) -> Iterator[rdflib.Graph]:
+    """
+    Yield a graph with the triples of every manuscript in 'data', in order, once they are complete.
+    All manuscripts are classified and their persons looked up together, or with 'window_size'
+    a window of that many at a time, whose graphs are yielded before the next window is started.
+    If 'stats' is given, 'llm_calls_avoided' and 'classifier_cache_hits' are added to it.
+    """
     def add_if_present_literal(graph, subj, pred, key, row):
         """
         If row[key] exists and is not empty, add triple (subj, pred, that_value).
@@ -575,430 +871,87 @@ def transform_data_into_rdf(data):
         graph.add((locus_uri, MS4AI.concernsFeature, feature_uri))
         graph.add((locus_uri, MS4AI.includesText, rdflib.Literal(text_val, datatype=XSD.string)))
 
-    # Process each manuscript
-    for manuscript in data:
-        row = manuscript.get("data", {})
-        ms_id = row.get("manuscript_ID")
-        if not ms_id:
-            # Skip if no ID
-            continue
-
-        cleaned_id = sanitize_for_uri(ms_id)
-        ms_node = EX[cleaned_id]
-
-        # Mark as ms4ai:Manuscript + shelfmark
-        g.add((ms_node, RDF_.type, MS4AI.Manuscript))
-        g.add((ms_node, MS4AI.shelfmark, rdflib.Literal(ms_id, datatype=XSD.string)))
-
-        # Add standard fields
-        add_if_present_literal(g, ms_node, MS4AI.attributedDate, "century_of_creation", row)
-        add_if_present_literal(g, ms_node, MS4AI.width, "dimensions_of_the_manuscript.width", row)
-        add_if_present_literal(g, ms_node, MS4AI.length, "dimensions_of_the_manuscript.length", row)
-        add_if_present_literal(g, ms_node, MS4AI.thickness, "dimensions_of_the_manuscript.thickness", row)
-        add_if_present_literal(g, ms_node, MS4AI.containedWork, "contained_works", row)
-        add_if_present_literal(g, ms_node, MS4AI.attributedAuthor, "authors", row)
-        add_if_present_literal(g, ms_node, MS4AI.attributedCopyist, "copyists", row)
-        add_if_present_literal(g, ms_node, MS4AI.attributedMiniaturist, "miniaturists", row)
-        add_if_present_literal(g, ms_node, MS4AI.attributedBookbinder, "bookbinders", row)
-        add_if_present_literal(g, ms_node, MS4AI.attributedIlluminator, "illuminators", row)
-        add_if_present_literal(g, ms_node, MS4AI.attributedRubricator, "rubricators", row)
-        add_if_present_literal(g, ms_node, MS4AI.conservationIntervention, "restoration_history", row)
-        add_if_present_literal(g, ms_node, MS4AI.historyOfOwnership, "ownership_history", row)
-        add_if_present_literal(g, ms_node, MS4AI.support, "support_type", row)
-        add_if_present_literal(g, ms_node, MS4AI.script, "handwriting_form", row)
-        add_if_present_literal(g, ms_node, MS4AI.includesDecoration, "decorations", row)
-        add_if_present_literal(g, ms_node, MS4AI.foliaCount, "total_folia_count", row)
-        add_if_present_literal(g, ms_node, MS4AI.ink, "ink", row)
-        add_if_present_literal(g, ms_node, MS4AI.binding, "binding", row)
-        add_if_present_literal(g, ms_node, MS4AI["format"], "format", row)
-
-        # rdfs:comment from additional_notes
-        notes_val = row.get("additional_notes", "")
-        if notes_val:
-            g.add((ms_node, RDFS.comment, rdflib.Literal(notes_val, datatype=XSD.string)))
-
-        # incipit => locus
-        incipit_val = row.get("incipit")
-        if incipit_val:
-            add_locus(g, ms_node, cleaned_id, MS4AI.incipit, "incipit", incipit_val)
-
-        # explicit => locus
-        explicit_val = row.get("explicit")
-        if explicit_val:
-            add_locus(g, ms_node, cleaned_id, MS4AI.explicit, "explicit", explicit_val)
-
-        # Classification if support_type is present and not empty
-        raw_support = row.get("support_type")
-        if raw_support:
-            support_val = raw_support.strip()  # avoids NoneType error
-            if support_val:
-                # 2-agent approach: single-turn
-                conversation_result = support_presenter_agent.initiate_chat(
-                    recipient=material_classifier_agent,
-                    message=f"Guess what is this data about? [DATA: {support_val}]",
-                    max_turns=1
-                )
-
-                # The classifier's final message
-                final_msg = conversation_result.chat_history[-1]["content"].strip()
-
-                print("\n=== FULL CONVERSATION ===")
-                for turn in conversation_result.chat_history:
-                    role = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{role} => {text}")
-                print("=== END OF CONVERSATION ===")
-
-                print(f"[DEBUG] support='{support_val}', classifier_reply='{final_msg}'")
-
-                # if final_msg is in valid_materials => add triple
-                if final_msg != "null":
-                    # Split by commas to allow multiple recognized items
-                    splitted_items = [x.strip() for x in final_msg.split(",")]
-                    for mat_item in splitted_items:
-                        if mat_item in valid_materials:
-                            mat_node = rdflib.URIRef(f"{MS4AI}{mat_item}")
-                            g.add((ms_node, MS4AI.hasSupport, mat_node))
-                        # else => skip unknown items
-
-        # If handwriting_form is present => classify with script
-        raw_script = row.get("handwriting_form")
-        if raw_script:
-            script_val = raw_script.strip()
-            if script_val:
-                # Single-turn conversation
-                conv_script = script_presenter_agent.initiate_chat(
-                    recipient=script_classifier_agent,
-                    message=f"Guess what is this data about? [DATA: {script_val}]",
-                    max_turns=1
-                )
-                final_script = conv_script.chat_history[-1]["content"].strip()
-
-                print("\n=== SCRIPT CONVERSATION ===")
-                for turn in conv_script.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END SCRIPT ===\n")
-
-                print(f"[DEBUG] handwriting_form='{script_val}', classifier_reply='{final_script}'")
-
-                if final_script != "null":
-                    # Split on commas for multiple recognized items
-                    splitted_scripts = [x.strip() for x in final_script.split(",")]
-                    for scr_item in splitted_scripts:
-                        if scr_item in valid_scripts:
-                            g.add((ms_node, MS4AI.hasScript, rdflib.URIRef(f"{MS4AI}{scr_item}")))
-                        # else => skip unrecognized
-
-        raw_decorations = row.get("decorations")
-        if raw_decorations:
-            decor_val = raw_decorations.strip()
-            if decor_val:
-                conv_decor = decorations_presenter_agent.initiate_chat(
-                    recipient=decorations_classifier_agent,
-                    message=f"Guess what is this data about? [DATA: {decor_val}]",
-                    max_turns=1
-                )
-                final_decor = conv_decor.chat_history[-1]["content"].strip()
-
-                print("\n=== DECORATIONS CONVERSATION ===")
-                for turn in conv_decor.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END DECORATIONS ===\n")
-
-                if final_decor != "null":
-                    splitted = [x.strip() for x in final_decor.split(",")]
-                    for deco_item in splitted:
-                        if deco_item in valid_decorations:
-                            g.add((ms_node, MS4AI.hasDecoration, rdflib.URIRef(f"{MS4AI}{deco_item}")))
-                        # else => skip
-
-        raw_format = row.get("format")
-        if raw_format:
-            format_val = raw_format.strip()
-            if format_val:
-                conv_format = format_presenter_agent.initiate_chat(
-                    recipient=format_classifier_agent,
-                    message=f"Guess what is this data about? [DATA: {format_val}]",
-                    max_turns=1
-                )
-                final_format = conv_format.chat_history[-1]["content"].strip()
-
-                print("\n=== FORMAT CONVERSATION ===")
-                for turn in conv_format.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END FORMAT ===\n")
-
-                if final_format != "null":
-                    splitted = [x.strip() for x in final_format.split(",")]
-                    for fmt in splitted:
-                        if fmt in valid_formats:
-                            g.add((ms_node, MS4AI.hasFormat, rdflib.URIRef(f"{MS4AI}{fmt}")))
-                        # else => skip
-
-        raw_binding = row.get("binding")
-        if raw_binding:
-            bind_val = raw_binding.strip()
-            if bind_val:
-                conv_bind = binding_presenter_agent.initiate_chat(
-                    recipient=binding_classifier_agent,
-                    message=f"Guess what is this data about? [DATA: {bind_val}]",
-                    max_turns=1
-                )
-                final_bind = conv_bind.chat_history[-1]["content"].strip()
-
-                print("\n=== BINDING CONVERSATION ===")
-                for turn in conv_bind.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END BINDING ===\n")
-
-                if final_bind != "null":
-                    splitted = [x.strip() for x in final_bind.split(",")]
-                    for bItem in splitted:
-                        if bItem in valid_bindings:
-                            g.add((ms_node, MS4AI.hasBinding, rdflib.URIRef(f"{MS4AI}{bItem}")))
-
-        # Ink classification
-        raw_ink = row.get("ink")
-        if raw_ink:
-            ink_val = raw_ink.strip()
-            if ink_val:
-                conv_ink = ink_presenter_agent.initiate_chat(
-                    recipient=ink_classifier_agent,
-                    message=f"Guess what is this data about? [DATA: {ink_val}]",
-                    max_turns=1
-                )
-                final_ink = conv_ink.chat_history[-1]["content"].strip()
-
-                print("\n=== INK CONVERSATION ===")
-                for turn in conv_ink.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END INK ===\n")
-
-                if final_ink != "null":
-                    splitted = [x.strip() for x in final_ink.split(",")]
-                    for ink_item in splitted:
-                        if ink_item in valid_inks:
-                            g.add((ms_node, MS4AI.hasInk, rdflib.URIRef(f"{MS4AI}{ink_item}")))
-                        # else skip
-
-
-        # authors wikidata classification
-        # Extract author field
-        raw_authors = (row.get("authors", "") or "").strip()
-        # Only proceed if we actually have authors
-        if raw_authors:
-            # Split authors on comma
-            authors_list = [auth.strip() for auth in raw_authors.split(",")]
-
-            # For each individual author, perform a separate lookup
-            for author_name in authors_list:
-
-
-                # Initiate the conversation for this single author
-                conv_auth = user_proxy.initiate_chat(
-                    recipient=names_wikidata_agent,
-                    message=f"Please do a Wikidata lookup for: [AUTHOR_LIST: {author_name}] using the function 'wikidata_query_with_mwapi'",
-                    max_turns=2
-                )
-
-                # Use the helper to retrieve final URIs from the conversation
-                final_uris = get_last_nonempty_content_excluding_tools(conv_auth)
-                if not final_uris:
-                    final_uris = "null"
-                else:
-                    final_uris = final_uris.strip()
-
-                # Print out the conversation details for debugging or logging
-                print("\n=== AUTHORS WIKIDATA CONVERSATION ===")
-                for turn in conv_auth.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END AUTHORS CONVERSATION ===\n")
-
-                # If URIs were found, add them to your graph
-                if final_uris.lower() != "null":
-                    splitted = [uri.strip() for uri in final_uris.split(",")]
-                    for u in splitted:
-                        g.add((ms_node, MS4AI.hasAttributedAuthor, rdflib.URIRef(u)))
-
-        # Copyists
-        # Handle copyists in a similar way to authors
-        raw_copyists = (row.get("copyists", "") or "").strip()
-
-        # Only proceed if we actually have copyists
-        if raw_copyists:
-            # Split copyists on comma
-            copyists_list = [c.strip() for c in raw_copyists.split(",")]
-
-            # For each individual copyist, perform a separate lookup
-            for copyist_name in copyists_list:
-                # Estimate max turns for this single copyist
-
-                conv_copyists = user_proxy.initiate_chat(
-                    recipient=names_wikidata_agent,
-                    message=f"Please do a Wikidata lookup for: [COPYISTS_LIST: {copyist_name}] using the function 'wikidata_query_with_mwapi'",
-                    max_turns=2
-                )
-
-                final_uris_copyists = get_last_nonempty_content_excluding_tools(conv_copyists)
-                if not final_uris_copyists:
-                    final_uris_copyists = "null"
-                else:
-                    final_uris_copyists = final_uris_copyists.strip()
-
-
-                print("\n=== COPYISTS WIKIDATA CONVERSATION ===")
-                for turn in conv_copyists.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END COPYISTS CONVERSATION ===\n")
-
-
-                if final_uris_copyists.lower() != "null":
-                    splitted_copyists = [x.strip() for x in final_uris_copyists.split(",")]
-                    for uri in splitted_copyists:
-                        g.add((ms_node, MS4AI.hasAttributedCopyist, rdflib.URIRef(uri)))
-
-        # Miniaturists
-        raw_minis = (row.get("miniaturists", "") or "").strip()
-        if raw_minis:
-            # Split miniaturists on comma
-            minis_list = [m.strip() for m in raw_minis.split(",")]
-
-            # For each individual miniaturist, perform a separate lookup
-            for mini_name in minis_list:
-                conv_minis = user_proxy.initiate_chat(
-                    recipient=names_wikidata_agent,
-                    message=f"Please do a Wikidata lookup for: [MINIATURISTS_LIST: {mini_name}] using the function 'wikidata_query_with_mwapi'",
-                    max_turns=2
-                )
-
-                final_uris_minis = get_last_nonempty_content_excluding_tools(conv_minis)
-                if not final_uris_minis:
-                    final_uris_minis = "null"
-                else:
-                    final_uris_minis = final_uris_minis.strip()
-
-                # Log the conversation for debugging
-                print("\n=== MINIATURISTS WIKIDATA CONVERSATION ===")
-                for turn in conv_minis.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END MINIATURISTS CONVERSATION ===\n")
-
-
-                if final_uris_minis.lower() != "null":
-                    splitted_minis = [x.strip() for x in final_uris_minis.split(",")]
-                    for uri in splitted_minis:
-                        g.add((ms_node, MS4AI.hasAttributedMiniaturist, rdflib.URIRef(uri)))
-
-
-        # bookbinders
-        raw_binders = (row.get("bookbinders", "") or "").strip()
-        if raw_binders:
-            binders_list = [b.strip() for b in raw_binders.split(",")]
-            for binder_name in binders_list:
-                # Optionally estimate max turns for each binder (if you want different conversation lengths)
-                #dynamic_turns_binders = estimate_max_turns_for_works(binder_name)
-
-                conv_binders = user_proxy.initiate_chat(
-                    recipient=names_wikidata_agent,
-                    message=f"Please do a Wikidata lookup for: [BOOKBINDERS_LIST: {binder_name}] using the function 'wikidata_query_with_mwapi'",
-                    max_turns=2
-                )
-
-                final_uris_binders = get_last_nonempty_content_excluding_tools(conv_binders)
-                if not final_uris_binders:
-                    final_uris_binders = "null"
-                else:
-                    final_uris_binders = final_uris_binders.strip()
-
-                print("\n=== BOOKBINDERS WIKIDATA CONVERSATION ===")
-                for turn in conv_binders.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END BOOKBINDERS CONVERSATION ===\n")
-
-                if final_uris_binders.lower() != "null":
-                    splitted_binders = [x.strip() for x in final_uris_binders.split(",")]
-                    for uri in splitted_binders:
-                        g.add((ms_node, MS4AI.hasAttributedBookbinder, rdflib.URIRef(uri)))
-
-        # illuminators => hasAttributedIlluminator
-        raw_illums = (row.get("illuminators", "") or "").strip()
-        if raw_illums:
-            illums_list = [i.strip() for i in raw_illums.split(",")]
-            for illum_name in illums_list:
-                #dynamic_turns_illums = estimate_max_turns_for_works(illum_name)
-
-                conv_illums = user_proxy.initiate_chat(
-                    recipient=names_wikidata_agent,
-                    message=f"Please do a Wikidata lookup for: [ILLUMINATORS_LIST: {illum_name}] using the function 'wikidata_query_with_mwapi'",
-                    max_turns=2
-                )
-
-                final_uris_illums = get_last_nonempty_content_excluding_tools(conv_illums)
-                if not final_uris_illums:
-                    final_uris_illums = "null"
-                else:
-                    final_uris_illums = final_uris_illums.strip()
-
-                print("\n=== ILLUMINATORS WIKIDATA CONVERSATION ===")
-                for turn in conv_illums.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END ILLUMINATORS CONVERSATION ===\n")
-
-                if final_uris_illums.lower() != "null":
-                    splitted_illums = [x.strip() for x in final_uris_illums.split(",")]
-                    for uri in splitted_illums:
-                        g.add((ms_node, MS4AI.hasAttributedIlluminator, rdflib.URIRef(uri)))
-
-        # rubricators => hasAttributedRubricator
-        raw_rubrics = (row.get("rubricators", "") or "").strip()
-        if raw_rubrics:
-            rubrics_list = [r.strip() for r in raw_rubrics.split(",")]
-            for rubric_name in rubrics_list:
-                #dynamic_turns_rub = estimate_max_turns_for_works(rubric_name)
-
-                conv_rubrics = user_proxy.initiate_chat(
-                    recipient=names_wikidata_agent,
-                    message=f"Please do a Wikidata lookup for: [RUBRICATORS_LIST: {rubric_name}] using the function 'wikidata_query_with_mwapi'",
-                    max_turns=2
-                )
-
-                final_uris_rubrics = get_last_nonempty_content_excluding_tools(conv_rubrics)
-                if not final_uris_rubrics:
-                    final_uris_rubrics = "null"
-                else:
-                    final_uris_rubrics = final_uris_rubrics.strip()
-
-                print("\n=== RUBRICATORS WIKIDATA CONVERSATION ===")
-                for turn in conv_rubrics.chat_history:
-                    who = turn.get("sender") or turn.get("role") or "unknown"
-                    text = turn.get("content", "")
-                    print(f"{who} => {text}")
-                print("=== END RUBRICATORS CONVERSATION ===\n")
-
-                if final_uris_rubrics.lower() != "null":
-                    splitted_rubrics = [x.strip() for x in final_uris_rubrics.split(",")]
-                    for uri in splitted_rubrics:
-                        g.add((ms_node, MS4AI.hasAttributedRubricator, rdflib.URIRef(uri)))
+    # Skip manuscripts without an ID
+    rows = [manuscript.get("data", {}) for manuscript in data]
+    rows = [row for row in rows if row.get("manuscript_ID")]
+
+    # A window at a time, so the first graphs are yielded while the later manuscripts haven't been looked at yet
+    if window_size is None:
+        window_size = max(len(rows), 1)
+    for window_start in range(0, len(rows), window_size):
+        window = rows[window_start:window_start + window_size]
+
+        # Run the presenter -> classifier chats of the window concurrently; earlier windows
+        # have cached their answers, so a value repeated further on doesn't take another chat
+        classifier_replies = classify_properties(window, stats)
+
+        # Look up the distinct person names of the window at once, in a few batched SPARQL queries
+        person_uris = resolve_persons(collect_person_names(window))
+
+        # Process each manuscript of the window
+        for ms_index, row in enumerate(window):
+            g = new_graph()
+            ms_id = row.get("manuscript_ID")
+
+            cleaned_id = sanitize_for_uri(ms_id)
+            ms_node = EX[cleaned_id]
+
+            # Mark as ms4ai:Manuscript + shelfmark
+            g.add((ms_node, RDF_.type, MS4AI.Manuscript))
+            g.add((ms_node, MS4AI.shelfmark, rdflib.Literal(ms_id, datatype=XSD.string)))
+
+            # Add standard fields
+            add_if_present_literal(g, ms_node, MS4AI.attributedDate, "century_of_creation", row)
+            add_if_present_literal(g, ms_node, MS4AI.width, "dimensions_of_the_manuscript.width", row)
+            add_if_present_literal(g, ms_node, MS4AI.length, "dimensions_of_the_manuscript.length", row)
+            add_if_present_literal(g, ms_node, MS4AI.thickness, "dimensions_of_the_manuscript.thickness", row)
+            add_if_present_literal(g, ms_node, MS4AI.containedWork, "contained_works", row)
+            add_if_present_literal(g, ms_node, MS4AI.attributedAuthor, "authors", row)
+            add_if_present_literal(g, ms_node, MS4AI.attributedCopyist, "copyists", row)
+            add_if_present_literal(g, ms_node, MS4AI.attributedMiniaturist, "miniaturists", row)
+            add_if_present_literal(g, ms_node, MS4AI.attributedBookbinder, "bookbinders", row)
+            add_if_present_literal(g, ms_node, MS4AI.attributedIlluminator, "illuminators", row)
+            add_if_present_literal(g, ms_node, MS4AI.attributedRubricator, "rubricators", row)
+            add_if_present_literal(g, ms_node, MS4AI.conservationIntervention, "restoration_history", row)
+            add_if_present_literal(g, ms_node, MS4AI.historyOfOwnership, "ownership_history", row)
+            add_if_present_literal(g, ms_node, MS4AI.support, "support_type", row)
+            add_if_present_literal(g, ms_node, MS4AI.script, "handwriting_form", row)
+            add_if_present_literal(g, ms_node, MS4AI.includesDecoration, "decorations", row)
+            add_if_present_literal(g, ms_node, MS4AI.foliaCount, "total_folia_count", row)
+            add_if_present_literal(g, ms_node, MS4AI.ink, "ink", row)
+            add_if_present_literal(g, ms_node, MS4AI.binding, "binding", row)
+            add_if_present_literal(g, ms_node, MS4AI["format"], "format", row)
+
+            # rdfs:comment from additional_notes
+            notes_val = row.get("additional_notes", "")
+            if notes_val:
+                g.add((ms_node, RDFS.comment, rdflib.Literal(notes_val, datatype=XSD.string)))
+
+            # incipit => locus
+            incipit_val = row.get("incipit")
+            if incipit_val:
+                add_locus(g, ms_node, cleaned_id, MS4AI.incipit, "incipit", incipit_val)
+
+            # explicit => locus
+            explicit_val = row.get("explicit")
+            if explicit_val:
+                add_locus(g, ms_node, cleaned_id, MS4AI.explicit, "explicit", explicit_val)
+
+            # Property classifications, added in the fixed order of PROPERTY_CLASSIFIERS
+            for spec_index, spec in enumerate(PROPERTY_CLASSIFIERS):
+                reply = classifier_replies.get((ms_index, spec_index))
+                if reply:
+                    for item in classified_items(reply, spec.valid_values):
+                        g.add((ms_node, MS4AI[spec.predicate], rdflib.URIRef(f"{MS4AI}{item}")))
+
+            # authors, copyists, miniaturists, ... => hasAttributed* Wikidata URIs
+            for key, predicate in PERSON_ROLES:
+                for name in split_names(row.get(key)):
+                    uri = person_uris.get(name)
+                    if uri:
+                        g.add((ms_node, MS4AI[predicate], rdflib.URIRef(uri)))
+
+            yield g
 
                     # contained_works => includesWork
    # raw_works = (row.get("contained_works", "") or "").strip()
@@ -1033,6 +986,4 @@ def transform_data_into_rdf(data):
         #    for work_uri in splitted_works:
          #       g.add((ms_node, MS4AI.includesWork, rdflib.URIRef(work_uri)))
 
-    return g.serialize(format="turtle")
-
 
@@ -0,0 +1,194 @@
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from api.paths.caches import get_cache
+
+
+# Responses worth another try; anything else is returned or raised right away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Wikidata asks clients to identify themselves: https://meta.wikimedia.org/wiki/User-Agent_policy
+USER_AGENT = "ManuscriptAI/1.0 (https://www.ru.nl/en/research/research-projects/manuscriptai)"
+
+
+class TokenBucket:
+    """
+    Token bucket rate limit shared by every process that uses the same cache directory:
+    'rate' requests per second on average, with bursts of up to 'capacity' requests.
+    The bucket state lives in the 'rate_limits' cache and is updated in a transaction,
+    which SQLite serializes over all gunicorn workers.
+    """
+
+    def __init__(self, key: str, rate: float, capacity: int):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def acquire(self) -> float:
+        """
+        Take one token, sleeping until one is available. Returns the seconds waited.
+        """
+        cache = get_cache('rate_limits')
+        waited = 0.0
+        while True:
+            with cache.transact(retry=True):
+                now = time.time()
+                tokens, last = cache.get(self.key, default=(self.capacity, now), retry=True)
+                tokens = min(self.capacity, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    cache.set(self.key, (tokens - 1, now), retry=True)
+                    return waited
+                cache.set(self.key, (tokens, now), retry=True)
+            delay = (1 - tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class LatencyStats:
+    """
+    Per-process record of the duration and outcome of every request.
+    With 'log_interval', the summary is logged at most every 'log_interval' seconds, after a request.
+    """
+
+    def __init__(self, keep: int = 1000, name: str = "", log_interval: float = None):
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=keep)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.name = name
+        self.log_interval = log_interval
+        self.last_logged = time.monotonic()
+
+    def record(self, seconds: float, ok: bool) -> None:
+        with self.lock:
+            self.recent.append(seconds)
+            self.calls += 1
+            self.total_seconds += seconds
+            if not ok:
+                self.errors += 1
+            now = time.monotonic()
+            due = self.log_interval is not None and now - self.last_logged >= self.log_interval
+            if due:
+                self.last_logged = now
+        if due:
+            print(f"[sparql] {self.name}: {self.format_summary()}")
+
+    def summary(self) -> dict:
+        with self.lock:
+            recent = sorted(self.recent)
+            calls, errors, retries, total = self.calls, self.errors, self.retries, self.total_seconds
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] if recent else 0.0
+
+        return {
+            'calls': calls,
+            'errors': errors,
+            'retries': retries,
+            'mean_seconds': total / calls if calls else 0.0,
+            'p50_seconds': percentile(0.50),
+            'p95_seconds': percentile(0.95),
+            'max_seconds': recent[-1] if recent else 0.0,
+        }
+
+    def format_summary(self) -> str:
+        """
+        e.g. "120 requests, 3 errors, 2 retries; mean 0.31s, p50 0.25s, p95 0.90s, max 2.10s (last 1000 requests)"
+        """
+        summary = self.summary()
+        return (
+            f"{summary['calls']} requests, {summary['errors']} errors, {summary['retries']} retries; "
+            f"mean {summary['mean_seconds']:.2f}s, p50 {summary['p50_seconds']:.2f}s, "
+            f"p95 {summary['p95_seconds']:.2f}s, max {summary['max_seconds']:.2f}s "
+            f"(last {self.recent.maxlen} requests)"
+        )
+
+
+class SparqlClient:
+    """
+    HTTP client for a SPARQL endpoint, meant to be shared by all lookups of a process.
+    - keeps connections alive in a pool, so consecutive queries skip the TCP/TLS handshake;
+    - retries connection errors, timeouts and 429/5xx responses with exponential backoff,
+      waiting as long as the server's Retry-After header asks for;
+    - takes a token from a TokenBucket before every request, including retries;
+    - records the latency of every request in 'stats', and logs their summary every
+      'log_interval' seconds while requests are made.
+    """
+
+    def __init__(self, endpoint: str, rate: float = 5.0, burst: int = 10, max_retries: int = 3,
+                 backoff: float = 0.5, max_backoff: float = 30.0, pool_size: int = 10,
+                 log_interval: float = None):
+        self.endpoint = endpoint
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.bucket = TokenBucket(f'sparql|{endpoint}', rate, burst)
+        self.stats = LatencyStats(name=endpoint, log_interval=log_interval)
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': USER_AGENT,
+            'Accept': 'application/sparql-results+json',
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def query(self, query: str, timeout: float = 10) -> dict:
+        """
+        Run a SELECT query and return the parsed JSON results.
+        Raises the last error once all retries are used up.
+        """
+        params = {"query": query, "format": "json"}
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(self.endpoint, params=params, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self.stats.record(time.perf_counter() - start, ok=False)
+                if attempt == self.max_retries:
+                    raise
+                self.wait_before_retry(attempt, None)
+                continue
+
+            self.stats.record(time.perf_counter() - start, ok=response.ok)
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                self.wait_before_retry(attempt, response)
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    def wait_before_retry(self, attempt: int, response) -> None:
+        with self.stats.lock:
+            self.stats.retries += 1
+        delay = retry_after_seconds(response) if response is not None else None
+        if delay is None:
+            # Exponential backoff with jitter: ~0.5s, 1s, 2s, ...
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        time.sleep(min(delay, self.max_backoff))
+
+
+def retry_after_seconds(response) -> float | None:
+    """
+    The Retry-After header of a response in seconds; it may hold a number or an HTTP date.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
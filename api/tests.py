@@ -1,3 +1,779 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+import xml.etree.ElementTree as ET
 
-# Create your tests here.
+import rdflib
+from rdflib.compare import isomorphic
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from requests import HTTPError
+
+from api import activity_log, archive, jobs
+from api.benchmarks.fake_sparql import FakeSparqlServer
+from api.budgets import tokens_used_today
+from api.models import Activity, Job, JobChunk, PayloadBlob, summarize_payload
+from api.paths import caches, drop_classify, rdfData
+from api.paths.sparql_client import SparqlClient
+
+
+def person_uri(name):
+    return f"http://www.wikidata.org/entity/Q{sum(map(ord, name))}"
+
+
+def answer_persons(query):
+    """
+    Bindings of a batched person lookup (VALUES ?name { ... }) that finds everybody except "Nobody".
+    """
+    values = re.search(r'VALUES \?name \{(.*?)\}', query)
+    return [
+        {"name": {"value": name}, "item": {"value": person_uri(name)}, "ordinal": {"value": "0"}}
+        for name in re.findall(r'"(.*?)"', values.group(1)) if name != "Nobody"
+    ]
+
+
+class CacheDirTestCase(SimpleTestCase):
+    """
+    Runs every test with empty caches in a temporary directory.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patches = [
+            mock.patch.object(caches, 'CACHE_DIR', Path(directory.name)),
+            mock.patch.dict(caches._open_caches, clear=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def start_server(self, **options) -> FakeSparqlServer:
+        server = FakeSparqlServer(**options).__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        return server
+
+
+class SparqlClientTests(CacheDirTestCase):
+
+    def test_retries_server_errors_as_long_as_retry_after_asks(self):
+        server = self.start_server(fail_first=2, error_status=503, retry_after=0.2)
+        # Without the Retry-After header the backoff would take at least 5 seconds
+        client = SparqlClient(server.endpoint, rate=100, burst=10, max_retries=3, backoff=10)
+        start = time.perf_counter()
+        client.query("SELECT * WHERE {}")
+        elapsed = time.perf_counter() - start
+        self.assertEqual(server.requests, 3)
+        self.assertGreaterEqual(elapsed, 0.4)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(client.stats.summary()['retries'], 2)
+        self.assertEqual(client.stats.summary()['errors'], 2)
+
+    def test_retries_too_many_requests(self):
+        server = self.start_server(fail_first=1, error_status=429, retry_after=0)
+        client = SparqlClient(server.endpoint, rate=100, burst=10, max_retries=3)
+        self.assertEqual(client.query("SELECT * WHERE {}")["results"]["bindings"], [])
+        self.assertEqual(server.requests, 2)
+
+    def test_raises_once_the_retries_are_used_up(self):
+        server = self.start_server(error_rate=1, error_status=500, retry_after=0)
+        client = SparqlClient(server.endpoint, rate=100, burst=10, max_retries=2)
+        with self.assertRaises(HTTPError):
+            client.query("SELECT * WHERE {}")
+        self.assertEqual(server.requests, 3)
+
+    def test_does_not_retry_client_errors(self):
+        server = self.start_server(error_rate=1, error_status=400, retry_after=0)
+        client = SparqlClient(server.endpoint, rate=100, burst=10, max_retries=3)
+        with self.assertRaises(HTTPError):
+            client.query("SELECT * WHERE {}")
+        self.assertEqual(server.requests, 1)
+
+    def test_logs_the_latencies_every_log_interval(self):
+        server = self.start_server(fail_first=1, retry_after=0)
+        client = SparqlClient(server.endpoint, rate=100, burst=10, log_interval=0)
+        with mock.patch('builtins.print') as log:
+            client.query("SELECT * WHERE {}")
+        self.assertEqual(log.call_count, 2)
+        self.assertIn("2 requests, 1 errors, 1 retries", log.call_args[0][0])
+
+    def test_rate_limit_allows_a_burst_then_the_rate(self):
+        server = self.start_server()
+        client = SparqlClient(server.endpoint, rate=20, burst=2)
+        start = time.perf_counter()
+        for _ in range(2):
+            client.query("SELECT * WHERE {}")
+        self.assertLess(time.perf_counter() - start, 0.1)
+        for _ in range(4):
+            client.query("SELECT * WHERE {}")
+        # The 4 requests after the burst wait for a token every 1/20 seconds
+        self.assertGreaterEqual(time.perf_counter() - start, 0.18)
+        self.assertEqual(server.requests, 6)
+
+
+class WikidataLookupTests(CacheDirTestCase):
+
+    def use_server(self, **options) -> FakeSparqlServer:
+        server = self.start_server(answer=answer_persons, **options)
+        client = SparqlClient(server.endpoint, rate=100, burst=10, max_retries=0)
+        patch = mock.patch.object(rdfData, 'wikidata_client', client)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return server
+
+    def assertCached(self, name, status, ttl):
+        entry, expire_time = caches.get_cache("wikidata").get(
+            rdfData.wikidata_cache_key("person", name), expire_time=True
+        )
+        self.assertEqual(entry["status"], status)
+        self.assertAlmostEqual(expire_time - time.time(), ttl, delta=5)
+
+    def test_hit_is_cached_for_the_hit_ttl(self):
+        server = self.use_server()
+        self.assertEqual(rdfData.resolve_persons(["Dante Alighieri"]), {"Dante Alighieri": person_uri("Dante Alighieri")})
+        self.assertCached("Dante Alighieri", "hit", rdfData.WIKIDATA_HIT_TTL)
+        self.assertEqual(rdfData.resolve_persons(["Dante  Alighieri"]), {"Dante  Alighieri": person_uri("Dante Alighieri")})
+        self.assertEqual(server.requests, 1)
+
+    def test_miss_is_cached_for_the_miss_ttl(self):
+        server = self.use_server()
+        self.assertEqual(rdfData.resolve_persons(["Nobody"]), {"Nobody": ""})
+        self.assertCached("Nobody", "miss", rdfData.WIKIDATA_MISS_TTL)
+        self.assertEqual(rdfData.resolve_persons(["Nobody"]), {"Nobody": ""})
+        self.assertEqual(server.requests, 1)
+
+    def test_error_is_cached_for_the_error_ttl(self):
+        server = self.use_server(error_rate=1, error_status=500)
+        self.assertEqual(rdfData.resolve_persons(["Dante Alighieri"]), {"Dante Alighieri": ""})
+        self.assertCached("Dante Alighieri", "error", rdfData.WIKIDATA_ERROR_TTL)
+        self.assertEqual(rdfData.resolve_persons(["Dante Alighieri"]), {"Dante Alighieri": ""})
+        self.assertEqual(server.requests, 1)
+
+    def test_resolve_persons_looks_up_the_uncached_names_in_batches(self):
+        server = self.use_server()
+        rdfData.resolve_persons(["Petrarch"])
+        names = ["Petrarch", "Boccaccio", "Nobody", "Dante", "Giotto", "Cimabue"]
+        with mock.patch.object(rdfData, 'WIKIDATA_BATCH_SIZE', 2):
+            uris = rdfData.resolve_persons(names)
+
+        self.assertEqual(uris, {name: "" if name == "Nobody" else person_uri(name) for name in names})
+        # Petrarch on its own, then the 5 names that weren't cached, 2 at a time
+        batches = [re.findall(r'"(.*?)"', re.search(r'VALUES \?name \{(.*?)\}', query).group(1))
+                   for query in server.queries[1:]]
+        self.assertEqual(batches, [["Boccaccio", "Nobody"], ["Dante", "Giotto"], ["Cimabue"]])
+        self.assertCached("Giotto", "hit", rdfData.WIKIDATA_HIT_TTL)
+        self.assertCached("Nobody", "miss", rdfData.WIKIDATA_MISS_TTL)
+
+        self.assertEqual(rdfData.resolve_persons(names), uris)
+        self.assertEqual(server.requests, 4)
+
+
+
+class RdfWindowTests(SimpleTestCase):
+
+    DATA = [{"data": {"manuscript_ID": f"Ms. {n}", "authors": f"Auctor {n}"}} for n in range(10)] + [{"data": {}}]
+
+    def setUp(self):
+        self.calls = []
+        patches = [
+            mock.patch.object(rdfData, "classify_properties", side_effect=lambda rows, stats=None: self.calls.append(
+                ("classify", [row["manuscript_ID"] for row in rows])) or {}),
+            mock.patch.object(rdfData, "resolve_persons", side_effect=lambda names: self.calls.append(
+                ("persons", names)) or {name: person_uri(name) for name in names}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_transform_classifies_all_manuscripts_together(self):
+        graph = rdflib.Graph().parse(data=rdfData.transform_data_into_rdf(self.DATA), format="turtle")
+        self.assertEqual(self.calls, [
+            ("classify", [f"Ms. {n}" for n in range(10)]), ("persons", [f"Auctor {n}" for n in range(10)]),
+        ])
+        self.assertEqual(len(set(graph.subjects(rdflib.RDF.type, None))), 10)
+
+    @mock.patch.object(rdfData, "RDF_STREAM_WINDOW", 4)
+    def test_stream_classifies_a_window_at_a_time(self):
+        pieces = rdfData.iter_rdf(self.DATA)
+        prefixes = next(pieces)
+        self.assertEqual(self.calls, [])
+        graph = rdflib.Graph().parse(data=prefixes + "".join(pieces), format="turtle")
+        self.assertEqual([len(names) for call, names in self.calls], [4, 4, 4, 4, 2, 2])
+        self.assertEqual(len(set(graph.subjects(rdflib.RDF.type, None))), 10)
+
+
+@override_settings(JOB_CHUNK_MAX_ATTEMPTS=3, JOB_CHUNK_RETRY_SECONDS=10, JOB_CHUNK_STALE_SECONDS=600,
+                   ACTIVITY_WRITE_BEHIND=False)
+class JobTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='test')
+        self.job = Job.objects.create(user=user, endpoint='drop_classify', input={})
+        self.chunk = JobChunk.objects.create(job=self.job, index=0, text="Ms. 1")
+        patch = mock.patch.object(jobs.time, 'sleep')
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def assertBackoff(self, *seconds):
+        """
+        The waits before the retries were about 'seconds', give or take the jitter.
+        """
+        waits = [call.args[0] for call in self.sleep.call_args_list]
+        self.assertEqual(len(waits), len(seconds))
+        for wait, expected in zip(waits, seconds):
+            self.assertTrue(expected / 2 <= wait <= expected * 1.5, (wait, expected))
+
+    def structure(self, *outcomes):
+        """
+        Patch the Structurer to fail with the exceptions and answer with the strings in 'outcomes'.
+        """
+        patch = mock.patch.object(jobs, 'structure_chunk_cached', side_effect=[
+            outcome if isinstance(outcome, Exception) else (outcome, False) for outcome in outcomes
+        ])
+        self.addCleanup(patch.stop)
+        return patch.start()
+
+    def test_failed_chunk_is_tried_again(self):
+        structurer = self.structure(RuntimeError("timeout"), json.dumps({"manuscript_ID": "Ms. 1"}))
+        jobs.process_chunk(self.chunk.pk)
+        self.chunk.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual(structurer.call_count, 2)
+        self.assertEqual((self.chunk.status, self.chunk.attempts, self.chunk.error), (Job.DONE, 2, ""))
+        self.assertEqual(self.job.status, Job.DONE)
+        self.assertEqual(self.job.output["structured_data"][0]["data_analyzed"], "Ms. 1")
+        self.assertBackoff(10)
+        # The output has what is needed of the chunks
+        self.assertEqual((self.chunk.text, self.chunk.reply), ("", ""))
+
+    def test_chunk_fails_after_the_last_attempt(self):
+        structurer = self.structure(*[RuntimeError("timeout")] * 4)
+        jobs.process_chunk(self.chunk.pk)
+        self.chunk.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual(structurer.call_count, 3)
+        self.assertEqual((self.chunk.status, self.chunk.attempts), (Job.FAILED, 3))
+        self.assertEqual(self.job.status, Job.FAILED)
+        self.assertBackoff(10, 20)
+
+    def test_stale_running_chunks_are_queued_again(self):
+        long_ago = timezone.now() - timedelta(seconds=601)
+        JobChunk.objects.filter(pk=self.chunk.pk).update(status=Job.RUNNING, claimed=long_ago, attempts=1)
+        running = JobChunk.objects.create(job=self.job, index=1, text="Ms. 2", status=Job.RUNNING,
+                                          claimed=timezone.now(), attempts=1)
+        given_up = JobChunk.objects.create(job=self.job, index=2, text="Ms. 3", status=Job.RUNNING,
+                                           claimed=long_ago, attempts=3)
+
+        self.assertEqual(jobs.requeue_stale_chunks(600), 1)
+        statuses = dict(JobChunk.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {self.chunk.pk: Job.PENDING, running.pk: Job.RUNNING, given_up.pk: Job.FAILED})
+
+        # When nothing else works on the queue, every running chunk is stale
+        self.assertEqual(jobs.requeue_stale_chunks(0), 1)
+        self.assertEqual(JobChunk.objects.get(pk=running.pk).status, Job.PENDING)
+
+    def test_jobs_are_deleted_some_days_after_they_finished(self):
+        Job.objects.filter(pk=self.job.pk).update(status=Job.DONE, finished=timezone.now() - timedelta(days=31))
+        recent = Job.objects.create(user=self.job.user, endpoint='drop_classify', input={}, status=Job.DONE,
+                                    finished=timezone.now() - timedelta(days=29))
+        unfinished = Job.objects.create(user=self.job.user, endpoint='drop_classify', input={})
+
+        self.assertEqual(jobs.purge_finished_jobs(30, dry_run=True), 1)
+        self.assertEqual(jobs.purge_finished_jobs(30), 1)
+        self.assertEqual(set(Job.objects.values_list('pk', flat=True)), {recent.pk, unfinished.pk})
+        self.assertFalse(JobChunk.objects.exists())
+
+
+
+@override_settings(ACTIVITY_WRITE_BEHIND=True)
+class TokenBudgetTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="reader")
+        Activity.objects.create(user=self.user, endpoint="transform", input=[], output="", prompt_tokens=700)
+        # A sink that holds on to its records until 'written' is set
+        self.written = threading.Event()
+        sink = activity_log.ActivitySink()
+        patches = [
+            mock.patch.object(activity_log, "sink", sink),
+            mock.patch.object(sink, "write", side_effect=lambda activities: self.written.wait(10)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(sink.close)
+        self.addCleanup(self.written.set)
+
+    def test_queued_activities_count_until_they_are_written(self):
+        other = User.objects.create(username="other")
+        activity_log.log_activity(user=self.user, endpoint="drop_classify", input={}, output={},
+                                  prompt_tokens=200, completion_tokens=50)
+        activity_log.log_activity(user=other, endpoint="drop_classify", input={}, output={}, prompt_tokens=10)
+        activity_log.log_activity(user=other, endpoint="transform", input={}, output={})
+        self.assertEqual(tokens_used_today(self.user), 950)
+        self.assertEqual(tokens_used_today(other), 10)
+
+        self.written.set()
+        self.assertTrue(activity_log.flush_activities(10))
+        self.assertEqual(tokens_used_today(self.user), 700)
+        self.assertEqual(tokens_used_today(other), 0)
+
+
+def parse_chunks(chunks, format="turtle") -> rdflib.Graph:
+    """
+    The union of the graphs of the chunks, each parsed as a document of its own,
+    as the Structurer sees them.
+    """
+    graph = rdflib.Graph()
+    for chunk in chunks:
+        graph += rdflib.Graph().parse(data=chunk, format=format)
+    return graph
+
+
+class TurtleChunkingTests(SimpleTestCase):
+
+    TURTLE = """
+    @prefix ex: <http://example.org/> .
+    @prefix ms4ai: <http://ontology.tno.nl/manuscriptAI/> .
+
+    ex:ms1 a ms4ai:Manuscript ; ms4ai:shelfmark "Ms. 1" ; ms4ai:binding _:binding ;
+        ms4ai:includesLocus [ ms4ai:includesText "Incipit liber primus" ] .
+    ex:ms2 a ms4ai:Manuscript ; ms4ai:shelfmark "Ms. 2" ; ms4ai:binding _:binding .
+    ex:ms3 a ms4ai:Manuscript ; ms4ai:shelfmark "Ms. 3" ; ms4ai:heldBy _:library .
+    ex:ms4 a ms4ai:Manuscript ; ms4ai:shelfmark "Ms. 4" ; ms4ai:heldBy _:library .
+    _:binding ms4ai:material "leather" ; ms4ai:decoratedWith [ ms4ai:motif "fleur-de-lis" ] .
+    _:library ms4ai:name "Biblioteca Laurenziana" ; ms4ai:partOf _:binding .
+    _:cycle1 ms4ai:next _:cycle2 .
+    _:cycle2 ms4ai:next _:cycle1 .
+    """
+
+    def test_chunks_parse_to_the_same_graph(self):
+        graph = rdflib.Graph().parse(data=self.TURTLE, format="turtle")
+        for token_budget in [40, 80, 10000]:
+            chunks = drop_classify.chunk_turtle(self.TURTLE, token_budget)
+            self.assertTrue(isomorphic(parse_chunks(chunks), graph), token_budget)
+
+    def test_blank_node_is_described_with_all_subjects_referring_to_it(self):
+        chunks = drop_classify.chunk_turtle(self.TURTLE, 40)
+        self.assertGreater(len(chunks), 1)
+        for text in ["ex:ms1", "ex:ms2", "ex:ms3", "ex:ms4", '"leather"', '"Biblioteca Laurenziana"']:
+            self.assertEqual(sum(text in chunk for chunk in chunks), 1, text)
+        self.assertEqual(len(chunks), len(set(chunks)))
+        [chunk] = [chunk for chunk in chunks if '"leather"' in chunk]
+        for text in ["ex:ms1", "ex:ms2", "ex:ms3", "ex:ms4", '"Biblioteca Laurenziana"']:
+            self.assertIn(text, chunk)
+
+    def test_same_turtle_gives_the_same_chunks(self):
+        self.assertEqual(drop_classify.chunk_turtle(self.TURTLE, 40), drop_classify.chunk_turtle(self.TURTLE, 40))
+
+
+def count_tokens(text):
+    return drop_classify.count_tokens(text, drop_classify.model)
+
+
+class PackingTests(SimpleTestCase):
+
+    UNITS = [f'{{"manuscript_ID": "Ms. {n}", "title": "{"Liber " * (n % 7)}"}}' for n in range(60)]
+
+    def test_chunks_stay_within_the_budget(self):
+        for token_budget in [30, 100, 400]:
+            chunks = drop_classify.pack_units(self.UNITS, token_budget, head="[", separator=", ", tail="]")
+            for chunk in chunks:
+                self.assertLessEqual(count_tokens(chunk), token_budget)
+            self.assertEqual([item for chunk in chunks for item in json.loads(chunk)],
+                             [json.loads(unit) for unit in self.UNITS])
+
+    def test_chunks_are_as_full_as_the_budget_allows(self):
+        chunks = drop_classify.pack_units(self.UNITS, 100, head="[", separator=", ", tail="]")
+        for chunk, following in zip(chunks, chunks[1:]):
+            first_unit = json.dumps(json.loads(following)[0], ensure_ascii=False)
+            self.assertGreater(count_tokens(chunk[:-1] + ", " + first_unit + "]"), 100)
+
+    def test_unit_over_the_budget_is_a_chunk_of_its_own(self):
+        units = ["short", "long " * 50, "short"]
+        self.assertEqual(drop_classify.pack_units(units, 20), units)
+
+    def test_duplicate_units_are_left_out_if_asked(self):
+        stats = {}
+        chunks = drop_classify.pack_units(["a", "b", "a", "c", "b"], 1000, stats=stats, skip_duplicates=True)
+        self.assertEqual((chunks, stats), (["a\nb\nc"], {"duplicate_records": 2}))
+        self.assertEqual(drop_classify.pack_units(["a", "b", "a"], 1000, skip_duplicates=False), ["a\nb\na"])
+
+
+class CsvChunkingTests(SimpleTestCase):
+
+    ROWS = [["shelfmark", "title", "notes"]] + [
+        [f"Ms. {n}", f'Liber "{n}", pars {n % 3}', "folio 1r\nfolio 2v" if n % 4 == 0 else ""] for n in range(40)
+    ]
+
+    def csv_text(self, delimiter=","):
+        text = io.StringIO()
+        writer = csv.writer(text, delimiter=delimiter, lineterminator="\r\n")
+        for n, row in enumerate(self.ROWS):
+            writer.writerow(row)
+            if n % 10 == 5:
+                text.write("\r\n")
+        return text.getvalue()
+
+    def parse_chunks(self, chunks, delimiter=","):
+        rows = []
+        for chunk in chunks:
+            header, *records = csv.reader(io.StringIO(chunk, newline=""), delimiter=delimiter)
+            self.assertEqual(header, self.ROWS[0])
+            rows += records
+        return rows
+
+    def test_chunks_parse_to_the_same_records(self):
+        for is_tsv, delimiter in [(False, ","), (True, "\t")]:
+            text = self.csv_text(delimiter)
+            chunks = drop_classify.chunk_csv_tsv(text, is_tsv=is_tsv, token_budget=60)
+            self.assertGreater(len(chunks), 1)
+            for chunk in chunks:
+                self.assertLessEqual(count_tokens(chunk), 60)
+            self.assertEqual(self.parse_chunks(chunks, delimiter), self.ROWS[1:])
+
+    def test_streamed_file_gives_the_same_chunks(self):
+        text = self.csv_text()
+        chunks = drop_classify.chunk_csv_tsv(text, token_budget=60)
+        streamed = drop_classify.iter_file_chunks(io.BytesIO(("\ufeff" + text).encode()), "csv", token_budget=60)
+        self.assertEqual(list(streamed), chunks)
+
+    def test_header_only(self):
+        self.assertEqual(drop_classify.chunk_csv_tsv("\n\nshelfmark,title\n\n", token_budget=60), [])
+        self.assertEqual(drop_classify.chunk_csv_tsv("", token_budget=60), [])
+
+
+def split_text(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+class JsonChunkingTests(SimpleTestCase):
+
+    ITEMS = [
+        {"manuscript_ID": f"Ms. {n}", "folios": n * 2.5, "scribes": ["Johannes", "Petrus"][:n % 3], "dated": n % 2 == 0,
+         "note": None if n % 5 else "ink \"ferrogallica\", [faded]"}
+        for n in range(30)
+    ] + [12, -0.5, 1e-7, "x", [], {}]
+
+    def test_array_items_are_decoded_from_any_pieces(self):
+        text = " [ " + " , ".join(json.dumps(item) for item in self.ITEMS) + " ]\n"
+        for size in [1, 2, 3, 7, 64, len(text)]:
+            first, *rest = split_text(text, size)
+            # The buffer starts with the "[", as in iter_json_chunks()
+            while "[" not in first:
+                first += rest.pop(0)
+            self.assertEqual(list(drop_classify.iter_json_array_items(first, iter(rest))), self.ITEMS, size)
+
+    def test_invalid_arrays_raise(self):
+        for text in ["[1, 2", "[1 2]", "[1,, 2]", "[1] garbage", "[] 2", "[1]]"]:
+            for size in [1, len(text)]:
+                first, *rest = split_text(text, size)
+                with self.assertRaises(json.JSONDecodeError, msg=text):
+                    list(drop_classify.iter_json_array_items(first, iter(rest)))
+
+    def test_streamed_chunks_are_those_of_chunk_json(self):
+        text = json.dumps(self.ITEMS, ensure_ascii=False)
+        chunks = drop_classify.chunk_json(text, token_budget=80)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual([item for chunk in chunks for item in json.loads(chunk)], self.ITEMS)
+        for size in [5, 100, len(text)]:
+            self.assertEqual(list(drop_classify.iter_json_chunks(split_text(text, size), 80)), chunks, size)
+
+    def test_invalid_json_falls_back_to_plain_text_like_chunk_json(self):
+        for text in ['[{"manuscript_ID": "Ms. 1"}] and Ms. 2', '[{"manuscript_ID": "Ms. 1"}, Ms. 2]', "Ms. 1"]:
+            expected = drop_classify.chunk_json(text, token_budget=80)
+            self.assertEqual(expected, drop_classify.chunk_plain_text(text, 80))
+            self.assertEqual(list(drop_classify.iter_json_chunks(split_text(text, 4), 80)), expected, text)
+
+    def test_invalid_json_after_the_first_chunk_raises(self):
+        text = json.dumps(self.ITEMS) + " garbage"
+        chunks = drop_classify.iter_json_chunks(split_text(text, 100), 80)
+        self.assertEqual(next(chunks), drop_classify.chunk_json(json.dumps(self.ITEMS), token_budget=80)[0])
+        with self.assertRaises(json.JSONDecodeError):
+            list(chunks)
+
+
+def element_shape(element):
+    """
+    Tag, attributes, text and children of an element, with the namespaces resolved and the tail left out.
+    """
+    return (element.tag, element.attrib, (element.text or "").strip(),
+            [element_shape(child) + ((child.tail or "").strip(),) for child in element])
+
+
+class XmlChunkingTests(SimpleTestCase):
+
+    TEI = """<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0" xmlns:ex="http://example.org/">
+  <teiHeader><fileDesc><titleStmt><title>Catalogo</title></titleStmt></fileDesc></teiHeader>
+  <text><body>
+    <listBibl>
+{}
+    </listBibl>
+  </body></text>
+</TEI>
+"""
+
+    MSDESC = """      <msDesc xml:id="ms{n}" ex:status="draft">
+        <msIdentifier><idno>Ms. {n}</idno></msIdentifier>
+        <msContents><summary>Liber <hi rend="italic">primus</hi> &amp; "secundus" &lt;{n}&gt;</summary></msContents>
+        <ex:note>Folio {n}r</ex:note>
+      </msDesc>"""
+
+    def tei(self, count=12):
+        return self.TEI.format("\n".join(self.MSDESC.format(n=n) for n in range(count)))
+
+    def chunk_units(self, chunks):
+        units = []
+        for chunk in chunks:
+            units += list(ET.fromstring(f"<chunk>{chunk}</chunk>"))
+        return [element_shape(unit) for unit in units]
+
+    def test_tei_chunks_hold_every_msdesc(self):
+        text = self.tei()
+        chunks = drop_classify.chunk_xml(text, token_budget=150)
+        self.assertGreater(len(chunks), 1)
+        expected = [element_shape(element) for element in ET.fromstring(text).iter(drop_classify.MSDESC_TAG)]
+        self.assertEqual(self.chunk_units(chunks), expected)
+        # The document's own prefixes are kept
+        self.assertTrue(chunks[0].startswith("<msDesc "))
+        self.assertIn('xml:id="ms0" ex:status="draft"', chunks[0])
+        self.assertIn("<ex:note>Folio 0r</ex:note>", chunks[0])
+
+    def test_streamed_file_gives_the_same_chunks(self):
+        text = self.tei()
+        chunks = drop_classify.chunk_xml(text, token_budget=150)
+        self.assertEqual(list(drop_classify.iter_file_chunks(io.BytesIO(text.encode()), "tei", 150)), chunks)
+
+    def test_other_xml_is_chunked_by_top_level_children(self):
+        text = "<catalog>" + "".join(f'<item n="{n}">Ms. {n}<b>x</b></item>' for n in range(20)) + "</catalog>"
+        chunks = drop_classify.chunk_xml(text, token_budget=40)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(self.chunk_units(chunks), [element_shape(item) for item in ET.fromstring(text)])
+
+    def test_tei_without_msdesc_is_chunked_by_top_level_children(self):
+        text = self.tei(0)
+        chunks = drop_classify.chunk_xml(text, token_budget=1000)
+        self.assertEqual(self.chunk_units(chunks), [element_shape(child) for child in ET.fromstring(text)])
+
+    def test_text_that_is_not_xml_falls_back_to_plain_text(self):
+        text = "Ms. 1, Liber primus. Ms. 2, Liber secundus."
+        self.assertEqual(drop_classify.chunk_xml(text, token_budget=1000), [text])
+        self.assertEqual(list(drop_classify.iter_file_chunks(io.BytesIO(text.encode()), "xml", 1000)), [text])
+
+
+def structure_rows(chunk_text):
+    """
+    A Structurer reply with a record per CSV row of the chunk: (manuscript_ID, title), for structure_chunk_cached.
+    """
+    rows = list(csv.reader(io.StringIO(chunk_text)))[1:]
+    return json.dumps([{"manuscript_ID": manuscript_id, "title": title} for manuscript_id, title in rows]), False
+
+
+class ManuscriptAssemblerTests(SimpleTestCase):
+
+    REPLIES = [
+        ([{"title": "Without an ID"}, {"manuscript_ID": "Ms. 1", "title": "Liber", "size": {"height": 30}}], "chunk 0"),
+        ([{"manuscript_ID": "MS.  1", "title": "Liber", "size": {"width": 20}}, {"script": "gothica"},
+          {"manuscript_ID": "Ms. 2", "title": ""}], "chunk 1"),
+        ([{"title": "Codex"}, {"manuscript_ID": " ms. 1 ", "title": "Codex", "scribes": ["Petrus"]}], "chunk 2"),
+        ([{"manuscript_ID": "Ms. 3"}], "chunk 3"),
+    ]
+
+    def results(self):
+        return [(json.dumps(records), chunk_text) for records, chunk_text in self.REPLIES]
+
+    def test_records_are_merged_by_normalized_manuscript_id(self):
+        merged = drop_classify.merge_structured_results(self.results())
+        self.assertEqual(merged, {"structured_data": [
+            {"title": "Without an ID", "data_analyzed": "chunk 0"},
+            {"manuscript_ID": "Ms. 1", "title": "Liber / Codex", "size": {"height": 30, "width": 20},
+             "script": "gothica", "scribes": ["Petrus"], "data_analyzed": "chunk 0\nchunk 1\nchunk 2"},
+            {"manuscript_ID": "Ms. 2", "title": "Codex", "data_analyzed": "chunk 1\nchunk 2"},
+            {"manuscript_ID": "Ms. 3", "data_analyzed": "chunk 3"},
+        ]})
+
+    def test_streamed_manuscripts_add_up_to_the_merged_ones(self):
+        merged = {}
+        for index, manuscript in drop_classify.iter_merged_manuscripts(self.results()):
+            if index in merged:
+                # Sent again: the fields replace the earlier ones, data_analyzed adds to it
+                self.assertNotIn(merged[index]["data_analyzed"], manuscript["data_analyzed"])
+                manuscript = dict(manuscript, data_analyzed=merged[index]["data_analyzed"] + "\n" + manuscript["data_analyzed"])
+            merged[index] = manuscript
+        self.assertEqual([merged[index] for index in sorted(merged)],
+                         drop_classify.merge_structured_results(self.results())["structured_data"])
+
+
+@override_settings(ACTIVITY_WRITE_BEHIND=False)
+class DropClassifyStreamTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("reader")
+        self.client.force_login(self.user)
+        patches = [
+            mock.patch.object(drop_classify, "structure_chunk_cached", side_effect=structure_rows),
+            # No unfinished jobs to resume from the test database
+            mock.patch.object(jobs, "_resumed", True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_activity_has_the_merged_manuscripts(self):
+        rows = "\n".join(f"{'MS ' if n % 2 else 'ms  '}{n % 15},{'lorem ' * (20 + n % 9)}" for n in range(200))
+        body = {"content": "shelfmark,title\n" + rows, "extension": "csv"}
+        expected = self.client.post("/api/drop-classify", body, content_type="application/json").json()
+        self.assertEqual(len(expected["structured_data"]), 15)
+
+        response = self.client.post("/api/drop-classify/stream", body, content_type="application/json")
+        records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(records[-1]["type"], "summary")
+        self.assertGreater(records[-1]["chunks"], 1)
+        self.assertGreater(len(records) - 1, 15)
+
+        activity = Activity.objects.filter(endpoint="drop_classify").latest("pk")
+        self.assertEqual(activity.output, expected)
+        self.assertTrue(activity.output_summary.startswith("structured_data: 15 items"))
+
+
+class PayloadBlobMigrationTests(TransactionTestCase):
+
+    PAYLOADS = [
+        ({"content": "shelfmark,title\nMs. 1,Liber", "extension": "csv"}, {"structured_data": [{"title": "Liber"}]}),
+        ({"content": "shelfmark,title\nMs. 1,Liber", "extension": "csv"}, {"structured_data": []}),
+        ([{"data": {"manuscript_ID": "Ms. 2", "material": "pergamena, «antica»"}}], "@prefix ex: <http://example.org/> ."),
+        ({"content": "", "extension": "txt"}, []),
+    ]
+
+    def migrate(self, target: str):
+        """
+        Migrate the api app to 'target', or its latest migration, and return the models as they are then.
+        """
+        executor = MigrationExecutor(connection)
+        targets = [("api", target)] if target else [key for key in executor.loader.graph.leaf_nodes() if key[0] == "api"]
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(None)
+
+    def test_payloads_are_the_same_after_the_migration_and_back(self):
+        old_apps = self.migrate("0003_llm_usage")
+        user = old_apps.get_model("auth", "User").objects.create(username="reader")
+        OldActivity = old_apps.get_model("api", "Activity")
+        pks = [OldActivity.objects.create(user=user, endpoint="drop_classify", input=input, output=output).pk
+               for input, output in self.PAYLOADS]
+
+        self.migrate(None)
+        # Equal payloads share a blob
+        distinct = {json.dumps(payload, sort_keys=True) for payloads in self.PAYLOADS for payload in payloads}
+        self.assertEqual(PayloadBlob.objects.count(), len(distinct))
+        for pk, (input, output) in zip(pks, self.PAYLOADS):
+            activity = Activity.objects.get(pk=pk)
+            self.assertEqual((activity.input, activity.output), (input, output))
+            self.assertEqual(activity.input_summary, summarize_payload(input, activity.input_blob.size))
+            self.assertEqual(activity.output_summary, summarize_payload(output, activity.output_blob.size))
+            self.assertEqual(activity.output_blob, PayloadBlob.of(output))
+
+        old_apps = self.migrate("0003_llm_usage")
+        OldActivity = old_apps.get_model("api", "Activity")
+        self.assertEqual([(activity.input, activity.output) for activity in OldActivity.objects.order_by("pk")],
+                         self.PAYLOADS)
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        user = User.objects.create(username="reader")
+        now = timezone.now()
+        for n in range(30):
+            activity = Activity.objects.create(user=user, endpoint=["drop_classify", "transform"][n % 2],
+                                               input={"content": f"Ms. {n % 4}"}, output={"n": n, "title": "Liber «primus»"})
+            Activity.objects.filter(pk=activity.pk).update(created=now - timedelta(days=10 * n))
+        self.payloads = {activity.pk: (activity.input, activity.output) for activity in Activity.objects.all()}
+
+    def expired(self):
+        return archive.expired_activities(100, {"transform": 50})
+
+    def archived(self) -> list[dict]:
+        lines = []
+        for path in sorted(self.directory.glob("activities-*.jsonl.gz")):
+            with gzip.open(path) as file:
+                lines += [json.loads(line) for line in file]
+        return lines
+
+    def test_expired_activities_are_archived_and_deleted(self):
+        expired = set(self.expired().values_list("pk", flat=True))
+        kept = set(self.payloads) - expired
+        stats = {}
+        archive.archive_activities(self.expired(), self.directory, batch_size=4, stats=stats)
+
+        lines = self.archived()
+        self.assertEqual(sorted(line["id"] for line in lines), sorted(expired))
+        for line in lines:
+            self.assertEqual((line["input"], line["output"]), self.payloads[line["id"]])
+            self.assertEqual(line["username"], "reader")
+        self.assertEqual(set(Activity.objects.values_list("pk", flat=True)), kept)
+        self.assertEqual(stats["activities"], len(expired))
+
+        # The blobs still in use are kept, the others deleted
+        for activity in Activity.objects.all():
+            self.assertEqual((activity.input, activity.output), self.payloads[activity.pk])
+        in_use = {digest for activity in Activity.objects.all() for digest in [activity.input_blob_id, activity.output_blob_id]}
+        self.assertEqual(set(PayloadBlob.objects.values_list("pk", flat=True)), in_use)
+
+    def test_interrupted_archive_is_completed_once(self):
+        expired = sorted(self.expired().values_list("pk", flat=True))
+        atomic = archive.transaction.atomic
+        calls = []
+
+        def interrupted_atomic(*args, **kwargs):
+            calls.append(None)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return atomic(*args, **kwargs)
+
+        # Only the transactions of archive_activities itself
+        transaction = mock.Mock(atomic=interrupted_atomic)
+        with mock.patch.object(archive, "transaction", transaction), self.assertRaises(KeyboardInterrupt):
+            archive.archive_activities(self.expired(), self.directory, batch_size=4)
+        # The second batch is on disk, but its activities were not deleted
+        self.assertEqual(len(self.archived()), 8)
+        self.assertEqual(self.expired().count(), len(expired) - 4)
+        self.assertTrue(list(self.directory.glob("*.pending")))
+
+        archive.archive_activities(self.expired(), self.directory, batch_size=4)
+        self.assertEqual(sorted(line["id"] for line in self.archived()), expired)
+        self.assertFalse(list(self.directory.glob("*.pending")))
+
+        # Once done, running it again changes nothing
+        archives = {path: path.read_bytes() for path in self.directory.iterdir()}
+        self.assertFalse(self.expired().exists())
+        archive.archive_activities(self.expired(), self.directory, batch_size=4)
+        self.assertEqual({path: path.read_bytes() for path in self.directory.iterdir()}, archives)
+
+    def test_pending_file_of_a_deleted_batch_keeps_the_batch(self):
+        archive.archive_activities(self.expired(), self.directory, batch_size=4)
+        [path, *_] = sorted(self.directory.glob("activities-*.jsonl.gz"))
+        lines = self.archived()
+        # As if interrupted after the deletion was committed, but before the .pending file was removed
+        archive.pending_path(path).write_text(json.dumps({"size": 0, "ids": [line["id"] for line in lines]}))
+        self.assertEqual(archive.recover_archives(self.directory), 0)
+        self.assertEqual(self.archived(), lines)
+        self.assertFalse(list(self.directory.glob("*.pending")))
@@ -5,9 +5,14 @@ from . import views
 
 urlpatterns = [
     path('drop-classify', views.drop_classify_view, name='drop_classify'),
+    path('drop-classify/stream', views.drop_classify_stream_view, name='drop_classify_stream'),
+    path('drop-classify/jobs', views.drop_classify_job_view, name='drop_classify_job'),
+    path('drop-classify/jobs/<int:job_id>', views.drop_classify_job_status_view, name='drop_classify_job_status'),
+    path('drop-classify/jobs/<int:job_id>/result', views.drop_classify_job_result_view, name='drop_classify_job_result'),
     path('process', views.process_view, name='process'),
     path('send_manuscripts', views.send_manuscripts_view, name='send_manuscripts'),
     path('transform', views.transform_view, name='transform'),
+    path('transform/stream', views.transform_stream_view, name='transform_stream'),
     path('set-csrf-token', views.set_csrf_token, name='set_csrf_token'),
     path('login', views.login_view, name='login'),
     path('logout', views.logout_view, name='logout'),
@@ -1,14 +1,20 @@
 import json
+import os
+import time
 
-from django.http.response import JsonResponse, HttpResponse
+from django.http.response import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404
 
-from api.paths.drop_classify import drop_classify
+from api.paths.drop_classify import drop_classify, iter_drop_classify, iter_drop_classify_file
+from api.paths.metering import metering
 from api.paths.property_structuring import send_manuscipts
-from api.paths.rdfData import transform_data_into_rdf
-from api.models import Activity
+from api.paths.rdfData import iter_rdf, transform_data_into_rdf
+from api.models import Job, StreamedString, format_size
+from api.jobs import submit_drop_classify_job, job_status, job_result
+from api.activity_log import log_activity
+from api.budgets import within_token_budget
 from django.views.decorators.csrf import ensure_csrf_cookie
 import json
 from django.contrib.auth import authenticate, login, logout
@@ -70,49 +76,178 @@ def register(request):
 
 @require_http_methods(["POST"])
 @login_required
+@within_token_budget
 def drop_classify_view(request):
     input = json.loads(request.body)
-    output = drop_classify(input)
-    Activity.objects.create(user=request.user, endpoint='drop_classify', input=input, output=output)
-    return JsonResponse(output)
+    stats = {}
+    with metering() as meter:
+        output = drop_classify(input, stats=stats)
+    print(f"Chunks served from the extraction cache: {stats['chunks_from_cache']}, duplicates skipped: "
+          f"{stats.get('duplicate_records', 0)} records, {stats['duplicate_chunks']} chunks, "
+          f"near-duplicate chunks sent: {stats['near_duplicate_chunks']}")
+    print(f"LLM usage: {meter.as_fields()}")
+    log_activity(user=request.user, endpoint='drop_classify', input=input, output=output,
+                 **meter.as_fields())
+    response = JsonResponse(output)
+    response['X-Chunks-From-Cache'] = stats['chunks_from_cache']
+    response['X-Duplicate-Records-Skipped'] = stats.get('duplicate_records', 0)
+    response['X-Duplicate-Chunks-Skipped'] = stats['duplicate_chunks']
+    response['X-Near-Duplicate-Chunks'] = stats['near_duplicate_chunks']
+    return response
+
+def stream_records(records, sse: bool):
+    """
+    Encode dicts as newline delimited JSON, or as server-sent events named after their 'type'.
+    """
+    for record in records:
+        line = json.dumps(record, ensure_ascii=False)
+        if sse:
+            yield f"event: {record['type']}\ndata: {line}\n\n"
+        else:
+            yield line + "\n"
 
 @require_http_methods(["POST"])
 @login_required
-def process_view(request):
+@within_token_budget
+def drop_classify_stream_view(request):
+    """
+    Same input as drop_classify_view, but every manuscript is sent as soon as it is complete:
+        {"type": "manuscript", "index": 0, "manuscript": {...}}
+    When a later chunk adds to a manuscript, it is sent again with the same index, to replace the earlier one;
+    its data_analyzed then has the text of the chunks since it was sent before, to add to the earlier one.
+    The records are followed by a summary:
+        {"type": "summary", "manuscripts": 12, "chunks": 30, "chunks_from_cache": 4, "duplicate_records": 8,
+         "duplicate_chunks": 2, "near_duplicate_chunks": 1, "llm_calls": 26, "tokens": 151230, "seconds": 81.2}
+    or {"type": "error", "error": "..."} if structuring fails halfway.
+    Newline delimited JSON by default, server-sent events with ?format=sse.
     """
-    Reads the entire file as raw text and displays
-    it on a new page (results.html) with manuscript boxes.
+    input = json.loads(request.body)
+    return drop_classify_stream_response(request, input, lambda stats: iter_drop_classify(input, stats=stats))
+
+def drop_classify_stream_response(request, input, manuscripts_of):
+    """
+    The streaming response of drop_classify_stream_view, for the (index, manuscript) pairs
+    yielded by manuscripts_of(stats). 'input' is stored with the Activity, and as its output
+    the merged manuscripts, as drop_classify_view returns them.
     """
-    if 'file' not in request.FILES:
-        return JsonResponse({'error': 'No file part in the request'})
+    user = request.user
+    sse = request.GET.get('format') == 'sse'
 
-    file = request.FILES['file']
-    if file.filename == '':
-        return JsonResponse({'error': 'No selected file'})
+    def records():
+        start = time.perf_counter()
+        stats = {}
+        # Index => the manuscript as last sent, with the data_analyzed of every time it was sent
+        merged = {}
+        with metering() as meter:
+            try:
+                for index, manuscript in manuscripts_of(stats):
+                    record = {'type': 'manuscript', 'index': index, 'manuscript': manuscript}
+                    yield record
+                    if index in merged:
+                        data_analyzed = [merged[index]['data_analyzed'], manuscript['data_analyzed']]
+                        manuscript = dict(manuscript, data_analyzed="\n".join(filter(None, data_analyzed)))
+                    merged[index] = manuscript
+            except Exception as e:
+                print(f"[ERROR] Streaming drop_classify failed: {e}")
+                yield {'type': 'error', 'error': str(e)}
+                return
 
-    try:
-        # Read everything as raw text (no chunking here)
-        raw_text = file.read().decode('utf-8', errors='replace')
+        print(f"Chunks served from the extraction cache: {stats['chunks_from_cache']}, duplicates skipped: "
+              f"{stats.get('duplicate_records', 0)} records, {stats['duplicate_chunks']} chunks, "
+              f"near-duplicate chunks sent: {stats['near_duplicate_chunks']}")
+        print(f"LLM usage: {meter.as_fields()}")
+        output = {'structured_data': [merged[index] for index in sorted(merged)]}
+        log_activity(user=user, endpoint='drop_classify', input=input, output=output, **meter.as_fields())
+        yield {
+            'type': 'summary',
+            'manuscripts': len(merged),
+            'chunks': stats['chunks'],
+            'chunks_from_cache': stats['chunks_from_cache'],
+            'duplicate_records': stats.get('duplicate_records', 0),
+            'duplicate_chunks': stats['duplicate_chunks'],
+            'near_duplicate_chunks': stats['near_duplicate_chunks'],
+            'llm_calls': meter.llm_calls,
+            'tokens': meter.total_tokens,
+            'seconds': round(time.perf_counter() - start, 2),
+        }
 
-        # Pass raw_text into template to display it
-        return render(raw_text, 'results1.html')
+    content_type = 'text/event-stream' if sse else 'application/x-ndjson'
+    response = StreamingHttpResponse(stream_records(records(), sse), content_type=content_type)
+    # Keep a reverse proxy such as nginx from holding back the records until the response is complete
+    response['X-Accel-Buffering'] = 'no'
+    response['Cache-Control'] = 'no-cache'
+    return response
 
-    except Exception as e:
-        print(f"Error: {e}")
-        return JsonResponse({'error': str(e)})
+@require_http_methods(["POST"])
+@login_required
+@within_token_budget
+def drop_classify_job_view(request):
+    """
+    Same input as drop_classify_view, but the chunks are processed by the
+    worker pool. Returns the job ID immediately; poll the status and result endpoints.
+    """
+    input = json.loads(request.body)
+    job = submit_drop_classify_job(request.user, input)
+    return JsonResponse({'job_id': job.pk, 'status': job.status}, status=202)
 
+@require_http_methods(["GET"])
+@login_required
+def drop_classify_job_status_view(request, job_id):
+    job = get_object_or_404(Job, pk=job_id, user=request.user)
+    return JsonResponse(job_status(job))
+
+@require_http_methods(["GET"])
+@login_required
+def drop_classify_job_result_view(request, job_id):
+    """
+    Returns the 'structured_data' merged so far ('partial': true) or the final output.
+    """
+    job = get_object_or_404(Job, pk=job_id, user=request.user)
+    return JsonResponse(job_result(job))
 
 @require_http_methods(["POST"])
 @login_required
+@within_token_budget
+def process_view(request):
+    """
+    drop-classify for a file uploaded as multipart/form-data ('file', optionally 'extension';
+    by default the extension of the file name). Django spools large uploads to a temporary file,
+    which is read and chunked a piece at a time while the first chunks are already with the LLM,
+    so the whole file is never in memory. Answers with the records of drop_classify_stream_view.
+    """
+    upload = request.FILES.get('file')
+    if upload is None or not upload.name:
+        return JsonResponse({'error': 'No file part in the request'}, status=400)
+
+    extension = request.POST.get('extension') or os.path.splitext(upload.name)[1].lstrip('.') or 'txt'
+    # The Activity gets a description of the upload instead of its content
+    input = {'filename': upload.name, 'extension': extension, 'size': upload.size}
+    print(f"Processing upload {upload.name} ({upload.size} bytes)")
+    return drop_classify_stream_response(
+        request, input, lambda stats: iter_drop_classify_file(upload.file, extension, stats=stats)
+    )
+
+
+@require_http_methods(["POST"])
+@login_required
+@within_token_budget
 def send_manuscripts_view(request):
     input = json.loads(request.body)
-    output, status = send_manuscipts(input)
-    Activity.objects.create(user=request.user, endpoint='send_manuscripts', input=input, output=output)
-    return JsonResponse(output, status=status)
+    stats = {}
+    with metering() as meter:
+        output, status = send_manuscipts(input, stats=stats)
+    print(f"Manuscript boxes served from the extraction cache: {stats['chunks_from_cache']}")
+    print(f"LLM usage: {meter.as_fields()}")
+    log_activity(user=request.user, endpoint='send_manuscripts', input=input, output=output,
+                 **meter.as_fields())
+    response = JsonResponse(output, status=status)
+    response['X-Chunks-From-Cache'] = stats['chunks_from_cache']
+    return response
 
 
 @require_http_methods(["POST"])
 @login_required
+@within_token_budget
 def transform_view(request):
     """
     Example JSON input:
@@ -128,8 +263,56 @@ def transform_view(request):
     ]
     """
     input = json.loads(request.body)
-    print("manuscripts_data:", input)
-    output = transform_data_into_rdf(input)
-    print("rdf_output:", output)
-    Activity.objects.create(user=request.user, endpoint='transform', input=input, output=output)
-    return HttpResponse(output, content_type="text/turtle")
\ No newline at end of file
+    print(f"Transforming {len(input)} manuscripts ({format_size(len(request.body))})")
+    stats = {}
+    with metering() as meter:
+        output = transform_data_into_rdf(input, stats=stats)
+    print(f"RDF output: {format_size(len(output.encode()))}")
+    print(f"LLM classifier calls avoided by the lexicon: {stats['llm_calls_avoided']}, "
+          f"classifier cache hits: {stats['classifier_cache_hits']}")
+    print(f"LLM usage: {meter.as_fields()}")
+    log_activity(user=request.user, endpoint='transform', input=input, output=output,
+                 **meter.as_fields())
+    response = HttpResponse(output, content_type="text/turtle")
+    response['X-LLM-Calls-Avoided'] = stats['llm_calls_avoided']
+    response['X-Classifier-Cache-Hits'] = stats['classifier_cache_hits']
+    return response
+
+
+@require_http_methods(["POST"])
+@login_required
+@within_token_budget
+def transform_stream_view(request):
+    """
+    Same input as transform_view, but the RDF is sent one manuscript at a time:
+    Turtle with the prefixes up front, or N-Triples with ?format=nt.
+    """
+    input = json.loads(request.body)
+    user = request.user
+    rdf_format = 'nt' if request.GET.get('format') == 'nt' else 'turtle'
+
+    def pieces():
+        stats = {}
+        # The RDF sent so far, compressed for the Activity
+        output = StreamedString()
+        with metering() as meter:
+            try:
+                for piece in iter_rdf(input, rdf_format, stats=stats):
+                    output.write(piece)
+                    yield piece
+            except Exception as e:
+                print(f"[ERROR] Streaming transform failed: {e}")
+                # A comment keeps what was sent so far a valid document
+                yield f"# error: {' '.join(str(e).split())}\n"
+                return
+
+        print(f"LLM classifier calls avoided by the lexicon: {stats['llm_calls_avoided']}, "
+              f"classifier cache hits: {stats['classifier_cache_hits']}")
+        print(f"LLM usage: {meter.as_fields()}")
+        log_activity(user=user, endpoint='transform', input=input, output=output,
+                     **meter.as_fields())
+
+    content_type = 'application/n-triples' if rdf_format == 'nt' else 'text/turtle'
+    response = StreamingHttpResponse(pieces(), content_type=content_type)
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,17 +1,17 @@
 #!/bin/sh
 
-## Check that Postgres is running
-#if [ "$DATABASE" = "postgres" ]
-#then
-#    echo "Waiting for Postgres..."
-#
-#    while ! nc -z $SQL_HOST $SQL_PORT; do
-#      sleep 0.1
-#    done
-#
-#    echo "PostgreSQL started"
-#fi
-#
+# Check that Postgres is running
+if [ "$DATABASE" = "postgres" ]
+then
+    echo "Waiting for Postgres..."
+
+    while ! nc -z ${SQL_HOST:-localhost} ${SQL_PORT:-5432}; do
+      sleep 0.1
+    done
+
+    echo "PostgreSQL started"
+fi
+
 ## Check that Redis is running
 #if ! [ -z $REDIS_HOST ]
 #then
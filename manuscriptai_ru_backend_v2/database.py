@@ -0,0 +1,51 @@
+"""
+The database, configured from the environment: the SQLite file in writable/database by default,
+or Postgres with DATABASE=postgres and SQL_DATABASE, SQL_USER, SQL_PASSWORD, SQL_HOST and SQL_PORT.
+"""
+import os
+
+
+# Run on every new SQLite connection. In WAL mode readers don't wait for the writer and the writer
+# doesn't wait for readers; with synchronous=NORMAL a commit isn't synced to disk until the next
+# checkpoint, so a power cut may lose the last commits, but never corrupts the database.
+SQLITE_INIT_COMMAND = "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL"
+
+
+def sqlite_settings(name, busy_timeout: float) -> dict:
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+        'OPTIONS': {
+            'init_command': SQLITE_INIT_COMMAND,
+            # Seconds to wait for the lock of another connection before "database is locked" (busy_timeout)
+            'timeout': busy_timeout,
+            # Take the write lock when a transaction begins: a transaction that first reads and then
+            # writes can't wait for the lock halfway, it would fail at once
+            'transaction_mode': 'IMMEDIATE',
+        },
+    }
+
+
+def postgres_settings() -> dict:
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.getenv('SQL_DATABASE', 'manuscriptai'),
+        'USER': os.getenv('SQL_USER', 'manuscriptai'),
+        'PASSWORD': os.getenv('SQL_PASSWORD', ''),
+        'HOST': os.getenv('SQL_HOST', 'localhost'),
+        'PORT': os.getenv('SQL_PORT', '5432'),
+    }
+
+
+def database_settings(sqlite_path) -> dict:
+    """
+    settings.DATABASES['default'], with connections kept open for CONN_MAX_AGE seconds (default 600)
+    instead of a new one for every request, and checked before they are reused.
+    """
+    if os.getenv('DATABASE', 'sqlite') == 'postgres':
+        database = postgres_settings()
+    else:
+        database = sqlite_settings(sqlite_path, busy_timeout=float(os.getenv('SQLITE_BUSY_TIMEOUT', '20')))
+    database['CONN_MAX_AGE'] = int(os.getenv('CONN_MAX_AGE', '600'))
+    database['CONN_HEALTH_CHECKS'] = True
+    return database
@@ -14,6 +14,8 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 
+from manuscriptai_ru_backend_v2.database import database_settings
+
 
 # Load environment variables
 load_dotenv()
@@ -82,10 +84,7 @@ WSGI_APPLICATION = 'manuscriptai_ru_backend_v2.wsgi.application'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / '../writable/database' / 'db.sqlite3',
-    }
+    'default': database_settings(BASE_DIR / '../writable/database' / 'db.sqlite3'),
 }
 
 
@@ -130,3 +129,49 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Background jobs
+# Number of threads per process that send drop-classify job chunks to the LLM
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+
+# Times a chunk is tried before it is marked as failed, counting chunks left running by a worker that died
+JOB_CHUNK_MAX_ATTEMPTS = int(os.getenv('JOB_CHUNK_MAX_ATTEMPTS', '3'))
+
+# Seconds a worker waits before it tries a failed chunk again, doubled after every attempt, with jitter,
+# so a rate-limited or overloaded LLM gets some time to recover
+JOB_CHUNK_RETRY_SECONDS = float(os.getenv('JOB_CHUNK_RETRY_SECONDS', '10'))
+
+# Seconds after which a running chunk is taken to be abandoned by its worker and queued again;
+# keep it well above the time the Structurer may take for one chunk
+JOB_CHUNK_STALE_SECONDS = int(os.getenv('JOB_CHUNK_STALE_SECONDS', '3600'))
+
+# Queue the unfinished jobs again when a server process starts, e.g. after a deployment
+JOB_RESUME_ON_STARTUP = os.getenv('JOB_RESUME_ON_STARTUP', 'True') != 'False'
+
+# Days finished jobs are kept before './manage.py archive_activities' deletes them with their chunks;
+# their input and output stay in the Activity of the job, which is archived like the others
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '30'))
+
+
+# Activity log
+# Write Activity records from a background thread, in batches, instead of in the request;
+# set ACTIVITY_WRITE_BEHIND=False to write them right away, e.g. in tests
+
+ACTIVITY_WRITE_BEHIND = os.getenv('ACTIVITY_WRITE_BEHIND', 'True') != 'False'
+ACTIVITY_BATCH_SIZE = int(os.getenv('ACTIVITY_BATCH_SIZE', '100'))
+
+
+# Activity retention
+# Days activities are kept before './manage.py archive_activities' moves them to the monthly archives,
+# and the days for particular endpoints, e.g. ACTIVITY_RETENTION_DAYS_BY_ENDPOINT=drop_classify=90,transform=180
+
+ACTIVITY_RETENTION_DAYS = int(os.getenv('ACTIVITY_RETENTION_DAYS', '365'))
+ACTIVITY_RETENTION_DAYS_BY_ENDPOINT = {
+    endpoint.strip(): int(days)
+    for endpoint, days in (
+        item.split('=') for item in os.getenv('ACTIVITY_RETENTION_DAYS_BY_ENDPOINT', '').split(',') if item.strip()
+    )
+}
+ACTIVITY_ARCHIVE_DIR = Path(os.getenv('ACTIVITY_ARCHIVE_DIR', BASE_DIR / '../writable/archive'))